@@ -13,11 +13,19 @@ import sqlite3
 import io
 import time
 import json
+import re
 import uuid
+import hashlib
+import hmac
 import smtplib
 import threading
 import sys
 import signal
+import functools
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, date
 from typing import Dict, List, Optional, Tuple, Any
 from enum import Enum
@@ -42,12 +50,13 @@ from telegram.ext import (
     ConversationHandler
 )
 from telegram.constants import ParseMode
-from telegram.error import Conflict, InvalidToken
+from telegram.error import BadRequest, Conflict, InvalidToken, RetryAfter
 
 # ===== PDF GENERATION IMPORTS =====
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, letter
 from reportlab.lib.units import mm, inch
+from reportlab.lib.utils import ImageReader
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, Image
 from reportlab.lib import colors
@@ -56,7 +65,7 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 
 # ===== IMAGE PROCESSING =====
-from PIL import Image as PILImage
+from PIL import Image as PILImage, ImageOps
 from dotenv import load_dotenv
 
 # ===== PREMIUM MANAGER (WITH FALLBACK) =====
@@ -275,12 +284,266 @@ class AppointmentType(Enum):
     WORKING_HOURS_SETUP
 ) = range(21)
 
-# ===== DATABASE INITIALIZATION =====
-def init_db():
-    """Initialize database with all required tables"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
+# ===== DATABASE CONNECTION MANAGER =====
+DB_PATH = os.getenv('DB_PATH', 'invoices.db')
+
+# Tuning profile applied to every connection. Override any entry through the
+# environment, e.g. DB_SYNCHRONOUS=FULL or DB_MMAP_SIZE=0 to disable mmap.
+DB_PRAGMAS = {
+    'busy_timeout': int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000')),  # milliseconds
+    'journal_mode': os.getenv('DB_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('DB_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.getenv('DB_CACHE_SIZE', '-16000')),  # negative = KiB, i.e. 16 MB
+    'mmap_size': int(os.getenv('DB_MMAP_SIZE', str(128 * 1024 * 1024))),  # bytes
+    'temp_store': os.getenv('DB_TEMP_STORE', 'MEMORY'),
+}
+
+# Keyword PRAGMAs are interpolated into SQL, so only accept known values
+_DB_PRAGMA_CHOICES = {
+    'journal_mode': {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'},
+    'synchronous': {'OFF', 'NORMAL', 'FULL', 'EXTRA'},
+    'temp_store': {'DEFAULT', 'FILE', 'MEMORY'},
+}
+
+# Retry policy for "database is locked" once busy_timeout has been exhausted
+DB_LOCK_RETRIES = int(os.getenv('DB_LOCK_RETRIES', '3'))
+DB_LOCK_RETRY_DELAY = float(os.getenv('DB_LOCK_RETRY_DELAY', '0.2'))  # seconds, doubled per attempt
+
+_db_local = threading.local()
+
+def apply_db_pragmas(conn: sqlite3.Connection):
+    """Apply the DB_PRAGMAS tuning profile to a freshly opened connection"""
+    for name, value in DB_PRAGMAS.items():
+        if name in _DB_PRAGMA_CHOICES:
+            value = str(value).upper()
+            if value not in _DB_PRAGMA_CHOICES[name]:
+                logger.warning(f"⚠️  Ignoring invalid PRAGMA {name}={value}")
+                continue
+        try:
+            conn.execute(f'PRAGMA {name} = {value}')
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️  Could not apply PRAGMA {name}={value}: {e}")
+
+def get_db_settings() -> Dict[str, Any]:
+    """Read back the effective PRAGMA values on this thread's connection"""
+    conn = _get_thread_connection()
+    settings = {}
+    for name in DB_PRAGMAS:
+        row = conn.execute(f'PRAGMA {name}').fetchone()
+        settings[name] = row[0] if row else None
+    return settings
+
+def log_db_settings():
+    """Report the effective database settings at startup"""
+    try:
+        settings = get_db_settings()
+        summary = ', '.join(f"{name}={value}" for name, value in settings.items())
+        logger.info(f"✅ Database {DB_PATH} settings: {summary}")
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️  Could not read database settings: {e}")
+
+def is_db_locked_error(error: Exception) -> bool:
+    """True for the transient SQLITE_BUSY / SQLITE_LOCKED errors"""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+def call_with_lock_retry(func, *args, **kwargs):
+    """Call a database helper, retrying with backoff while the database stays locked"""
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not is_db_locked_error(e) or attempt >= DB_LOCK_RETRIES:
+                raise
+            logger.warning(f"⚠️  Database locked in {getattr(func, '__name__', func)}, retry {attempt + 1}/{DB_LOCK_RETRIES}")
+        time.sleep(DB_LOCK_RETRY_DELAY * (2 ** attempt))
+        attempt += 1
+
+class DatabaseConnection:
+    """Lease on the calling thread's shared SQLite connection.
+
+    Behaves like a sqlite3.Connection, so existing helpers keep their
+    cursor()/commit()/close() calls. Leases nest, and only the outermost one
+    owns the transaction:
+
+    - A nested lease (a helper called while its caller holds a lease) works
+      inside a SAVEPOINT. Its commit() folds its changes into the caller's
+      transaction rather than committing the caller's half-finished work;
+      its rollback(), or close() without commit(), undoes only its own
+      changes. With no transaction open in the caller, commit() is final.
+    - Releasing the outermost lease rolls back anything uncommitted, which is
+      what closing a private connection used to do. If a nested lease
+      committed into the transaction, it is committed instead, as that
+      commit() used to do on the spot.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+        self._released = False
+        self._depth = getattr(_db_local, 'depth', 0) + 1
+        _db_local.depth = self._depth
+        self._savepoint = None
+        if self._depth == 1:
+            _db_local.nested_commit = False
+        else:
+            self._savepoint = f"lease_{self._depth}"
+            conn.execute(f"SAVEPOINT {self._savepoint}")
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._conn, name)
+
+    def commit(self):
+        """Commit (outermost lease) or fold into the caller's transaction (nested)"""
+        if self._savepoint is None:
+            self._conn.commit()
+            _db_local.nested_commit = False
+            return
+        self._conn.execute(f"RELEASE {self._savepoint}")
+        if self._conn.in_transaction:
+            _db_local.nested_commit = True
+        # Keep a savepoint open for whatever this lease does next
+        self._conn.execute(f"SAVEPOINT {self._savepoint}")
+
+    def rollback(self):
+        """Roll back the transaction (outermost lease) or this lease's changes (nested)"""
+        if self._savepoint is None:
+            self._conn.rollback()
+            _db_local.nested_commit = False
+        else:
+            self._conn.execute(f"ROLLBACK TO {self._savepoint}")
+
+    def close(self):
+        """Release this lease on the shared connection"""
+        if self._released:
+            return
+        self._released = True
+        _db_local.depth = max(0, getattr(_db_local, 'depth', 1) - 1)
+        if self._savepoint is not None:
+            try:
+                self._conn.execute(f"ROLLBACK TO {self._savepoint}")
+                self._conn.execute(f"RELEASE {self._savepoint}")
+            except sqlite3.OperationalError:
+                pass  # the outer lease already ended the transaction
+        elif self._conn.in_transaction:
+            if getattr(_db_local, 'nested_commit', False):
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+            _db_local.nested_commit = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        self.close()
+        return False
+
+    def __del__(self):
+        # A helper that raised before close() still gives its lease back
+        try:
+            self.close()
+        except Exception:
+            pass
+
+def _get_thread_connection() -> sqlite3.Connection:
+    """Open (once per thread) and return the thread's SQLite connection"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_PRAGMAS['busy_timeout'] / 1000)
+        apply_db_pragmas(conn)
+        _db_local.conn = conn
+        _db_local.depth = 0
+    return conn
+
+def get_db_connection() -> DatabaseConnection:
+    """Get a lease on the shared database connection for this thread"""
+    return DatabaseConnection(_get_thread_connection())
+
+def db_connection() -> DatabaseConnection:
+    """Context manager over the shared connection - commits on success, rolls back on error
+
+    Usage:
+        with db_connection() as conn:
+            conn.execute(...)
+    """
+    return get_db_connection()
+
+def close_db_connection():
+    """Close this thread's shared connection (e.g. when a worker thread exits)"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _db_local.conn = None
+        _db_local.depth = 0
+
+# ===== ASYNC DATABASE ACCESS =====
+# Handlers run on the python-telegram-bot event loop, so blocking sqlite3 calls
+# are pushed onto a small bounded pool. Each worker thread gets its own shared
+# connection from the connection manager above.
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '4'))
+
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_executor_lock = threading.Lock()
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Get (and lazily create) the executor used for database work"""
+    global _db_executor
+    if _db_executor is None:
+        with _db_executor_lock:
+            if _db_executor is None:
+                _db_executor = ThreadPoolExecutor(
+                    max_workers=max(1, DB_EXECUTOR_WORKERS),
+                    thread_name_prefix='db-worker'
+                )
+    return _db_executor
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database helper off the event loop and await its result
+
+    Usage:
+        user = await run_db(get_user, user_id)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_db_executor(),
+        functools.partial(call_with_lock_retry, func, *args, **kwargs)
+    )
+
+def shutdown_db_executor(wait: bool = True):
+    """Stop the database executor (called on bot shutdown)"""
+    global _db_executor
+    with _db_executor_lock:
+        if _db_executor is not None:
+            _db_executor.shutdown(wait=wait)
+            _db_executor = None
+
+# ===== SCHEMA MIGRATIONS =====
+# Schema changes are ordered migrations recorded in schema_version. Once the
+# database is current, startup runs a single SELECT and no DDL at all.
+# To change the schema, append a new (version, name, function) entry to
+# SCHEMA_MIGRATIONS - never edit a migration that has already shipped.
+
+def _table_columns(cursor, table: str) -> set:
+    """Get the column names of a table"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {row[1] for row in cursor.fetchall()}
+
+def _add_column_if_missing(cursor, table: str, column: str, definition: str) -> bool:
+    """Add a column unless a database created by older code already has it"""
+    if column in _table_columns(cursor, table):
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+def _migration_001_initial_schema(cursor):
+    """Base schema - all tables, seed data and indexes the bot shipped with"""
     # Users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -550,59 +813,850 @@ def init_db():
             cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {index_def}')
         except sqlite3.Error as e:
             print(f"⚠️  Could not create index {index_name}: {e}")
+
+def _migration_002_invoice_document_type(cursor):
+    """Quote support - invoices.document_type (was update_database_for_quotes)"""
+    _add_column_if_missing(cursor, 'invoices', 'document_type', "TEXT DEFAULT 'invoice'")
+
+def _migration_003_user_reminder_settings(cursor):
+    """users.reminder_settings and users.telegram_id, queried by reminders but never created"""
+    _add_column_if_missing(cursor, 'users', 'reminder_settings', "TEXT DEFAULT '{}'")
+    if _add_column_if_missing(cursor, 'users', 'telegram_id', 'INTEGER'):
+        # Private chats use the Telegram user ID as the chat ID
+        cursor.execute('UPDATE users SET telegram_id = user_id WHERE telegram_id IS NULL')
+
+def _migration_004_invoice_items(cursor):
+    """Line items move from the invoices.items JSON blob to an invoice_items table"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invoice_items (
+            item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invoice_id INTEGER NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            description TEXT,
+            quantity NUMERIC NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (invoice_id) REFERENCES invoices (invoice_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id, position)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoice_items_description ON invoice_items(description)')
     
-    conn.commit()
-    conn.close()
-    logger.info("✅ Database initialization complete with enhanced scheduling system")
+    _move_invoice_item_blobs(cursor)
 
-# ===== INITIALIZE DATABASE =====
-init_db()
+def _move_invoice_item_blobs(cursor):
+    """Copy invoices.items blobs into invoice_items, quarantining any that can't be parsed"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invoice_items_quarantine (
+            invoice_id INTEGER PRIMARY KEY,
+            items TEXT,
+            error TEXT,
+            quarantined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    migrated = []
+    quarantined = []
+    rows = cursor.execute("SELECT invoice_id, items FROM invoices WHERE items IS NOT NULL").fetchall()
+    for invoice_id, blob in rows:
+        try:
+            item_rows = _invoice_item_rows(invoice_id, json.loads(blob) if blob else [])
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"⚠️ Invoice {invoice_id} has unreadable items JSON ({e}), "
+                           f"copied to invoice_items_quarantine")
+            quarantined.append((invoice_id, blob, str(e)))
+            continue
+        cursor.executemany('''
+            INSERT INTO invoice_items (invoice_id, position, description, quantity, amount)
+            VALUES (?, ?, ?, ?, ?)
+        ''', item_rows)
+        migrated.append((invoice_id,))
+    
+    cursor.executemany('''
+        INSERT OR REPLACE INTO invoice_items_quarantine (invoice_id, items, error) VALUES (?, ?, ?)
+    ''', quarantined)
+    # The blob is no longer read or written; clear it so list queries stop paging it in
+    cursor.executemany('UPDATE invoices SET items = NULL WHERE invoice_id = ?',
+                       migrated + [(invoice_id,) for invoice_id, _, _ in quarantined])
+    if migrated:
+        logger.info(f"🔧 Moved line items of {len(migrated)} invoices/quotes to invoice_items")
+    if quarantined:
+        logger.warning(f"⚠️ {len(quarantined)} unreadable items blobs kept in invoice_items_quarantine")
+
+# end_time is derived from appointment_time + duration_minutes. The triggers keep
+# it current for every writer, so conflict checks can be plain range predicates.
+APPOINTMENT_END_TIME_SQL = "datetime({row}appointment_time, '+' || COALESCE({row}duration_minutes, 0) || ' minutes')"
+
+def _migration_005_appointment_end_time(cursor):
+    """Stored appointments.end_time plus an index for interval (conflict) queries"""
+    _add_column_if_missing(cursor, 'appointments', 'end_time', 'TIMESTAMP')
+    cursor.execute(f"UPDATE appointments SET end_time = {APPOINTMENT_END_TIME_SQL.format(row='')}")
+    
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_appointments_end_time_insert
+        AFTER INSERT ON appointments
+        BEGIN
+            UPDATE appointments SET end_time = {APPOINTMENT_END_TIME_SQL.format(row='NEW.')}
+            WHERE appointment_id = NEW.appointment_id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_appointments_end_time_update
+        AFTER UPDATE OF appointment_time, duration_minutes ON appointments
+        BEGIN
+            UPDATE appointments SET end_time = {APPOINTMENT_END_TIME_SQL.format(row='NEW.')}
+            WHERE appointment_id = NEW.appointment_id;
+        END
+    ''')
+    
+    # end_time leads appointment_time: "ends after the new slot starts" is the
+    # selective side of an overlap test, so past history is never scanned
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_user_status_interval
+        ON appointments(user_id, status, end_time, appointment_time)
+    ''')
 
-# ===== DEFAULT SETTINGS HELPER FUNCTIONS =====
-def init_default_working_hours(user_id):
-    """Initialize default working hours for a user"""
-    conn = sqlite3.connect('invoices.db')
+# Monthly usage per (user_id, period 'YYYY-MM', kind). Triggers bump the counters
+# in the same transaction as the write, so every writer is counted exactly once:
+# 'appointment' on creation, 'invoice'/'quote' when a document becomes approved.
+# Migration 013 replaces these triggers with ones that also release usage.
+USAGE_PERIOD_SQL = "strftime('%Y-%m', 'now', 'localtime')"
+
+def _migration_006_usage_counters(cursor):
+    """Materialized monthly usage counters for tier limit checks"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_counters (
+            user_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, period, kind)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Backfill from existing rows (created_at is stored in UTC)
+    cursor.execute('''
+        INSERT OR REPLACE INTO usage_counters (user_id, period, kind, count)
+        SELECT user_id, strftime('%Y-%m', created_at, 'localtime'), 'appointment', COUNT(*)
+        FROM appointments GROUP BY 1, 2
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO usage_counters (user_id, period, kind, count)
+        SELECT user_id, strftime('%Y-%m', created_at, 'localtime'), COALESCE(document_type, 'invoice'), COUNT(*)
+        FROM invoices WHERE status = 'approved' GROUP BY 1, 2, 3
+    ''')
+    
+    bump = f'''
+        INSERT INTO usage_counters (user_id, period, kind, count)
+        VALUES (NEW.user_id, {USAGE_PERIOD_SQL}, {{kind}}, 1)
+        ON CONFLICT (user_id, period, kind) DO UPDATE SET count = count + 1;
+    '''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_usage_appointment_created
+        AFTER INSERT ON appointments
+        BEGIN {bump.format(kind="'appointment'")} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_usage_document_inserted_approved
+        AFTER INSERT ON invoices WHEN NEW.status = 'approved'
+        BEGIN {bump.format(kind="COALESCE(NEW.document_type, 'invoice')")} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_usage_document_approved
+        AFTER UPDATE OF status ON invoices
+        WHEN NEW.status = 'approved' AND OLD.status IS NOT 'approved'
+        BEGIN {bump.format(kind="COALESCE(NEW.document_type, 'invoice')")} END
+    ''')
+
+# Full-text search: external-content FTS5 tables over clients, invoices/quotes
+# and line items, kept in sync by triggers. (table, content table, rowid column,
+# indexed columns, columns whose updates need re-indexing)
+SEARCH_INDEXES = [
+    ('clients_fts', 'clients', 'client_id', ['user_id', 'client_name', 'email']),
+    ('invoices_fts', 'invoices', 'invoice_id', ['user_id', 'invoice_number', 'client_name', 'client_email']),
+    ('invoice_items_fts', 'invoice_items', 'item_id', ['invoice_id', 'description']),
+]
+
+def _migration_007_search_index(cursor):
+    """FTS5 search index (skipped when SQLite is built without FTS5)"""
+    for fts_table, content_table, rowid_column, columns in SEARCH_INDEXES:
+        # The first column is the owner key: stored for filtering, not tokenized
+        fts_columns = ', '.join([f'{columns[0]} UNINDEXED'] + columns[1:])
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                    {fts_columns},
+                    content='{content_table}', content_rowid='{rowid_column}',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            logger.warning(f"⚠️ Full-text search unavailable ({e}); searches will use LIKE")
+            return
+        
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'NEW.{column}' for column in columns)
+        old_values = ', '.join(f'OLD.{column}' for column in columns)
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {content_table} BEGIN
+                INSERT INTO {fts_table} (rowid, {column_list}) VALUES (NEW.{rowid_column}, {new_values});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {content_table} BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', OLD.{rowid_column}, {old_values});
+            END
+        ''')
+        # Only re-index when an indexed column changes (status updates are frequent)
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF {column_list} ON {content_table} BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column_list}) VALUES ('delete', OLD.{rowid_column}, {old_values});
+                INSERT INTO {fts_table} (rowid, {column_list}) VALUES (NEW.{rowid_column}, {new_values});
+            END
+        ''')
+        cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+def _migration_008_invoice_list_index(cursor):
+    """Composite index shaped like the approved-document list queries
+
+    The listings filter user_id and status and order by created_at,
+    invoice_id; invoice_id is the rowid and so already the index's last key.
+    Every listing (typed or not, first page or keyset page) walks it in
+    order with no sort step and stops at the LIMIT; a document_type filter
+    is checked per row. Putting document_type before created_at would speed
+    up the quote list but make the untyped lists sort (see
+    scripts/bench_invoice_indexes.py). It supersedes idx_invoices_user_date
+    and idx_invoices_status.
+    """
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_invoices_user_status_created
+        ON invoices(user_id, status, created_at)
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_invoices_user_date')
+    cursor.execute('DROP INDEX IF EXISTS idx_invoices_status')
+
+def _import_legacy_premium_users(cursor, json_path='premium_users.json', txt_path='premium_users.txt'):
+    """Copy PremiumManager's old JSON store (or its text fallback) into premium_users"""
+    users = {}
+    try:
+        if os.path.exists(json_path):
+            with open(json_path, 'r', encoding='utf-8') as f:
+                users = json.load(f)
+        elif os.path.exists(txt_path):
+            with open(txt_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        parts = [part.strip() for part in line.split('|')]
+                        if parts[0].isdigit():
+                            users[parts[0]] = {
+                                'type': 'paid',
+                                'expires': None,
+                                'activated': parts[2] if len(parts) > 2 and parts[2] else None,
+                                'username': parts[1] if len(parts) > 1 else '',
+                                'features': ['all']
+                            }
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Could not import legacy premium users: {e}")
+        return
+
+    cursor.executemany('''
+        INSERT OR IGNORE INTO premium_users
+        (user_id, premium_type, username, activated, expires_at, features, months)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (int(user_id), data.get('type', 'paid'), data.get('username', ''), data.get('activated'),
+         data.get('expires') or None, json.dumps(data.get('features', [])), data.get('months'))
+        for user_id, data in users.items() if str(user_id).isdigit()
+    ])
+    if users:
+        logger.info(f"📦 Imported {len(users)} premium users from legacy files")
+
+def _migration_009_premium_users(cursor):
+    """Premium subscriptions in SQLite (was premium_users.json, rewritten on every change)
+
+    expires_at is a 'YYYY-MM-DD' date (last day of access) or NULL for no
+    expiry, so "active" and "expiring soon" are range scans on its index.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS premium_users (
+            user_id INTEGER PRIMARY KEY,
+            premium_type TEXT NOT NULL DEFAULT 'paid',
+            username TEXT,
+            activated TEXT,
+            expires_at TEXT,
+            features TEXT,
+            months INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_premium_users_expires ON premium_users(expires_at)')
+    _import_legacy_premium_users(cursor)
+
+def _migration_010_stripe_events(cursor):
+    """Verified Stripe webhook events, keyed by event ID so redeliveries are no-ops"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stripe_events_pending
+        ON stripe_events(received_at) WHERE status = 'pending'
+    ''')
+
+def _migration_011_telegram_files(cursor):
+    """Telegram file_id of every file the bot has uploaded, keyed by content hash"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            kind TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_012_invoice_items_quarantine(cursor):
+    """Blobs migration 004 could not parse were left in invoices.items; quarantine them"""
+    _move_invoice_item_blobs(cursor)
+
+# Each counted row stores the period it was counted in (usage_period, NULL when
+# it is not counted), so a release decrements that period even when it happens
+# in a later month. Approved documents and non-cancelled appointments count;
+# un-approving, cancelling or deleting releases, so approve -> draft -> approve
+# or cancel -> reinstate still counts once.
+USAGE_COUNTED_ROWS = [
+    # (table, key column, kind, counted-state condition on {row})
+    ('invoices', 'invoice_id', "COALESCE({row}document_type, 'invoice')", "{row}status IS 'approved'"),
+    ('appointments', 'appointment_id', "'appointment'", "{row}status IS NOT 'cancelled'"),
+]
+
+def _migration_013_usage_counter_releases(cursor):
+    """Release usage on un-approval, cancellation and delete; rebuild the counters"""
+    for trigger in ('trg_usage_appointment_created', 'trg_usage_document_inserted_approved',
+                    'trg_usage_document_approved'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    
+    for table, key, kind, counted in USAGE_COUNTED_ROWS:
+        _add_column_if_missing(cursor, table, 'usage_period', 'TEXT')
+        # Backfill like migration 006: counted rows land in their creation month
+        cursor.execute(f'''
+            UPDATE {table} SET usage_period = CASE WHEN {counted.format(row='')}
+                THEN strftime('%Y-%m', created_at, 'localtime') END
+        ''')
+    
+    cursor.execute('DELETE FROM usage_counters')
+    for table, key, kind, counted in USAGE_COUNTED_ROWS:
+        cursor.execute(f'''
+            INSERT INTO usage_counters (user_id, period, kind, count)
+            SELECT user_id, usage_period, {kind.format(row='')}, COUNT(*)
+            FROM {table} WHERE usage_period IS NOT NULL GROUP BY 1, 2, 3
+        ''')
+    
+    for table, key, kind, counted in USAGE_COUNTED_ROWS:
+        count = f'''
+            INSERT INTO usage_counters (user_id, period, kind, count)
+            VALUES (NEW.user_id, {USAGE_PERIOD_SQL}, {kind.format(row='NEW.')}, 1)
+            ON CONFLICT (user_id, period, kind) DO UPDATE SET count = count + 1;
+            UPDATE {table} SET usage_period = {USAGE_PERIOD_SQL} WHERE {key} = NEW.{key};
+        '''
+        release = f'''
+            UPDATE usage_counters SET count = count - 1
+            WHERE user_id = OLD.user_id AND period = OLD.usage_period
+            AND kind = {kind.format(row='OLD.')} AND count > 0;
+        '''
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_usage_{table}_counted_insert
+            AFTER INSERT ON {table} WHEN {counted.format(row='NEW.')}
+            BEGIN {count} END
+        ''')
+        # usage_period guards both ways: a row already counted is never counted
+        # again, and only a counted row is released
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_usage_{table}_counted_update
+            AFTER UPDATE OF status ON {table}
+            WHEN {counted.format(row='NEW.')} AND OLD.usage_period IS NULL
+            BEGIN {count} END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_usage_{table}_released_update
+            AFTER UPDATE OF status ON {table}
+            WHEN NOT ({counted.format(row='NEW.')}) AND OLD.usage_period IS NOT NULL
+            BEGIN {release} UPDATE {table} SET usage_period = NULL WHERE {key} = NEW.{key}; END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_usage_{table}_released_delete
+            AFTER DELETE ON {table} WHEN OLD.usage_period IS NOT NULL
+            BEGIN {release} END
+        ''')
+
+SCHEMA_MIGRATIONS = [
+    (1, 'initial_schema', _migration_001_initial_schema),
+    (2, 'invoice_document_type', _migration_002_invoice_document_type),
+    (3, 'user_reminder_settings', _migration_003_user_reminder_settings),
+    (4, 'invoice_items', _migration_004_invoice_items),
+    (5, 'appointment_end_time', _migration_005_appointment_end_time),
+    (6, 'usage_counters', _migration_006_usage_counters),
+    (7, 'search_index', _migration_007_search_index),
+    (8, 'invoice_list_index', _migration_008_invoice_list_index),
+    (9, 'premium_users', _migration_009_premium_users),
+    (10, 'stripe_events', _migration_010_stripe_events),
+    (11, 'telegram_files', _migration_011_telegram_files),
+    (12, 'invoice_items_quarantine', _migration_012_invoice_items_quarantine),
+    (13, 'usage_counter_releases', _migration_013_usage_counter_releases),
+]
+
+def get_schema_version(conn) -> int:
+    """Get the highest applied migration, or 0 for a fresh/legacy database"""
+    try:
+        row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    except sqlite3.OperationalError:
+        return 0  # schema_version table does not exist yet
+    return row[0] or 0
+
+def run_migrations() -> int:
+    """Apply pending schema migrations in order; returns the resulting version"""
+    latest = SCHEMA_MIGRATIONS[-1][0]
+    conn = get_db_connection()
+    try:
+        current = get_schema_version(conn)
+        if current >= latest:
+            logger.info(f"✅ Database schema is current (version {current})")
+            return current
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        for version, name, migrate in SCHEMA_MIGRATIONS:
+            # BEGIN IMMEDIATE takes the write lock, so a second process starting
+            # at the same time waits here and then sees the migration as applied
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if version <= get_schema_version(conn):
+                    conn.rollback()
+                    continue
+                cursor = conn.cursor()
+                migrate(cursor)
+                cursor.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+                conn.commit()
+                logger.info(f"🔧 Applied schema migration {version:03d}_{name}")
+            except Exception:
+                conn.rollback()
+                logger.error(f"❌ Schema migration {version:03d}_{name} failed")
+                raise
+        
+        return get_schema_version(conn)
+    finally:
+        conn.close()
+
+# ===== ROW RECORDS =====
+# Compact __slots__ records for users, clients, invoices and appointments.
+# record_factory() maps a result set's columns to record fields once per query,
+# so JOINed columns (client_name, company_name, ...) land on named fields no
+# matter where they appear in the SELECT. Records still index positionally in
+# table-column order, so call sites written against tuples keep working.
+
+def parse_db_datetime(value) -> Optional[datetime]:
+    """Parse a TIMESTAMP value stored by SQLite into a datetime"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        try:
+            return parser.parse(str(value))
+        except (ValueError, OverflowError):
+            return None
+
+def day_range(start_day, end_day=None, days: int = 1) -> Tuple[str, str]:
+    """Half-open [start, end) TIMESTAMP bounds covering whole days
+
+    Filter with `appointment_time >= ? AND appointment_time < ?` rather than
+    DATE(appointment_time) so the (user_id, appointment_time) index is used.
+    Accepts dates or datetimes (the time of day is ignored). end_day is
+    inclusive; without it the range covers `days` days from start_day.
+    """
+    if isinstance(start_day, datetime):
+        start_day = start_day.date()
+    if end_day is None:
+        end_day = start_day + timedelta(days=days)
+    else:
+        if isinstance(end_day, datetime):
+            end_day = end_day.date()
+        end_day = end_day + timedelta(days=1)
+    return start_day.strftime('%Y-%m-%d 00:00:00'), end_day.strftime('%Y-%m-%d 00:00:00')
+
+class Record:
+    """Base class for slotted row records"""
+    __slots__ = ()
+    _fields: Tuple[str, ...] = ()
+    _aliases: Dict[str, str] = {}
+
+    def __init__(self, *values, **named):
+        for name, value in zip(self._fields, values + (None,) * (len(self._fields) - len(values))):
+            setattr(self, name, value)
+        for name, value in named.items():
+            setattr(self, name, value)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(getattr(self, name) for name in self._fields[index])
+        return getattr(self, self._fields[index])
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self._fields)
+        return f"{type(self).__name__}({fields})"
+
+    def get(self, name: str, default=None):
+        """dict-style access with a default for missing/NULL fields"""
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Fields as a plain dict"""
+        return {name: getattr(self, name) for name in self._fields}
+
+class User(Record):
+    _fields = (
+        'user_id', 'username', 'first_name', 'last_name', 'join_date', 'trial_end_date',
+        'subscription_tier', 'logo_path', 'company_name', 'company_reg_number',
+        'vat_reg_number', 'trial_start_date', 'trial_used', 'email', 'phone', 'timezone',
+        'calendar_settings', 'reminder_settings', 'telegram_id'
+    )
+    __slots__ = _fields
+
+class Client(Record):
+    _fields = ('client_id', 'user_id', 'client_name', 'email', 'phone', 'address', 'created_at')
+    __slots__ = _fields
+
+class Invoice(Record):
+    """Invoice or quote row (document_type distinguishes them)"""
+    _fields = (
+        'invoice_id', 'user_id', 'invoice_number', 'client_name', 'invoice_date', 'currency',
+        'items', 'total_amount', 'vat_enabled', 'vat_amount', 'status', 'paid_status',
+        'client_email', 'client_phone', 'created_at', 'document_type'
+    )
+    __slots__ = _fields
+
+class Appointment(Record):
+    """Appointment row plus the client/owner columns the queries JOIN in"""
+    _fields = (
+        'appointment_id', 'user_id', 'client_id', 'title', 'description', 'appointment_time',
+        'duration_minutes', 'appointment_type', 'status', 'reminder_enabled', 'reminder_sent',
+        'reminder_minutes_before', 'created_at', 'updated_at', 'cancelled_at',
+        'cancellation_reason', 'notification_sent', 'recurrence_pattern', 'recurrence_end_date',
+        'end_time',
+        # Joined columns
+        'client_name', 'client_email', 'client_phone', 'client_address',
+        'company_name', 'business_email', 'username', 'telegram_id'
+    )
+    __slots__ = _fields
+    # Unaliased client columns (c.email, c.phone, c.address) in the JOINs
+    _aliases = {'email': 'client_email', 'phone': 'client_phone', 'address': 'client_address'}
+
+    @property
+    def starts_at(self) -> Optional[datetime]:
+        return parse_db_datetime(self.appointment_time)
+
+    @property
+    def ends_at(self) -> Optional[datetime]:
+        if self.end_time:
+            return parse_db_datetime(self.end_time)
+        start = self.starts_at
+        return start + timedelta(minutes=self.duration_minutes or 0) if start else None
+
+_record_factories: Dict[type, Any] = {}
+
+def record_factory(record_cls):
+    """Get the sqlite3 row_factory that builds record_cls instances
+
+    Usage:
+        cursor = conn.cursor()
+        cursor.row_factory = record_factory(Appointment)
+    """
+    factory = _record_factories.get(record_cls)
+    if factory is not None:
+        return factory
+    
+    fields = record_cls._fields
+    aliases = record_cls._aliases
+    # (cursor.description, field->column positions) for the last result set seen
+    plan_cache = [(None, ())]
+    
+    def factory(cursor, row):
+        description, positions = plan_cache[0]
+        if description is not cursor.description:
+            description = cursor.description
+            columns = {}
+            for index, column in enumerate(description):
+                name = aliases.get(column[0], column[0])
+                columns.setdefault(name, index)  # first occurrence wins (a.* before joins)
+            positions = tuple(columns.get(name) for name in fields)
+            plan_cache[0] = (description, positions)
+        return record_cls(*[None if index is None else row[index] for index in positions])
+    
+    _record_factories[record_cls] = factory
+    return factory
+
+# ===== INVOICE LINE ITEMS =====
+# Line items for invoices and quotes live in invoice_items (one row per item,
+# ordered by position). List queries never touch them; get_invoice/get_quote
+# attach them as the same list of {'description', 'quantity', 'amount'} dicts
+# the conversation flow builds in user_data.
+
+def _invoice_item_rows(invoice_id: int, items: List[Dict]) -> List[tuple]:
+    """Rows for invoice_items from conversation-style item dicts"""
+    return [
+        (invoice_id, position, item.get('description', ''), item.get('quantity', 0), item.get('amount', 0.0))
+        for position, item in enumerate(items)
+    ]
+
+def save_invoice_items(cursor, invoice_id: int, items: List[Dict]):
+    """Replace an invoice's line items (runs in the caller's transaction)"""
+    cursor.execute('DELETE FROM invoice_items WHERE invoice_id = ?', (invoice_id,))
+    cursor.executemany('''
+        INSERT INTO invoice_items (invoice_id, position, description, quantity, amount)
+        VALUES (?, ?, ?, ?, ?)
+    ''', _invoice_item_rows(invoice_id, items))
+
+def load_invoice_items(cursor, invoice_id: int) -> List[Dict]:
+    """Line items for one invoice/quote, in entry order"""
+    cursor.execute('''
+        SELECT description, quantity, amount FROM invoice_items
+        WHERE invoice_id = ? ORDER BY position
+    ''', (invoice_id,))
+    return [
+        {'description': description, 'quantity': quantity, 'amount': amount}
+        for description, quantity, amount in cursor.fetchall()
+    ]
+
+def get_invoice_items(invoice_id: int) -> List[Dict]:
+    """Get line items for an invoice/quote"""
+    conn = get_db_connection()
+    items = load_invoice_items(conn.cursor(), invoice_id)
+    conn.close()
+    return items
+
+def get_invoice_subtotal(invoice_id: int) -> float:
+    """Sum of quantity * amount over an invoice's line items"""
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute('''
+        SELECT COALESCE(SUM(quantity * amount), 0) FROM invoice_items WHERE invoice_id = ?
+    ''', (invoice_id,))
+    subtotal = cursor.fetchone()[0]
+    conn.close()
+    return subtotal
+
+def get_item_revenue(user_id: int, limit: Optional[int] = None, document_type: str = 'invoice',
+                     start_date=None, end_date=None) -> List[Dict]:
+    """Per-product revenue over approved documents, highest first
+
+    With a limit this is the user's top items.
+    """
+    query = '''
+        SELECT ii.description,
+               SUM(ii.quantity) AS quantity,
+               SUM(ii.quantity * ii.amount) AS revenue,
+               COUNT(DISTINCT ii.invoice_id) AS documents
+        FROM invoice_items ii
+        JOIN invoices i ON i.invoice_id = ii.invoice_id
+        WHERE i.user_id = ? AND i.status = 'approved' AND i.document_type = ?
+    '''
+    params = [user_id, document_type]
     
-    # Monday to Friday, 9am-5pm
-    for day in range(0, 5):  # 0=Monday, 4=Friday
-        cursor.execute('''
-            INSERT OR IGNORE INTO working_hours (user_id, day_ofweek, is_working_day, start_time, end_time)
-            VALUES (?, ?, TRUE, ?, ?)
-        ''', (user_id, day, "09:00", "17:00"))
+    if start_date:
+        if isinstance(start_date, datetime):
+            start_date = start_date.strftime('%Y-%m-%d %H:%M:%S')
+        query += ' AND i.created_at >= ?'
+        params.append(start_date)
     
-    # Saturday and Sunday - non-working days
-    for day in range(5, 7):
-        cursor.execute('''
-            INSERT OR IGNORE INTO working_hours (user_id, day_of_week, is_working_day)
-            VALUES (?, ?, FALSE)
-        ''', (user_id, day))
+    if end_date:
+        if isinstance(end_date, datetime):
+            end_date = end_date.strftime('%Y-%m-%d %H:%M:%S')
+        query += ' AND i.created_at < ?'
+        params.append(end_date)
     
-    conn.commit()
+    query += ' GROUP BY ii.description ORDER BY revenue DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    revenue = [
+        {'description': description, 'quantity': quantity, 'revenue': total, 'documents': documents}
+        for description, quantity, total, documents in cursor.fetchall()
+    ]
     conn.close()
+    return revenue
+
+# ===== SEARCH =====
+# Prefix search over clients and documents. Uses the FTS5 index from migration
+# 007 when it exists, otherwise falls back to LIKE scans.
+_search_index_available: Optional[bool] = None
+
+def search_index_available() -> bool:
+    """Whether the FTS5 search tables exist in this database"""
+    global _search_index_available
+    if _search_index_available is None:
+        conn = get_db_connection()
+        _search_index_available = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'clients_fts'"
+        ).fetchone() is not None
+        conn.close()
+    return _search_index_available
 
-def init_default_calendar_settings(user_id):
-    """Initialize default calendar settings for a user"""
-    conn = sqlite3.connect('invoices.db')
+def fts_match_query(text: str, column: Optional[str] = None) -> Optional[str]:
+    """Turn free text into an FTS5 prefix query: 'acme lt' -> '"acme"* "lt"*'
+
+    Returns None when the text has no searchable words.
+    """
+    terms = re.findall(r'\w+', text or '')
+    if not terms:
+        return None
+    query = ' '.join(f'"{term}"*' for term in terms)
+    return f'{{{column}}} : ({query})' if column else query
+
+def search_clients(user_id: int, text: str, limit: int = 10) -> List[Client]:
+    """Find a user's clients by name or email, best match first"""
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Client)
     
-    cursor.execute('''
-        INSERT OR IGNORE INTO calendar_settings 
-        (user_id, default_view, first_day_of_week, slot_duration, show_weekends, send_email_notifications, send_telegram_notifications)
-        VALUES (?, 'week', 1, 30, TRUE, TRUE, TRUE)
-    ''', (user_id,))
+    match = fts_match_query(text)
+    if search_index_available() and match:
+        cursor.execute('''
+            SELECT c.* FROM clients_fts f
+            JOIN clients c ON c.client_id = f.rowid
+            WHERE clients_fts MATCH ? AND f.user_id = ?
+            ORDER BY f.rank
+            LIMIT ?
+        ''', (match, user_id, limit))
+    else:
+        pattern = f'%{text}%'
+        cursor.execute('''
+            SELECT * FROM clients
+            WHERE user_id = ? AND (client_name LIKE ? OR email LIKE ?)
+            ORDER BY client_name
+            LIMIT ?
+        ''', (user_id, pattern, pattern, limit))
     
-    conn.commit()
+    clients = cursor.fetchall()
     conn.close()
+    return clients
 
-def init_default_email_templates(user_id):
-    """Initialize default email templates for a user"""
-    conn = sqlite3.connect('invoices.db')
+def search_documents(user_id: int, text: str, document_type: Optional[str] = None,
+                     status: Optional[str] = 'approved', limit: int = 10) -> List[Invoice]:
+    """Find invoices/quotes by number, client name/email or line-item description
+
+    Newest first. Items are not loaded (use get_invoice for those).
+    """
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Invoice)
+    
+    match = fts_match_query(text)
+    if search_index_available() and match:
+        query = '''
+            SELECT i.* FROM invoices i
+            WHERE i.invoice_id IN (
+                SELECT f.rowid FROM invoices_fts f
+                WHERE invoices_fts MATCH ? AND f.user_id = ?
+                UNION
+                SELECT ii.invoice_id FROM invoice_items_fts f
+                JOIN invoice_items ii ON ii.item_id = f.rowid
+                JOIN invoices owner ON owner.invoice_id = ii.invoice_id
+                WHERE invoice_items_fts MATCH ? AND owner.user_id = ?
+            )
+            AND i.user_id = ?
+        '''
+        params = [match, user_id, match, user_id, user_id]
+    else:
+        pattern = f'%{text}%'
+        query = '''
+            SELECT i.* FROM invoices i
+            WHERE i.user_id = ?
+            AND (i.invoice_number LIKE ? OR i.client_name LIKE ? OR i.client_email LIKE ?
+                 OR EXISTS (SELECT 1 FROM invoice_items ii
+                            WHERE ii.invoice_id = i.invoice_id AND ii.description LIKE ?))
+        '''
+        params = [user_id, pattern, pattern, pattern, pattern]
+    
+    if document_type:
+        query += ' AND i.document_type = ?'
+        params.append(document_type)
+    
+    if status:
+        query += ' AND i.status = ?'
+        params.append(status)
     
-    templates = [
-        ("Appointment Confirmation", "Appointment Confirmation - {title}",
-         """Dear {client_name},
+    query += ' ORDER BY i.created_at DESC, i.invoice_id DESC LIMIT ?'
+    params.append(limit)
+    
+    cursor.execute(query, params)
+    documents = cursor.fetchall()
+    conn.close()
+    return documents
+
+def invoice_client_condition(client_name: str, user_id: int) -> Tuple[str, list]:
+    """WHERE fragment + params matching a user's invoices/quotes by client name
+
+    The FTS subquery filters on the index's stored user_id, so it only
+    returns this user's matches rather than every tenant's.
+    """
+    match = fts_match_query(client_name, 'client_name')
+    if search_index_available() and match:
+        return ('invoice_id IN (SELECT rowid FROM invoices_fts WHERE invoices_fts MATCH ? AND user_id = ?)',
+                [match, user_id])
+    return 'client_name LIKE ?', [f'%{client_name}%']
+
+def client_name_condition(client_name: str, user_id: int, alias: str = 'c') -> Tuple[str, list]:
+    """WHERE fragment + params matching a joined clients table by a user's client name"""
+    match = fts_match_query(client_name, 'client_name')
+    if search_index_available() and match:
+        return (f'{alias}.client_id IN (SELECT rowid FROM clients_fts WHERE clients_fts MATCH ? AND user_id = ?)',
+                [match, user_id])
+    return f'{alias}.client_name LIKE ?', [f'%{client_name}%']
+
+# ===== DATABASE INITIALIZATION =====
+def init_db():
+    """Initialize database by applying any pending schema migrations"""
+    version = run_migrations()
+    logger.info(f"✅ Database initialization complete (schema version {version})")
+
+# ===== INITIALIZE DATABASE =====
+init_db()
+log_db_settings()
+
+# ===== DEFAULT SETTINGS HELPER FUNCTIONS =====
+# New-user defaults are prebuilt rows written with executemany on the caller's
+# cursor, so create_user onboards a user in a single transaction.
+
+# (day_of_week, is_working_day, start_time, end_time): Monday-Friday 9am-5pm
+DEFAULT_WORKING_HOURS = [(day, True, "09:00", "17:00") for day in range(0, 5)] + \
+                        [(day, False, None, None) for day in range(5, 7)]
+
+DEFAULT_EMAIL_TEMPLATES = [
+    ("Appointment Confirmation", "Appointment Confirmation - {title}",
+     """Dear {client_name},
 
 Your appointment has been confirmed.
 
@@ -619,9 +1673,9 @@ Please arrive on time. If you need to reschedule or cancel, please do so at leas
 
 Best regards,
 {company_name}"""),
-        
-        ("Appointment Reminder", "Reminder: Your Appointment Tomorrow",
-         """Dear {client_name},
+    
+    ("Appointment Reminder", "Reminder: Your Appointment Tomorrow",
+     """Dear {client_name},
 
 This is a friendly reminder about your appointment tomorrow.
 
@@ -634,9 +1688,9 @@ Please don't hesitate to contact us if you have any questions.
 
 Best regards,
 {company_name}"""),
-        
-        ("Appointment Cancellation", "Appointment Cancelled - {title}",
-         """Dear {client_name},
+    
+    ("Appointment Cancellation", "Appointment Cancelled - {title}",
+     """Dear {client_name},
 
 Your appointment has been cancelled as requested.
 
@@ -649,56 +1703,73 @@ To reschedule, please use our booking system or contact us directly.
 
 Best regards,
 {company_name}""")
-    ]
-    
-    for i, (name, subject, body) in enumerate(templates):
-        cursor.execute('''
-            INSERT OR IGNORE INTO email_templates (user_id, template_name, subject, body, is_default)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, name, subject, body, i == 0))  # First one is default
-    
-    conn.commit()
-    conn.close()
+]
 
-def init_default_buffer_times(user_id):
-    """Initialize default buffer times for a user"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
+def init_default_working_hours(cursor, user_id):
+    """Initialize default working hours for a user"""
+    cursor.executemany('''
+        INSERT OR IGNORE INTO working_hours (user_id, day_of_week, is_working_day, start_time, end_time)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(user_id, *row) for row in DEFAULT_WORKING_HOURS])
+
+def init_default_calendar_settings(cursor, user_id):
+    """Initialize default calendar settings for a user"""
     cursor.execute('''
-        INSERT OR IGNORE INTO buffer_times (user_id, before_appointment, after_appointment, same_day_buffer)
-        VALUES (?, 15, 15, 60)
+        INSERT OR IGNORE INTO calendar_settings 
+        (user_id, default_view, first_day_of_week, slot_duration, show_weekends, send_email_notifications, send_telegram_notifications)
+        VALUES (?, 'week', 1, 30, TRUE, TRUE, TRUE)
     ''', (user_id,))
-    
-    conn.commit()
-    conn.close()
 
-def init_default_appointment_types(user_id):
+def init_default_email_templates(cursor, user_id):
+    """Initialize default email templates for a user"""
+    # email_templates has no unique key, so skip templates the user already has
+    cursor.executemany('''
+        INSERT INTO email_templates (user_id, template_name, subject, body, is_default)
+        SELECT ?, ?, ?, ?, ?
+        WHERE NOT EXISTS (SELECT 1 FROM email_templates WHERE user_id = ? AND template_name = ?)
+    ''', [
+        (user_id, name, subject, body, i == 0, user_id, name)  # First one is default
+        for i, (name, subject, body) in enumerate(DEFAULT_EMAIL_TEMPLATES)
+    ])
+
+def init_default_buffer_times(cursor, user_id):
+    """Initialize default buffer times for a user"""
+    cursor.execute('''
+        INSERT INTO buffer_times (user_id, before_appointment, after_appointment, same_day_buffer)
+        SELECT ?, 15, 15, 60
+        WHERE NOT EXISTS (SELECT 1 FROM buffer_times WHERE user_id = ?)
+    ''', (user_id, user_id))
+
+def init_default_appointment_types(cursor, user_id):
     """Initialize default appointment types for a user"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
     # Copy default types to user's appointment_types
     cursor.execute('''
         INSERT OR IGNORE INTO appointment_types (user_id, type_name, duration_minutes, description, color_hex)
         SELECT ?, type_name, duration_minutes, description, color_hex
         FROM default_appointment_types
-        WHERE NOT EXISTS (
-            SELECT 1 FROM appointment_types WHERE user_id = ? AND type_name = default_appointment_types.type_name
-        )
-    ''', (user_id, user_id))
-    
-    conn.commit()
-    conn.close()
+    ''', (user_id,))
 
-def initialize_user_defaults(user_id):
-    """Initialize all default settings for a new user"""
-    init_default_working_hours(user_id)
-    init_default_calendar_settings(user_id)
-    init_default_email_templates(user_id)
-    init_default_buffer_times(user_id)
-    init_default_appointment_types(user_id)
-    logger.info(f"✅ Default settings initialized for user {user_id}")
+def initialize_user_defaults(user_id, cursor=None):
+    """Initialize all default settings for a new user
+
+    Pass a cursor to write the defaults inside the caller's transaction;
+    otherwise they are committed together on their own connection.
+    """
+    conn = None
+    if cursor is None:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+    
+    init_default_working_hours(cursor, user_id)
+    init_default_calendar_settings(cursor, user_id)
+    init_default_email_templates(cursor, user_id)
+    init_default_buffer_times(cursor, user_id)
+    init_default_appointment_types(cursor, user_id)
+    
+    if conn is not None:
+        conn.commit()
+        conn.close()
+        logger.info(f"✅ Default settings initialized for user {user_id}")
 
 # ===== BOT COMMANDS SETUP =====
 async def setup_bot_commands(application):  
@@ -868,18 +1939,16 @@ def parse_trial_end_date(trial_end_date_str):
         return datetime.now()
 
 # ===== USER MANAGEMENT =====
-def get_user(user_id: int) -> Optional[tuple]:
+def get_user(user_id: int) -> Optional[User]:
     """Get user by ID"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = record_factory(User)
+        return cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
 
 def create_user(user_id: int, username: str, first_name: str, last_name: str):
     """Create a new user with trial period and initialize scheduling defaults"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     trial_end_date = datetime.now() + timedelta(days=14)
@@ -891,15 +1960,17 @@ def create_user(user_id: int, username: str, first_name: str, last_name: str):
         VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, TRUE)
     ''', (user_id, username, first_name, last_name, trial_end_date_str))
     
+    # Scheduling defaults go in the same transaction: one commit per new user
+    initialize_user_defaults(user_id, cursor)
+    
     conn.commit()
     conn.close()
-    
-    # Initialize scheduling defaults for new user
-    initialize_user_defaults(user_id)
+    entitlements.invalidate(user_id)
+    logger.info(f"✅ User {user_id} created with default settings")
 
 def update_user_company_info(user_id: int, logo_path=None, company_name=None, company_reg=None, vat_reg=None):
     """Update user's company information"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     updates = []
@@ -926,92 +1997,100 @@ def update_user_company_info(user_id: int, logo_path=None, company_name=None, co
     
     conn.commit()
     conn.close()
+    if updates:
+        pdf_cache.invalidate_user(user_id)
 
 # ===== INVOICE COUNTER FUNCTIONS =====
-def get_invoice_counter(user_id: int) -> int:
-    """Get current invoice counter for user"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT current_counter FROM invoice_counters WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    
-    if not result:
-        cursor.execute('INSERT INTO invoice_counters (user_id, current_counter) VALUES (?, ?)', (user_id, 1))
-        conn.commit()
-        counter = 1
-    else:
-        counter = result[0]
-    
-    conn.close()
+# invoice_counters.current_counter is the next number to hand out. Invoices and
+# quotes share the sequence. Numbers come from a single atomic upsert, so two
+# concurrent /create or /quote flows can never be given the same number.
+# Set INVOICE_NUMBER_BLOCK > 1 in multi-worker deployments to reserve numbers
+# per process in blocks. Unused numbers in a block are lost when the process
+# exits, which leaves gaps in the sequence.
+INVOICE_NUMBER_BLOCK = max(1, int(os.getenv('INVOICE_NUMBER_BLOCK', '1')))
+_RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+_invoice_number_blocks: Dict[int, List[int]] = {}  # user_id -> [next, end)
+_invoice_number_lock = threading.Lock()
+
+def reserve_invoice_counters(user_id: int, count: int = 1) -> int:
+    """Atomically reserve `count` consecutive counters; returns the first"""
+    with db_connection() as conn:
+        if _RETURNING_SUPPORTED:
+            next_counter = conn.execute('''
+                INSERT INTO invoice_counters (user_id, current_counter) VALUES (?, 1 + ?)
+                ON CONFLICT (user_id) DO UPDATE SET current_counter = current_counter + ?
+                RETURNING current_counter
+            ''', (user_id, count, count)).fetchone()[0]
+        else:
+            # Older SQLite: hold the write lock across the bump and the read-back
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR IGNORE INTO invoice_counters (user_id, current_counter) VALUES (?, 1)', (user_id,))
+            conn.execute('UPDATE invoice_counters SET current_counter = current_counter + ? WHERE user_id = ?', (count, user_id))
+            next_counter = conn.execute('SELECT current_counter FROM invoice_counters WHERE user_id = ?', (user_id,)).fetchone()[0]
+    return next_counter - count
+
+def next_invoice_counter(user_id: int) -> int:
+    """Take the next invoice/quote counter, from this process's block if enabled"""
+    if INVOICE_NUMBER_BLOCK == 1:
+        return reserve_invoice_counters(user_id)
+    
+    with _invoice_number_lock:
+        block = _invoice_number_blocks.get(user_id)
+        if not block or block[0] >= block[1]:
+            first = reserve_invoice_counters(user_id, INVOICE_NUMBER_BLOCK)
+            block = _invoice_number_blocks[user_id] = [first, first + INVOICE_NUMBER_BLOCK]
+        counter = block[0]
+        block[0] += 1
     return counter
 
-def increment_invoice_counter(user_id: int):
-    """Increment invoice counter for user"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE invoice_counters SET current_counter = current_counter + 1 WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
-
 # ===== INVOICE FUNCTIONS =====
 def generate_invoice_number(user_id: int) -> str:
     """Generate unique invoice number"""
-    counter = get_invoice_counter(user_id)
+    counter = next_invoice_counter(user_id)
     now = datetime.now()
-    invoice_number = f"INV-{now.year}-{now.month:02d}-{counter:04d}"
-    increment_invoice_counter(user_id)
-    return invoice_number
+    return f"INV-{now.year}-{now.month:02d}-{counter:04d}"
 
 def save_invoice_draft(user_id: int, client_name: str, invoice_date: str, currency: str, 
                       items: List[Dict], vat_enabled=False, client_email=None, client_phone=None):
     """Save invoice draft to database"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Convert items to JSON
-    items_json = json.dumps(items)
-    
     # Calculate totals
     subtotal = sum(item['quantity'] * item['amount'] for item in items)
     vat_amount = subtotal * 0.2 if vat_enabled else 0
     total_amount = subtotal + vat_amount
     
     cursor.execute('''
-        INSERT INTO invoices (user_id, client_name, invoice_date, currency, items, 
+        INSERT INTO invoices (user_id, client_name, invoice_date, currency, 
                             total_amount, vat_enabled, vat_amount, client_email, client_phone, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'draft')
-    ''', (user_id, client_name, invoice_date, currency, items_json, total_amount, 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'draft')
+    ''', (user_id, client_name, invoice_date, currency, total_amount, 
           vat_enabled, vat_amount, client_email, client_phone))
     
     invoice_id = cursor.lastrowid
+    save_invoice_items(cursor, invoice_id, items)
     conn.commit()
     conn.close()
     
     logger.info(f"Invoice draft saved: ID={invoice_id}, User={user_id}")
     return invoice_id
 
-def get_invoice(invoice_id: int) -> Optional[tuple]:
+def get_invoice(invoice_id: int) -> Optional[Invoice]:
     """Get invoice by ID"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Invoice)
     cursor.execute('SELECT * FROM invoices WHERE invoice_id = ?', (invoice_id,))
     invoice = cursor.fetchone()
+    if invoice:
+        invoice.items = load_invoice_items(conn.cursor(), invoice_id)
     conn.close()
-    
-    if invoice and len(invoice) > 5 and invoice[5]:  # items column
-        try:
-            # Parse JSON items
-            invoice_list = list(invoice)
-            invoice_list[5] = json.loads(invoice[5]) if isinstance(invoice[5], str) else invoice[5]
-            invoice = tuple(invoice_list)
-        except json.JSONDecodeError:
-            logger.warning(f"Failed to parse items JSON for invoice {invoice_id}")
-    
     return invoice
 
 def update_invoice_status(invoice_id: int, status: str, invoice_number=None):
     """Update invoice status and optionally assign invoice number"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     if invoice_number:
@@ -1025,18 +2104,21 @@ def update_invoice_status(invoice_id: int, status: str, invoice_number=None):
     
     conn.commit()
     conn.close()
+    pdf_cache.invalidate_document(invoice_id)
 
-def get_user_invoices(user_id: int, client_name=None) -> List[tuple]:
+def get_user_invoices(user_id: int, client_name=None) -> List[Invoice]:
     """Get user's approved invoices"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Invoice)
     
     if client_name:
-        cursor.execute('''
+        condition, params = invoice_client_condition(client_name, user_id)
+        cursor.execute(f'''
             SELECT * FROM invoices 
-            WHERE user_id = ? AND client_name LIKE ? AND status = 'approved'
+            WHERE user_id = ? AND {condition} AND status = 'approved'
             ORDER BY created_at DESC
-        ''', (user_id, f'%{client_name}%'))
+        ''', (user_id, *params))
     else:
         cursor.execute('''
             SELECT * FROM invoices 
@@ -1046,43 +2128,86 @@ def get_user_invoices(user_id: int, client_name=None) -> List[tuple]:
     
     invoices = cursor.fetchall()
     conn.close()
+    return invoices
+
+DOCUMENT_PAGE_SIZE = 10  # documents per /myinvoices or /myquotes page
+
+def encode_page_cursor(document: Invoice) -> str:
+    """Keyset cursor for the page after this document (fits in callback_data)"""
+    return f"{document.created_at}|{document.invoice_id}"
+
+def decode_page_cursor(token: str) -> Optional[Tuple[str, int]]:
+    """Inverse of encode_page_cursor; None for a malformed token"""
+    created_at, _, invoice_id = (token or '').rpartition('|')
+    if not created_at or not invoice_id.isdigit():
+        return None
+    return created_at, int(invoice_id)
+
+def get_document_page(user_id: int, document_type: Optional[str] = None, client_name=None,
+                      after: Optional[Tuple[str, int]] = None,
+                      limit: int = DOCUMENT_PAGE_SIZE) -> Tuple[List[Invoice], Optional[str]]:
+    """One page of approved documents, newest first, and the cursor for the next page
+
+    Keyset pagination on (created_at, invoice_id): each page reads at most
+    limit + 1 rows however many documents the user has. The next cursor is
+    None on the last page.
+    """
+    query = "SELECT * FROM invoices WHERE user_id = ? AND status = 'approved'"
+    params: List[Any] = [user_id]
     
-    # Parse JSON items for each invoice
-    parsed_invoices = []
-    for invoice in invoices:
-        if len(invoice) > 5 and invoice[5]:
-            try:
-                invoice_list = list(invoice)
-                invoice_list[5] = json.loads(invoice[5]) if isinstance(invoice[5], str) else invoice[5]
-                parsed_invoices.append(tuple(invoice_list))
-            except json.JSONDecodeError:
-                parsed_invoices.append(invoice)
-        else:
-            parsed_invoices.append(invoice)
+    if document_type:
+        query += ' AND document_type = ?'
+        params.append(document_type)
     
-    return parsed_invoices
-
-def get_user_invoice_count_this_month(user_id: int) -> int:
-    """Count user's approved invoices for current month"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
+    if client_name:
+        condition, condition_params = invoice_client_condition(client_name, user_id)
+        query += f' AND {condition}'
+        params.extend(condition_params)
     
-    first_day_of_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    first_day_str = first_day_of_month.strftime('%Y-%m-%d %H:%M:%S')
+    if after:
+        query += ' AND (created_at, invoice_id) < (?, ?)'
+        params.extend(after)
     
-    cursor.execute('''
-        SELECT COUNT(*) FROM invoices 
-        WHERE user_id = ? AND status = 'approved' AND created_at >= ?
-    ''', (user_id, first_day_str))
+    query += ' ORDER BY created_at DESC, invoice_id DESC LIMIT ?'
+    params.append(limit + 1)
     
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.row_factory = record_factory(Invoice)
+    cursor.execute(query, params)
+    documents = cursor.fetchall()
+    conn.close()
+    
+    if len(documents) > limit:
+        documents = documents[:limit]
+        return documents, encode_page_cursor(documents[-1])
+    return documents, None
+
+def get_monthly_usage(user_id: int, *kinds: str) -> int:
+    """This month's usage of the given kinds ('invoice', 'quote', 'appointment')
+
+    Reads the trigger-maintained usage_counters table: a primary-key lookup
+    instead of a COUNT(*) over invoices/appointments.
+    """
+    placeholders = ', '.join('?' * len(kinds))
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(count), 0) FROM usage_counters
+        WHERE user_id = ? AND period = ? AND kind IN ({placeholders})
+    ''', (user_id, datetime.now().strftime('%Y-%m'), *kinds))
     count = cursor.fetchone()[0]
     conn.close()
     return count
 
+def get_user_invoice_count_this_month(user_id: int) -> int:
+    """Count user's approved invoices for current month"""
+    return get_monthly_usage(user_id, 'invoice')
+
 # ===== CLIENT FUNCTIONS =====
 def save_client(user_id: int, client_name: str, email=None, phone=None, address=None) -> int:
     """Save new client"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -1095,74 +2220,192 @@ def save_client(user_id: int, client_name: str, email=None, phone=None, address=
     conn.close()
     return client_id
 
-def get_user_clients(user_id: int) -> List[tuple]:
+def get_user_clients(user_id: int) -> List[Client]:
     """Get all clients for a user"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Client)
     cursor.execute('SELECT * FROM clients WHERE user_id = ? ORDER BY client_name', (user_id,))
     clients = cursor.fetchall()
     conn.close()
     return clients
 
-def get_client_by_id(client_id: int) -> Optional[tuple]:
+def get_client_by_id(client_id: int) -> Optional[Client]:
     """Get client by ID"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Client)
     cursor.execute('SELECT * FROM clients WHERE client_id = ?', (client_id,))
     client = cursor.fetchone()
     conn.close()
     return client
 
-def get_client_by_name(user_id: int, client_name: str) -> Optional[tuple]:
+def get_client_by_name(user_id: int, client_name: str) -> Optional[Client]:
     """Get client by name for specific user"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Client)
     cursor.execute('SELECT * FROM clients WHERE user_id = ? AND client_name = ?', (user_id, client_name))
     client = cursor.fetchone()
     conn.close()
     return client
 
 # ===== PREMIUM & TRIAL FUNCTIONS =====
-def is_premium_user(user_id: int) -> bool:
-    """Check if user has premium access or active trial"""
-    # Check premium manager first
-    try:
-        from premium_manager import premium_manager as pm
-        if pm.is_premium(user_id):
-            return True
-    except ImportError:
-        pass
-    
-    # Check database trial
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT trial_end_date, trial_used FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        return False
-    
-    trial_end_date, trial_used = result
-    
-    # If user never started trial, they get one
-    if not trial_used:
-        return True
-    
-    # Check if trial has expired
-    if trial_end_date:
-        trial_end = parse_trial_end_date(trial_end_date)
-        if datetime.now() <= trial_end:
-            return True
+# Every tier check goes through `entitlements`. A user's tier is resolved from
+# premium_manager and the users table once, then served from memory for
+# ENTITLEMENT_CACHE_TTL seconds (never past the tier's own expiry). Anything
+# that changes a subscription must call entitlements.invalidate(user_id).
+ENTITLEMENT_CACHE_TTL = float(os.getenv('ENTITLEMENT_CACHE_TTL', '300'))
+
+class EntitlementService:
+    """Cached tier resolver behind is_premium_user and get_user_tier_enhanced"""
+    
+    def __init__(self, ttl: float = ENTITLEMENT_CACHE_TTL):
+        self.ttl = ttl
+        self._cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}  # user_id -> (valid_until, tier)
+        self._generation = 0  # bumped by invalidate() so in-flight lookups don't cache stale tiers
+        self._lock = threading.Lock()
+    
+    def get(self, user_id) -> Dict[str, Any]:
+        """Tier dict for a user: 'name' is 'premium', 'trial' or 'free' (treat as read-only)"""
+        user_id = int(user_id)
+        return self.get_many([user_id])[user_id]
+    
+    def get_many(self, user_ids) -> Dict[int, Dict[str, Any]]:
+        """Tier dicts for several users; all cache misses are resolved in one query"""
+        user_ids = {int(user_id) for user_id in user_ids}
+        tiers = {}
+        with self._lock:
+            now = time.monotonic()
+            for user_id in user_ids:
+                cached = self._cache.get(user_id)
+                if cached and cached[0] > now:
+                    tiers[user_id] = cached[1]
+            generation = self._generation
+        
+        missing = user_ids - tiers.keys()
+        if missing:
+            resolved = self._resolve(missing)
+            with self._lock:
+                if generation == self._generation:
+                    self._cache.update(resolved)
+            tiers.update((user_id, tier) for user_id, (_, tier) in resolved.items())
+        return tiers
+    
+    def is_premium(self, user_id) -> bool:
+        """Premium subscription or active trial"""
+        return self.get(user_id)['name'] != 'free'
+    
+    def invalidate(self, user_id=None):
+        """Forget a user's cached tier (or everyone's when user_id is None)"""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(int(user_id), None)
     
-    return False
+    def _resolve(self, user_ids) -> Dict[int, Tuple[float, Dict[str, Any]]]:
+        user_ids = list(user_ids)
+        rows = {}
+        premium_rows = {}
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        for start in range(0, len(user_ids), 500):  # stay under SQLite's parameter limit
+            chunk = user_ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(f'''
+                SELECT user_id, subscription_tier, trial_end_date, trial_used
+                FROM users WHERE user_id IN ({placeholders})
+            ''', chunk)
+            rows.update((row[0], row[1:]) for row in cursor.fetchall())
+            cursor.execute(f'''
+                SELECT user_id, premium_type, expires_at, features
+                FROM premium_users WHERE user_id IN ({placeholders})
+            ''', chunk)
+            premium_rows.update((row[0], row[1:]) for row in cursor.fetchall())
+        conn.close()
+        
+        now = datetime.now()
+        valid_until = time.monotonic() + self.ttl
+        resolved = {}
+        for user_id in user_ids:
+            tier, expires_at = self._tier(rows.get(user_id), premium_rows.get(user_id), now)
+            deadline = valid_until
+            if expires_at:
+                deadline = min(deadline, time.monotonic() + max(0.0, (expires_at - now).total_seconds()))
+            resolved[user_id] = (deadline, tier)
+        return resolved
+    
+    @staticmethod
+    def _tier(row, premium_row, now) -> Tuple[Dict[str, Any], Optional[datetime]]:
+        """(tier, moment it stops applying) from a users row and a premium_users row
+
+        users.subscription_tier only counts for users without a premium_users
+        row; once a subscription row exists its expires_at is authoritative.
+        """
+        if premium_row:
+            premium_type, expires, features = premium_row
+            expires_at = None
+            if expires:
+                try:
+                    expires_at = datetime.strptime(expires, '%Y-%m-%d') + timedelta(days=1)
+                except ValueError:
+                    pass
+            if expires_at is None or now < expires_at:
+                return {
+                    'name': 'premium',
+                    'type': premium_type or 'premium',
+                    'expires': expires or 'Never',
+                    'features': json.loads(features) if features else [],
+                    'unlimited': True
+                }, expires_at
+        
+        if row:
+            subscription_tier, trial_end_date, trial_used = row
+            if trial_end_date and trial_used:
+                trial_end = parse_trial_end_date(trial_end_date)
+                if now <= trial_end:
+                    return {
+                        'name': 'trial',
+                        'expires': trial_end.strftime('%Y-%m-%d'),
+                        'days_left': (trial_end - now).days,
+                        'features': TIER_LIMITS['free']['features'] + ['trial_features'],
+                        'unlimited': True  # Trial users get unlimited access
+                    }, trial_end
+            
+            if subscription_tier == 'premium' and not premium_row:
+                return {
+                    'name': 'premium',
+                    'type': 'premium',
+                    'expires': 'Never',
+                    'features': TIER_LIMITS['premium']['features'],
+                    'unlimited': True
+                }, None
+        
+        return {
+            'name': 'free',
+            'limits': {
+                'invoices': TIER_LIMITS['free']['monthly_invoices'],
+                'appointments': TIER_LIMITS['free']['max_appointments'],
+                'clients': TIER_LIMITS['free']['max_clients']
+            },
+            'features': TIER_LIMITS['free']['features'],
+            'unlimited': False
+        }, None
+
+entitlements = EntitlementService()
+
+def is_premium_user(user_id: int) -> bool:
+    """Check if user has premium access or active trial"""
+    return entitlements.is_premium(user_id)
 
 # ===== APPOINTMENT FUNCTIONS (FIXED - NO DUPLICATES) =====
 def create_appointment(user_id: int, client_id: int, title: str, appointment_date, 
                       duration_minutes=60, appointment_type='meeting', description='', 
                       status='scheduled', reminder_minutes_before=30) -> int:
     """Create a new appointment"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # Convert appointment_date to string if datetime
@@ -1184,19 +2427,21 @@ def create_appointment(user_id: int, client_id: int, title: str, appointment_dat
     conn.close()
     return appointment_id
 
-def get_appointment_by_id(appointment_id: int) -> Optional[tuple]:
+def get_appointment_by_id(appointment_id: int) -> Optional[Appointment]:
     """Get appointment by ID"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     cursor.execute('SELECT * FROM appointments WHERE appointment_id = ?', (appointment_id,))
     appointment = cursor.fetchone()
     conn.close()
     return appointment
 
-def get_user_appointments(user_id: int, start_date=None, end_date=None, status='scheduled') -> List[tuple]:
+def get_user_appointments(user_id: int, start_date=None, end_date=None, status='scheduled') -> List[Appointment]:
     """Get appointments for a user within date range"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     
     query = '''
         SELECT a.*, c.client_name, c.email as client_email, c.phone as client_phone
@@ -1232,7 +2477,7 @@ def get_today_appointments(user_id: int) -> List[tuple]:
 
 def cancel_appointment(appointment_id: int, reason="") -> bool:
     """Cancel an appointment"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -1248,7 +2493,7 @@ def cancel_appointment(appointment_id: int, reason="") -> bool:
 # ===== APPOINTMENT TYPE FUNCTIONS =====
 def get_appointment_types(user_id: int) -> List[tuple]:
     """Get appointment types for a user"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # Check custom types first
@@ -1284,18 +2529,16 @@ def get_appointment_types(user_id: int) -> List[tuple]:
 # ===== WORKING HOURS FUNCTIONS =====
 def get_working_hours(user_id: int) -> List[tuple]:
     """Get working hours for a user"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM working_hours 
-        WHERE user_id = ? 
-        ORDER BY day_of_week
-    ''', (user_id,))
-    hours = cursor.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        hours = conn.execute('''
+            SELECT * FROM working_hours 
+            WHERE user_id = ? 
+            ORDER BY day_of_week
+        ''', (user_id,)).fetchall()
     
     if not hours:
-        init_default_working_hours(user_id)
+        with db_connection() as conn:
+            init_default_working_hours(conn.cursor(), user_id)
         return get_working_hours(user_id)
     
     return hours
@@ -1303,14 +2546,12 @@ def get_working_hours(user_id: int) -> List[tuple]:
 # ===== CALENDAR SETTINGS FUNCTIONS =====
 def get_calendar_settings(user_id: int) -> Optional[tuple]:
     """Get calendar settings for a user"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM calendar_settings WHERE user_id = ?', (user_id,))
-    settings = cursor.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        settings = conn.execute('SELECT * FROM calendar_settings WHERE user_id = ?', (user_id,)).fetchone()
     
     if not settings:
-        init_default_calendar_settings(user_id)
+        with db_connection() as conn:
+            init_default_calendar_settings(conn.cursor(), user_id)
         return get_calendar_settings(user_id)
     
     return settings
@@ -1318,44 +2559,44 @@ def get_calendar_settings(user_id: int) -> Optional[tuple]:
 # ===== QUOTE FUNCTIONS =====
 def generate_quote_number(user_id: int) -> str:
     """Generate unique quote number"""
-    counter = get_invoice_counter(user_id)
+    counter = next_invoice_counter(user_id)
     now = datetime.now()
-    quote_number = f"QUO-{now.year}-{now.month:02d}-{counter:04d}"
-    increment_invoice_counter(user_id)
-    return quote_number
+    return f"QUO-{now.year}-{now.month:02d}-{counter:04d}"
 
 def save_quote_draft(user_id: int, client_name: str, quote_date: str, currency: str, 
                     items: List[Dict], client_email=None, client_phone=None) -> int:
     """Save quote draft to database"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
-    items_json = json.dumps(items)
     total_amount = sum(item['quantity'] * item['amount'] for item in items)
     
     cursor.execute('''
-        INSERT INTO invoices (user_id, client_name, invoice_date, currency, items, 
+        INSERT INTO invoices (user_id, client_name, invoice_date, currency, 
                             total_amount, status, client_email, client_phone, document_type)
-        VALUES (?, ?, ?, ?, ?, ?, 'draft', ?, ?, 'quote')
-    ''', (user_id, client_name, quote_date, currency, items_json, total_amount, 
+        VALUES (?, ?, ?, ?, ?, 'draft', ?, ?, 'quote')
+    ''', (user_id, client_name, quote_date, currency, total_amount, 
           client_email, client_phone))
     
     quote_id = cursor.lastrowid
+    save_invoice_items(cursor, quote_id, items)
     conn.commit()
     conn.close()
     return quote_id
 
-def get_user_quotes(user_id: int, client_name=None) -> List[tuple]:
+def get_user_quotes(user_id: int, client_name=None) -> List[Invoice]:
     """Get user's quotes"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Invoice)
     
     if client_name:
-        cursor.execute('''
+        condition, params = invoice_client_condition(client_name, user_id)
+        cursor.execute(f'''
             SELECT * FROM invoices 
-            WHERE user_id = ? AND client_name LIKE ? AND status = 'approved' AND document_type = 'quote'
+            WHERE user_id = ? AND {condition} AND status = 'approved' AND document_type = 'quote'
             ORDER BY created_at DESC
-        ''', (user_id, f'%{client_name}%'))
+        ''', (user_id, *params))
     else:
         cursor.execute('''
             SELECT * FROM invoices 
@@ -1365,21 +2606,7 @@ def get_user_quotes(user_id: int, client_name=None) -> List[tuple]:
     
     quotes = cursor.fetchall()
     conn.close()
-    
-    # Parse JSON items
-    parsed_quotes = []
-    for quote in quotes:
-        if len(quote) > 5 and quote[5]:
-            try:
-                quote_list = list(quote)
-                quote_list[5] = json.loads(quote[5]) if isinstance(quote[5], str) else quote[5]
-                parsed_quotes.append(tuple(quote_list))
-            except json.JSONDecodeError:
-                parsed_quotes.append(quote)
-        else:
-            parsed_quotes.append(quote)
-    
-    return parsed_quotes
+    return quotes
 
 # ===== TIER CHECK FUNCTIONS =====
 def check_invoice_limit(user_id: int) -> Tuple[bool, str]:
@@ -1387,7 +2614,7 @@ def check_invoice_limit(user_id: int) -> Tuple[bool, str]:
     if is_premium_user(user_id):
         return True, ""
     
-    monthly_count = get_user_invoice_count_this_month(user_id)
+    monthly_count = get_monthly_usage(user_id, 'invoice', 'quote')
     remaining = TIER_LIMITS['free']['monthly_invoices'] - monthly_count
     
     if remaining <= 0:
@@ -1400,20 +2627,7 @@ def check_appointment_limit(user_id: int) -> Tuple[bool, str]:
     if is_premium_user(user_id):
         return True, ""
     
-    # Count appointments created this month
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
-    first_day_of_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    first_day_str = first_day_of_month.strftime('%Y-%m-%d %H:%M:%S')
-    
-    cursor.execute('''
-        SELECT COUNT(*) FROM appointments 
-        WHERE user_id = ? AND created_at >= ?
-    ''', (user_id, first_day_str))
-    
-    appointment_count = cursor.fetchone()[0]
-    conn.close()
+    appointment_count = get_monthly_usage(user_id, 'appointment')
     
     remaining = TIER_LIMITS['free']['max_appointments'] - appointment_count
     
@@ -1476,10 +2690,11 @@ def save_appointment(user_id: int, client_id: int, title: str, description: str,
         reminder_minutes_before=reminder_minutes_before
     )
 
-def get_appointment_with_details(appointment_id: int) -> Optional[tuple]:
+def get_appointment_with_details(appointment_id: int) -> Optional[Appointment]:
     """Get appointment by ID with client details"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     
     cursor.execute('''
         SELECT a.*, c.client_name, c.email, c.phone, c.address,
@@ -1495,10 +2710,11 @@ def get_appointment_with_details(appointment_id: int) -> Optional[tuple]:
     return appointment
 
 def get_user_appointments_filtered(user_id: int, start_date=None, end_date=None, 
-                                  status=None, appointment_type=None, client_id=None) -> List[tuple]:
+                                  status=None, appointment_type=None, client_id=None) -> List[Appointment]:
     """Get user's appointments with filtering options"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     
     query = '''
         SELECT a.*, c.client_name, c.email, c.phone 
@@ -1581,7 +2797,7 @@ def update_appointment_status(appointment_id: int, status: str, cancellation_rea
     if status == 'cancelled' and cancellation_reason:
         updates['cancellation_reason'] = cancellation_reason
     
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     set_clauses = []
@@ -1627,7 +2843,7 @@ def reschedule_appointment_enhanced(appointment_id: int, new_date, new_duration=
     if new_duration:
         updates['duration_minutes'] = new_duration
     
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     set_clauses = []
@@ -1661,7 +2877,7 @@ def get_user_appointment_types_with_details(user_id: int) -> List[tuple]:
 
 def get_default_appointment_types_list() -> List[tuple]:
     """Get default appointment types"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM default_appointment_types ORDER BY type_name')
     types = cursor.fetchall()
@@ -1671,7 +2887,7 @@ def get_default_appointment_types_list() -> List[tuple]:
 def add_custom_appointment_type(user_id: int, type_name: str, duration=60, 
                                color='#4a6ee0', price=0.00, description='') -> int:
     """Add custom appointment type for user"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -1685,19 +2901,20 @@ def add_custom_appointment_type(user_id: int, type_name: str, duration=60,
     conn.close()
     return type_id
 
-def set_appointment_reminder_sent(appointment_id: int) -> bool:
-    """Mark appointment reminder as sent"""
-    conn = sqlite3.connect('invoices.db')
+def set_appointment_reminder_sent(appointment_id: int, sent: bool = True) -> bool:
+    """Mark appointment reminder as sent (or clear the flag)"""
+    conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('UPDATE appointments SET reminder_sent = 1 WHERE appointment_id = ?', (appointment_id,))
+    cursor.execute('UPDATE appointments SET reminder_sent = ? WHERE appointment_id = ?', (1 if sent else 0, appointment_id))
     conn.commit()
     conn.close()
     return True
 
-def get_appointments_needing_reminder(hours_before=24) -> List[tuple]:
+def get_appointments_needing_reminder(hours_before=24) -> List[Appointment]:
     """Get appointments needing reminder with enhanced filtering"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     
     reminder_window_start = datetime.now() + timedelta(hours=hours_before - 1)
     reminder_window_end = datetime.now() + timedelta(hours=hours_before + 1)
@@ -1733,7 +2950,7 @@ def get_upcoming_appointments_count(user_id: int, days=7) -> int:
 
 def get_appointment_statistics_enhanced(user_id: int, start_date=None, end_date=None) -> Dict[str, Any]:
     """Get appointment statistics for dashboard with enhanced metrics"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # Convert dates to strings for SQL
@@ -1823,30 +3040,27 @@ def get_appointment_statistics_enhanced(user_id: int, start_date=None, end_date=
     return stats
 
 def get_appointment_conflicts(user_id: int, start_datetime: datetime, 
-                             duration_minutes: int, exclude_appointment_id=None) -> List[tuple]:
+                             duration_minutes: int, exclude_appointment_id=None) -> List[Appointment]:
     """Check for scheduling conflicts"""
     end_datetime = start_datetime + timedelta(minutes=duration_minutes)
     
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     
     # Convert to strings for SQL
     start_str = start_datetime.strftime('%Y-%m-%d %H:%M:%S')
     end_str = end_datetime.strftime('%Y-%m-%d %H:%M:%S')
     
-    query = '''
+    query = f'''
         SELECT a.*, c.client_name
         FROM appointments a
         LEFT JOIN clients c ON a.client_id = c.client_id
         WHERE a.user_id = ? 
-        AND a.status IN ('scheduled', 'confirmed')
-        AND (
-            (a.appointment_time < ? AND datetime(a.appointment_time, '+' || a.duration_minutes || ' minutes') > ?)
-            OR (a.appointment_time >= ? AND a.appointment_time < ?)
-        )
+        AND {APPOINTMENT_OVERLAP_SQL.format(a='a.', start='?', end='?')}
     '''
     
-    params = [user_id, end_str, start_str, start_str, end_str]
+    params = [user_id, start_str, end_str]
     
     if exclude_appointment_id:
         query += ' AND a.appointment_id != ?'
@@ -1873,10 +3087,7 @@ def generate_appointment_summary(appointment_id: int) -> Optional[str]:
     duration = appointment[6]  # duration_minutes field
     end_time = appt_date + timedelta(minutes=duration)
     
-    # Get client name - check different positions
-    client_name = "Unknown"
-    if len(appointment) > 12 and appointment[12]:  # from joined query
-        client_name = appointment[12]
+    client_name = appointment.client_name or "Unknown"
     
     summary = f"""
 📅 **Appointment Summary**
@@ -1891,8 +3102,8 @@ def generate_appointment_summary(appointment_id: int) -> Optional[str]:
 • **Description:** {appointment[4] or 'No description provided'}
 """
     
-    if appointment[8] == 'cancelled' and len(appointment) > 18 and appointment[18]:  # status and cancellation_reason
-        summary += f"• **Cancellation Reason:** {appointment[18]}\n"
+    if appointment.status == 'cancelled' and appointment.cancellation_reason:
+        summary += f"• **Cancellation Reason:** {appointment.cancellation_reason}\n"
     
     return summary.strip()
 
@@ -1924,26 +3135,15 @@ def send_appointment_confirmation(appointment_id: int) -> bool:
     if not appointment:
         return False
     
-    # Get client email - check different positions
-    client_email = None
-    if len(appointment) > 13 and appointment[13]:  # email from client join
-        client_email = appointment[13]
-    
+    client_email = appointment.client_email
     if not client_email:
         return False
     
     # Get email template
     template = get_default_email_template(appointment[1])  # user_id
     
-    # Get client name
-    client_name = "Valued Client"
-    if len(appointment) > 12 and appointment[12]:
-        client_name = appointment[12]
-    
-    # Get company name
-    company_name = "Our Team"
-    if len(appointment) > 15 and appointment[15]:
-        company_name = appointment[15]
+    client_name = appointment.client_name or "Valued Client"
+    company_name = appointment.company_name or "Our Team"
     
     appt_date_str = appointment[5]
     try:
@@ -1955,7 +3155,7 @@ def send_appointment_confirmation(appointment_id: int) -> bool:
     logger.info(f"Appointment confirmation would be sent to {client_email} for appointment {appointment_id}")
     
     # Mark notification as sent
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('UPDATE appointments SET notification_sent = 1 WHERE appointment_id = ?', (appointment_id,))
     conn.commit()
@@ -1963,11 +3163,36 @@ def send_appointment_confirmation(appointment_id: int) -> bool:
     
     return True
 
-def create_recurring_appointments(user_id: int, client_id: int, title: str, description: str, 
-                                 start_date: datetime, duration: int, appointment_type: str,
-                                 recurrence_pattern: str, end_date=None, count=None) -> List[int]:
-    """Create a series of recurring appointments"""
-    appointments_created = []
+# Upper bound on a single series (a year of daily sessions); also keeps the
+# series conflict query well under SQLite's bound-parameter limit
+MAX_RECURRING_OCCURRENCES = 366
+
+# Closed-interval overlap: a slot starting exactly when an appointment ends (or
+# ending when one starts) is a conflict. get_appointment_conflicts,
+# check_appointment_conflict and find_series_conflicts share it so the booking
+# flow and recurring bookings agree. The unary + keeps the planner on
+# idx_appointments_user_status_interval.
+APPOINTMENT_OVERLAP_SQL = (
+    "{a}status IN ('scheduled', 'confirmed') "
+    "AND {a}end_time >= {start} AND +{a}appointment_time <= {end}"
+)
+
+class SeriesConflictError(Exception):
+    """Occurrences of a recurring series clash with existing appointments"""
+    
+    def __init__(self, conflicts: Dict[str, List[int]]):
+        self.conflicts = conflicts
+        super().__init__(f"{len(conflicts)} occurrences conflict with existing appointments: "
+                         f"{', '.join(sorted(conflicts))}")
+
+def get_recurrence_dates(start_date: datetime, recurrence_pattern: str, end_date=None, count=None) -> List[datetime]:
+    """Occurrence start times for a recurrence pattern
+
+    Raises ValueError if the series would exceed MAX_RECURRING_OCCURRENCES.
+    """
+    if count and count > MAX_RECURRING_OCCURRENCES:
+        raise ValueError(f"A recurring series can have at most {MAX_RECURRING_OCCURRENCES} "
+                         f"occurrences, {count} requested")
     
     if recurrence_pattern == 'daily':
         interval = timedelta(days=1)
@@ -1979,33 +3204,24 @@ def create_recurring_appointments(user_id: int, client_id: int, title: str, desc
         # Simple monthly - same day of month
         interval = None
     else:
-        return appointments_created
+        return []
     
+    dates = []
     current_date = start_date
-    appointments_count = 0
     
     while True:
         # Check termination conditions
         if end_date and current_date > end_date:
             break
         
-        if count and appointments_count >= count:
+        if count and len(dates) >= count:
             break
         
-        # Create appointment
-        appointment_id = create_appointment(
-            user_id=user_id,
-            client_id=client_id,
-            title=f"{title} ({appointments_count + 1})" if count else title,
-            appointment_date=current_date,
-            duration_minutes=duration,
-            appointment_type=appointment_type,
-            description=description,
-            status='scheduled'
-        )
+        if len(dates) >= MAX_RECURRING_OCCURRENCES:
+            raise ValueError(f"A recurring series can have at most {MAX_RECURRING_OCCURRENCES} "
+                             f"occurrences; set an earlier end date or a count")
         
-        appointments_created.append(appointment_id)
-        appointments_count += 1
+        dates.append(current_date)
         
         # Calculate next date
         if recurrence_pattern == 'monthly':
@@ -2024,6 +3240,94 @@ def create_recurring_appointments(user_id: int, client_id: int, title: str, desc
         else:
             current_date += interval
     
+    return dates
+
+def find_series_conflicts(cursor, user_id: int, start_times: List[datetime], duration: int) -> Dict[str, List[int]]:
+    """Existing appointments overlapping any slot of a series, in one query
+
+    Returns {slot start 'YYYY-MM-DD HH:MM:SS': [conflicting appointment_id, ...]}.
+    """
+    if not start_times:
+        return {}
+    
+    slots = []
+    for start_time in start_times:
+        slots.append(start_time.strftime('%Y-%m-%d %H:%M:%S'))
+        slots.append((start_time + timedelta(minutes=duration)).strftime('%Y-%m-%d %H:%M:%S'))
+    
+    cursor.execute(f'''
+        WITH series(slot_start, slot_end) AS (VALUES {', '.join(['(?, ?)'] * len(start_times))})
+        SELECT s.slot_start, a.appointment_id
+        FROM series s
+        JOIN appointments a
+          ON a.user_id = ?
+         AND {APPOINTMENT_OVERLAP_SQL.format(a='a.', start='s.slot_start', end='s.slot_end')}
+    ''', (*slots, user_id))
+    
+    conflicts = {}
+    for slot_start, appointment_id in cursor.fetchall():
+        conflicts.setdefault(slot_start, []).append(appointment_id)
+    return conflicts
+
+def create_recurring_appointments(user_id: int, client_id: int, title: str, description: str, 
+                                 start_date: datetime, duration: int, appointment_type: str,
+                                 recurrence_pattern: str, end_date=None, count=None,
+                                 reminder_minutes_before=30, allow_conflicts=False,
+                                 skip_conflicts=False) -> List[int]:
+    """Create a series of recurring appointments in one transaction
+
+    If any occurrence clashes with an existing appointment nothing is created
+    and SeriesConflictError (with .conflicts) is raised. Pass skip_conflicts
+    to create only the free occurrences, or allow_conflicts to book every
+    occurrence regardless. Returns the IDs of the appointments created.
+    """
+    start_times = get_recurrence_dates(start_date, recurrence_pattern, end_date, count)
+    if not start_times:
+        return []
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # Write lock up front: the conflict check and the inserts see the same state
+        cursor.execute('BEGIN IMMEDIATE')
+        
+        if not allow_conflicts:
+            conflicts = find_series_conflicts(cursor, user_id, start_times, duration)
+            if conflicts and not skip_conflicts:
+                raise SeriesConflictError(conflicts)
+            if conflicts:
+                logger.warning(f"⚠️ Skipping {len(conflicts)} conflicting occurrences in recurring series for user {user_id}")
+        else:
+            conflicts = {}
+        
+        rows = []
+        for number, start_time in enumerate(start_times, 1):
+            start_str = start_time.strftime('%Y-%m-%d %H:%M:%S')
+            if start_str in conflicts:
+                continue
+            rows.append((
+                user_id, client_id, f"{title} ({number})" if count else title, description,
+                start_str, duration, appointment_type, reminder_minutes_before, recurrence_pattern,
+                end_date.strftime('%Y-%m-%d %H:%M:%S') if isinstance(end_date, datetime) else end_date
+            ))
+        
+        last_id = cursor.execute('SELECT COALESCE(MAX(appointment_id), 0) FROM appointments').fetchone()[0]
+        cursor.executemany('''
+            INSERT INTO appointments 
+            (user_id, client_id, title, description, appointment_time, duration_minutes,
+             appointment_type, status, reminder_minutes_before, recurrence_pattern, recurrence_end_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'scheduled', ?, ?, ?)
+        ''', rows)
+        # IDs are assigned in order and nobody else can write while we hold the lock
+        cursor.execute('SELECT appointment_id FROM appointments WHERE appointment_id > ? ORDER BY appointment_id', (last_id,))
+        appointments_created = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
     return appointments_created
 
 def export_appointments_to_csv(user_id: int, start_date=None, end_date=None) -> str:
@@ -2055,23 +3359,23 @@ def export_appointments_to_csv(user_id: int, start_date=None, end_date=None) ->
         
         writer.writerow([
             appt[0],  # appointment_id
-            appt[12] if len(appt) > 12 else '',  # client_name
-            appt[3],  # title
-            appt[4],  # description
+            appt.client_name or '',
+            appt.title,
+            appt.description,
             date_str,
             time_str,
-            appt[6],  # duration_minutes
-            appt[7],  # appointment_type
-            appt[8],  # status
-            appt[13] if len(appt) > 13 else '',  # email
-            appt[14] if len(appt) > 14 else ''   # phone
+            appt.duration_minutes,
+            appt.appointment_type,
+            appt.status,
+            appt.client_email or '',
+            appt.client_phone or ''
         ])
     
     return output.getvalue()
 
 def get_default_email_template(user_id: int) -> Optional[tuple]:
     """Get default email template for a user"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT * FROM email_templates 
@@ -2085,7 +3389,7 @@ def get_default_email_template(user_id: int) -> Optional[tuple]:
 # ===== SCHEDULING UTILITY FUNCTIONS =====
 def generate_appointment_number(user_id: int) -> str:
     """Generate unique appointment reference number"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     now = datetime.now()
@@ -2155,15 +3459,13 @@ print("✅ Part 3: Appointment helper functions enhanced with comprehensive sche
 # Invoice generation
 def generate_invoice_number(user_id):
     """Generate unique invoice number"""
-    counter = get_invoice_counter(user_id)
+    counter = next_invoice_counter(user_id)
     now = datetime.now()
-    invoice_number = f"INV-{now.year}-{now.month:02d}-{counter:04d}"
-    increment_invoice_counter(user_id)
-    return invoice_number
+    return f"INV-{now.year}-{now.month:02d}-{counter:04d}"
 
 def generate_appointment_number(user_id):
     """Generate unique appointment reference number"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     now = datetime.now()
@@ -2179,7 +3481,14 @@ def generate_appointment_number(user_id):
 # ==================================================
 
 def create_appointment_confirmation_pdf(appointment_data, user_info, client_info):
-    """Create a professional appointment confirmation PDF"""
+    """Create a professional appointment confirmation PDF and save it under appointments/"""
+    pdf_data = render_appointment_confirmation_pdf(appointment_data, user_info, client_info)
+    pdf_file = save_pdf(pdf_data, f"appointments/{appointment_data.get('appointment_number', 'N/A')}.pdf")
+    logger.info(f"Appointment PDF generated: {pdf_file}")
+    return pdf_file
+
+def render_appointment_confirmation_pdf(appointment_data, user_info, client_info) -> bytes:
+    """Build the appointment confirmation PDF in memory"""
     try:
         buffer = io.BytesIO()
         
@@ -2215,21 +3524,14 @@ def create_appointment_confirmation_pdf(appointment_data, user_info, client_info
         
         # Header section
         company_name = ""
-        if user_info and len(user_info) > 8:
-            company_name = user_info[8] if user_info[8] else ''
+        if user_info:
+            company_name = user_info.company_name or ''
         
-        has_logo = False
-        if user_info and len(user_info) > 7 and user_info[7]:  # logo_path
-            logo_path = user_info[7]
-            if os.path.exists(logo_path):
-                try:
-                    logo = Image(logo_path, width=2*inch, height=1*inch)
-                    story.append(logo)
-                    story.append(Spacer(1, 0.2*inch))
-                    has_logo = True
-                except Exception as e:
-                    logger.warning(f"Could not load logo: {e}")
-                    has_logo = False
+        logo = get_logo_image(user_info.logo_path if user_info else None, 2*inch, 1*inch)
+        has_logo = logo is not None
+        if has_logo:
+            story.append(logo)
+            story.append(Spacer(1, 0.2*inch))
         
         # Appointment title
         title_text = "<b>APPOINTMENT CONFIRMATION</b>"
@@ -2334,12 +3636,11 @@ def create_appointment_confirmation_pdf(appointment_data, user_info, client_info
         if company_name:
             business_details.append(f"<b>Company:</b> {company_name}")
         
-        # Get user email and phone from user_info tuple
         if user_info:
-            if len(user_info) > 13 and user_info[13]:  # email field
-                business_details.append(f"<b>Contact Email:</b> {user_info[13]}")
-            if len(user_info) > 14 and user_info[14]:  # phone field
-                business_details.append(f"<b>Contact Phone:</b> {user_info[14]}")
+            if user_info.email:
+                business_details.append(f"<b>Contact Email:</b> {user_info.email}")
+            if user_info.phone:
+                business_details.append(f"<b>Contact Phone:</b> {user_info.phone}")
         
         for detail in business_details:
             story.append(Paragraph(detail, normal_style))
@@ -2384,23 +3685,28 @@ def create_appointment_confirmation_pdf(appointment_data, user_info, client_info
         
         pdf_data = buffer.getvalue()
         buffer.close()
-        
-        # Save PDF
-        os.makedirs('appointments', exist_ok=True)
-        pdf_file = f"appointments/{appointment_number}.pdf"
-        with open(pdf_file, 'wb') as f:
-            f.write(pdf_data)
-        
-        logger.info(f"Appointment PDF generated: {pdf_file}")
-        return pdf_file
+        return pdf_data
         
     except Exception as e:
         logger.error(f"Appointment PDF generation error: {e}")
         # Return minimal PDF or raise exception
         raise
 
+def calendar_export_filename(user_id, start_date, end_date):
+    """File name for a calendar export"""
+    return f"calendar_{user_id}_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}.pdf"
+
 def create_calendar_export_pdf(user_id, start_date, end_date):
-    """Create a PDF calendar export for a date range"""
+    """Create a PDF calendar export for a date range and save it under calendar_exports/"""
+    pdf_data = render_calendar_export_pdf(user_id, start_date, end_date)
+    if not pdf_data:
+        return None
+    pdf_file = save_pdf(pdf_data, f"calendar_exports/{calendar_export_filename(user_id, start_date, end_date)}")
+    logger.info(f"Calendar PDF generated: {pdf_file}")
+    return pdf_file
+
+def render_calendar_export_pdf(user_id, start_date, end_date) -> Optional[bytes]:
+    """Build a calendar export PDF in memory; None when there are no appointments"""
     try:
         # Get appointments for the period
         appointments = get_user_appointments(user_id, start_date, end_date)
@@ -2438,8 +3744,8 @@ def create_calendar_export_pdf(user_id, start_date, end_date):
         
         # Header
         company_name = "Your Business"
-        if user_info and len(user_info) > 8 and user_info[8]:
-            company_name = user_info[8]
+        if user_info and user_info.company_name:
+            company_name = user_info.company_name
             
         story.append(Paragraph(f"<b>{company_name} - Appointment Calendar</b>", title_style))
         
@@ -2495,22 +3801,18 @@ def create_calendar_export_pdf(user_id, start_date, end_date):
             ]
             
             for appt in day_appointments:
-                appt_date_str = appt[5]
-                try:
-                    appt_time = parser.parse(appt_date_str)
-                    duration = appt[6] if len(appt) > 6 else 60
+                appt_time = appt.starts_at
+                duration = appt.duration_minutes or 60
+                if appt_time:
                     end_time = appt_time + timedelta(minutes=duration)
                     time_range = f"{appt_time.strftime('%I:%M %p')} - {end_time.strftime('%I:%M %p')}"
-                except:
+                else:
                     time_range = "Time N/A"
                     duration = 0
                 
-                client_name = "Unknown"
-                if len(appt) > 12 and appt[12]:  # client_name from join
-                    client_name = appt[12]
-                
-                appointment_type = appt[7] if len(appt) > 7 else "Meeting"
-                status = appt[8] if len(appt) > 8 else "Scheduled"
+                client_name = appt.client_name or "Unknown"
+                appointment_type = appt.appointment_type or "Meeting"
+                status = appt.status or "Scheduled"
                 
                 table_data.append([
                     Paragraph(time_range, small_style),
@@ -2580,17 +3882,7 @@ def create_calendar_export_pdf(user_id, start_date, end_date):
         
         pdf_data = buffer.getvalue()
         buffer.close()
-        
-        # Save PDF
-        os.makedirs('calendar_exports', exist_ok=True)
-        filename = f"calendar_{start_date.strftime('%Y%m%d')}_to_{end_date.strftime('%Y%m%d')}.pdf"
-        pdf_file = f"calendar_exports/{filename}"
-        
-        with open(pdf_file, 'wb') as f:
-            f.write(pdf_data)
-        
-        logger.info(f"Calendar PDF generated: {pdf_file}")
-        return pdf_file
+        return pdf_data
         
     except Exception as e:
         logger.error(f"Calendar PDF generation error: {e}")
@@ -2692,13 +3984,13 @@ def send_appointment_email(appointment_id, email_type="confirmation"):
             return False
         
         # Get user and client info
-        user_id = appointment[1]
+        user_id = appointment.user_id
         user_info = get_user(user_id)
         client_info = {
-            'client_name': appointment[12] if len(appointment) > 12 else '',
-            'email': appointment[13] if len(appointment) > 13 else '',
-            'phone': appointment[14] if len(appointment) > 14 else '',
-            'address': appointment[15] if len(appointment) > 15 else ''
+            'client_name': appointment.client_name or '',
+            'email': appointment.client_email or '',
+            'phone': appointment.client_phone or '',
+            'address': appointment.client_address or ''
         }
         
         # Check if client has email
@@ -2733,8 +4025,8 @@ def send_appointment_email(appointment_id, email_type="confirmation"):
         
         # Prepare email content
         company_name = "Your Business"
-        if user_info and len(user_info) > 8 and user_info[8]:
-            company_name = user_info[8]
+        if user_info and user_info.company_name:
+            company_name = user_info.company_name
             
         try:
             appt_date = parser.parse(appt_data['appointment_date'])
@@ -2825,7 +4117,7 @@ def send_appointment_email(appointment_id, email_type="confirmation"):
         logger.info(f"Appointment {email_type} email prepared for appointment {appointment_id}")
         
         # Mark notification as sent in database
-        conn = sqlite3.connect('invoices.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute('UPDATE appointments SET notification_sent = 1 WHERE appointment_id = ?', (appointment_id,))
         conn.commit()
@@ -2868,7 +4160,14 @@ def send_bulk_appointment_reminders():
 # ==================================================
 
 def create_invoice_pdf(invoice_data, user_info):
-    """Original invoice PDF creation function - kept as is"""
+    """Create the invoice PDF and save it under invoices/"""
+    pdf_data = render_invoice_pdf(invoice_data, user_info)
+    pdf_file = save_pdf(pdf_data, f"invoices/{invoice_data.get('invoice_number', 'invoice')}.pdf")
+    logger.info(f"PDF generated successfully: {pdf_file}")
+    return pdf_file
+
+def render_invoice_pdf(invoice_data, user_info) -> bytes:
+    """Build the invoice PDF in memory (send it straight to Telegram or email)"""
     try:
         buffer = io.BytesIO()
         
@@ -2906,19 +4205,11 @@ def create_invoice_pdf(invoice_data, user_info):
         
         # Header section
         company_name = ""
-        has_logo = False
-        if user_info and len(user_info) > 8:
-            company_name = user_info[8] if user_info[8] else ''
+        if user_info:
+            company_name = user_info.company_name or ''
         
-        if user_info and len(user_info) > 7 and user_info[7]:  # logo_path
-            logo_path = user_info[7]
-            if os.path.exists(logo_path):
-                try:
-                    logo = Image(logo_path, width=2.5*inch, height=1.25*inch)
-                    has_logo = True
-                except Exception as e:
-                    logger.warning(f"Could not load logo: {e}")
-                    has_logo = False
+        logo = get_logo_image(user_info.logo_path if user_info else None, 2.5*inch, 1.25*inch)
+        has_logo = logo is not None
         
         header_data = []
         
@@ -2948,12 +4239,12 @@ def create_invoice_pdf(invoice_data, user_info):
         reg_data = []
         
         # Always show company registration number if available
-        if user_info and len(user_info) > 9 and user_info[9]:  # company_reg_number
-            reg_data.append(Paragraph(f"<b>Company Reg:</b> {user_info[9]}", normal_style))
+        if user_info and user_info.company_reg_number:
+            reg_data.append(Paragraph(f"<b>Company Reg:</b> {user_info.company_reg_number}", normal_style))
         
         # Only show VAT registration number if VAT is enabled for this invoice
-        if invoice_data.get('vat_enabled') and user_info and len(user_info) > 10 and user_info[10]:  # vat_reg_number
-            reg_data.append(Paragraph(f"<b>VAT Reg:</b> {user_info[10]}", normal_style))
+        if invoice_data.get('vat_enabled') and user_info and user_info.vat_reg_number:
+            reg_data.append(Paragraph(f"<b>VAT Reg:</b> {user_info.vat_reg_number}", normal_style))
         
         if reg_data:
             for reg in reg_data:
@@ -3084,19 +4375,451 @@ def create_invoice_pdf(invoice_data, user_info):
         
         pdf_data = buffer.getvalue()
         buffer.close()
-        
-        os.makedirs('invoices', exist_ok=True)
-        pdf_file = f"invoices/{invoice_data.get('invoice_number', 'invoice')}.pdf"
-        with open(pdf_file, 'wb') as f:
-            f.write(pdf_data)
-        
-        logger.info(f"PDF generated successfully: {pdf_file}")
-        return pdf_file
+        return pdf_data
         
     except Exception as e:
         logger.error(f"PDF generation error: {e}")
         raise
 
+# ===== PDF RENDERING SERVICE =====
+# ReportLab's doc.build is CPU-bound and holds the GIL, so async handlers hand
+# PDF builders to a process pool instead of calling them inline. At most
+# PDF_RENDER_QUEUE_SIZE renders are queued or running; further callers wait
+# up to PDF_RENDER_QUEUE_WAIT seconds for a slot and then get PdfRenderBusy.
+# Workers are forked by pdf_renderer.start() in main(), before the bot starts
+# its own threads, and never afterwards: if the pool breaks, renders fall back
+# to a thread in this process until the bot is restarted.
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+PDF_RENDER_QUEUE_SIZE = int(os.getenv('PDF_RENDER_QUEUE_SIZE', '32'))
+PDF_RENDER_QUEUE_WAIT = float(os.getenv('PDF_RENDER_QUEUE_WAIT', '5'))
+PDF_RENDER_TIMEOUT = float(os.getenv('PDF_RENDER_TIMEOUT', '30'))
+
+def save_pdf(pdf_data: bytes, pdf_file: str) -> str:
+    """Write rendered PDF bytes to pdf_file (creating its directory) and return the path"""
+    os.makedirs(os.path.dirname(pdf_file) or '.', exist_ok=True)
+    with open(pdf_file, 'wb') as f:
+        f.write(pdf_data)
+    return pdf_file
+
+async def save_pdf_async(pdf_data: bytes, pdf_file: str) -> str:
+    """save_pdf on a worker thread, for handlers that also want a copy on disk"""
+    return await asyncio.to_thread(save_pdf, pdf_data, pdf_file)
+
+class PdfRenderBusy(Exception):
+    """The render queue stayed full for PDF_RENDER_QUEUE_WAIT seconds"""
+
+# Connections a forked PDF worker inherited from the parent. They are kept
+# referenced, never used or closed: closing one in the child could checkpoint
+# or remove the WAL files the parent's connection is still using.
+_inherited_conns = []
+
+def _pdf_worker_init():
+    """Set aside the SQLite connection inherited through fork; the worker opens its own"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        _inherited_conns.append(conn)
+    _db_local.conn = None
+    _db_local.depth = 0
+
+class PdfRenderService:
+    """Bounded process pool for PDF builders (create_invoice_pdf and friends)
+
+    Until start() has forked the pool (or with workers=0, or after the pool
+    broke) builders run on the event loop's default thread pool instead.
+    """
+    
+    def __init__(self, workers: int = PDF_RENDER_WORKERS, queue_size: int = PDF_RENDER_QUEUE_SIZE,
+                 timeout: float = PDF_RENDER_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(queue_size)
+        self._executor = None
+        self._broken = False
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """Fork the worker pool now; call it before the process starts any threads
+
+        A no-op once the pool exists, after it has broken, or with no workers.
+        """
+        if self.workers <= 0:
+            return
+        with self._lock:
+            if self._executor is not None or self._broken:
+                return
+            context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+            executor = self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context, initializer=_pdf_worker_init
+            )
+        for future in [executor.submit(int) for _ in range(self.workers)]:
+            future.result()
+        logger.info(f"✅ PDF render pool started ({self.workers} workers)")
+    
+    async def render(self, func, *args, timeout: Optional[float] = None):
+        """Run a PDF builder off the event loop and return its result (usually a file path)
+
+        Raises PdfRenderBusy when no slot frees up in time and
+        asyncio.TimeoutError when the render itself takes too long.
+        """
+        try:
+            await asyncio.wait_for(self._slots.acquire(), PDF_RENDER_QUEUE_WAIT)
+        except asyncio.TimeoutError:
+            raise PdfRenderBusy(f"{PDF_RENDER_QUEUE_SIZE} PDF renders already pending")
+        
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            if executor is None:
+                future = loop.run_in_executor(None, func, *args)
+            else:
+                future = asyncio.wrap_future(executor.submit(func, *args))
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._render_finished)
+        
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except BrokenProcessPool:
+            # Re-forking now would copy the bot's threads' held locks into the
+            # children, so the pool stays down until the next restart
+            logger.error("❌ PDF render worker died; rendering in-process until the bot is restarted")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+                    self._broken = True
+            executor.shutdown(wait=False)
+            raise
+    
+    def _render_finished(self, future):
+        # The slot is held until the render really finishes, even after a
+        # timeout, so a stuck worker still counts against the queue bound
+        self._slots.release()
+        if not future.cancelled():
+            future.exception()  # an abandoned (timed-out) render's error is not logged as unretrieved
+    
+    def shutdown(self):
+        """Stop the worker processes"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+pdf_renderer = PdfRenderService()
+
+# ===== PDF CACHE =====
+# Rendered invoice/quote PDFs keyed by a hash of everything that goes into
+# them: the normalized document data, the user's branding fields and the logo
+# file's size/mtime. An unchanged document is served from memory; entries are
+# evicted least-recently-used once PDF_CACHE_MAX_BYTES is exceeded.
+# update_user_company_info, update_invoice_status and update_quote_status also
+# drop a user's or a document's entries explicitly. Documents are keyed by
+# their invoices.invoice_id, which quotes share.
+PDF_CACHE_MAX_BYTES = int(os.getenv('PDF_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+PDF_BRANDING_FIELDS = ('logo_path', 'company_name', 'company_reg_number', 'vat_reg_number')
+
+class PdfCache:
+    """Content-addressed LRU cache of rendered PDF bytes, bounded by total size"""
+    
+    def __init__(self, max_bytes: int = PDF_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # key -> (pdf bytes, user_id, document_id)
+        self._entries: 'OrderedDict[str, Tuple[bytes, Optional[int], Optional[int]]]' = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(kind: str, data: Dict, user_info) -> str:
+        """SHA-256 over the document kind, its data and the user's branding"""
+        branding = {field: getattr(user_info, field, None) for field in PDF_BRANDING_FIELDS}
+        logo_path = branding['logo_path']
+        if logo_path and os.path.exists(logo_path):
+            stat = os.stat(logo_path)
+            branding['logo_stat'] = (stat.st_size, stat.st_mtime_ns)
+        normalized = json.dumps({'kind': kind, 'data': data, 'branding': branding},
+                                sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+    
+    def put(self, key: str, pdf_data: bytes, user_id: Optional[int] = None, document_id: Optional[int] = None):
+        if len(pdf_data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[0])
+            self._entries[key] = (pdf_data, user_id, document_id)
+            self.total_bytes += len(pdf_data)
+            while self.total_bytes > self.max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+    
+    def _invalidate(self, position: int, value: int):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[position] == value]:
+                self.total_bytes -= len(self._entries.pop(key)[0])
+    
+    def invalidate_user(self, user_id: int):
+        """Drop every cached PDF for a user (their branding changed)"""
+        self._invalidate(1, user_id)
+    
+    def invalidate_document(self, document_id: int):
+        """Drop cached PDFs of one invoice or quote (its invoices.invoice_id)"""
+        self._invalidate(2, document_id)
+
+pdf_cache = PdfCache()
+
+async def render_document_pdf(document_type: str, document_id: int, document_data: Dict, user_info,
+                              key: Optional[str] = None) -> bytes:
+    """Invoice or quote PDF bytes, from the cache or rendered on the render pool"""
+    render = render_quote_pdf if document_type == 'quote' else render_invoice_pdf
+    if key is None:
+        # key() stats the logo file, so it runs on a worker thread
+        key = await asyncio.to_thread(pdf_cache.key, document_type, document_data, user_info)
+    pdf_data = pdf_cache.get(key)
+    if pdf_data is None:
+        pdf_data = await pdf_renderer.render(render, document_data, user_info)
+        pdf_cache.put(key, pdf_data, getattr(user_info, 'user_id', None), document_id)
+    return pdf_data
+
+# ===== TELEGRAM FILE ID CACHE =====
+# Telegram re-sends an uploaded file by its file_id, so each upload's file_id
+# is stored against the hash of what was sent. For rendered documents the hash
+# is the PdfCache input key, which lets a repeat send skip rendering as well as
+# the upload. Rows older than TELEGRAM_FILE_MAX_AGE_DAYS are pruned daily; a
+# pruned file is simply uploaded again on its next send.
+TELEGRAM_FILE_MAX_AGE_DAYS = int(os.getenv('TELEGRAM_FILE_MAX_AGE_DAYS', '90'))
+
+def get_telegram_file_id(content_hash: str) -> Optional[str]:
+    """Stored Telegram file_id for a content hash"""
+    conn = get_db_connection()
+    row = conn.execute('SELECT file_id FROM telegram_files WHERE content_hash = ?', (content_hash,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def save_telegram_file_id(content_hash: str, file_id: str, kind: str):
+    """Remember the file_id Telegram assigned to an upload"""
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO telegram_files (content_hash, file_id, kind) VALUES (?, ?, ?)
+        ''', (content_hash, file_id, kind))
+
+def forget_telegram_file_id(content_hash: str):
+    """Drop a file_id Telegram no longer accepts"""
+    with db_connection() as conn:
+        conn.execute('DELETE FROM telegram_files WHERE content_hash = ?', (content_hash,))
+
+def prune_telegram_file_ids(max_age_days: int = TELEGRAM_FILE_MAX_AGE_DAYS) -> int:
+    """Delete file_ids stored more than max_age_days ago; returns how many"""
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            DELETE FROM telegram_files WHERE created_at < datetime('now', ?)
+        ''', (f'-{max_age_days} days',))
+        return cursor.rowcount
+
+async def prune_telegram_files_job(context: ContextTypes.DEFAULT_TYPE):
+    """Daily job: keep telegram_files from growing without bound"""
+    try:
+        pruned = await run_db(prune_telegram_file_ids)
+    except Exception as e:
+        logger.error(f"Error pruning Telegram file ids: {e}")
+        return 0
+    
+    if pruned:
+        logger.info(f"🧹 Pruned {pruned} stored Telegram file ids")
+    return pruned
+
+async def send_cached_file(bot, chat_id: int, content_hash: str, kind: str, load,
+                           filename: Optional[str] = None, caption: Optional[str] = None,
+                           as_photo: bool = False):
+    """Send a file by its stored file_id, uploading (and remembering it) only on a miss
+
+    load is a zero-argument coroutine function returning the bytes; it is
+    only awaited when there is no usable file_id.
+    """
+    send = bot.send_photo if as_photo else bot.send_document
+    field = 'photo' if as_photo else 'document'
+    
+    file_id = await run_db(get_telegram_file_id, content_hash)
+    if file_id:
+        try:
+            return await send(chat_id=chat_id, caption=caption, **{field: file_id})
+        except BadRequest as e:
+            logger.warning(f"Stored file_id for {kind} rejected, re-uploading: {e}")
+            await run_db(forget_telegram_file_id, content_hash)
+    
+    data = await load()
+    upload = {field: data}
+    if not as_photo:
+        upload['filename'] = filename
+    message = await send(chat_id=chat_id, caption=caption, **upload)
+    
+    sent = message.photo[-1] if as_photo else message.document
+    await run_db(save_telegram_file_id, content_hash, sent.file_id, kind)
+    return message
+
+def document_pdf_data(document: Invoice) -> Dict:
+    """PDF builder input for a stored invoice or quote (quote builders read quote_* fields)"""
+    data = document.as_dict()
+    if document.document_type == 'quote':
+        data['quote_number'] = document.invoice_number
+        data['quote_date'] = document.invoice_date
+    return data
+
+async def send_document_pdf(bot, chat_id: int, document_type: str, document_id: int, document_data: Dict,
+                            user_info, caption: Optional[str] = None):
+    """Send an invoice or quote PDF, reusing the Telegram upload when nothing changed"""
+    number = document_data.get('invoice_number') or document_data.get('quote_number') or document_type
+    key = await asyncio.to_thread(pdf_cache.key, document_type, document_data, user_info)
+    return await send_cached_file(
+        bot, chat_id, key, document_type,
+        lambda: render_document_pdf(document_type, document_id, document_data, user_info, key),
+        filename=f"{number}.pdf", caption=caption
+    )
+
+def _read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+async def send_logo(bot, chat_id: int, user_info, caption: Optional[str] = None):
+    """Send the user's stored logo, uploading it only the first time"""
+    logo_path = user_info.logo_path if user_info else None
+    if not logo_path:
+        return None
+    
+    logo_data = await asyncio.to_thread(_read_file, logo_path)
+    if logo_data is None:
+        return None
+    
+    async def load():
+        return logo_data
+    
+    return await send_cached_file(bot, chat_id, hashlib.sha256(logo_data).hexdigest(), 'logo', load,
+                                  caption=caption, as_photo=True)
+
+# ===== LOGO PROCESSING =====
+# /logo uploads are normalized once with Pillow: EXIF rotation applied, scaled
+# down to LOGO_MAX_PX on the long side and re-encoded without metadata as PNG
+# (if the image has transparency) or JPEG. Only that rendition is stored, and
+# PDF builders draw it through an ImageReader cached per (path, mtime), so
+# render time and PDF size no longer depend on the original upload.
+LOGO_DIR = os.getenv('LOGO_DIR', 'logos')
+LOGO_MAX_PX = int(os.getenv('LOGO_MAX_PX', '600'))
+LOGO_JPEG_QUALITY = int(os.getenv('LOGO_JPEG_QUALITY', '85'))
+LOGO_MAX_UPLOAD_BYTES = int(os.getenv('LOGO_MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+
+def process_logo(source_path: str, user_id: int) -> str:
+    """Write a compact, metadata-free rendition of source_path and return its path"""
+    with PILImage.open(source_path) as image:
+        # Let the JPEG decoder skip detail we'd throw away anyway
+        image.draft('RGB', (LOGO_MAX_PX * 2, LOGO_MAX_PX * 2))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        image.thumbnail((LOGO_MAX_PX, LOGO_MAX_PX), PILImage.LANCZOS)
+    image.info = {}  # no EXIF, ICC or text chunks in the stored copy
+
+    extension = 'png' if has_alpha else 'jpg'
+    os.makedirs(LOGO_DIR, exist_ok=True)
+    logo_path = os.path.join(LOGO_DIR, f"{user_id}.{extension}")
+    tmp_path = logo_path + '.tmp'
+    if has_alpha:
+        image.save(tmp_path, 'PNG', optimize=True)
+    else:
+        image.save(tmp_path, 'JPEG', quality=LOGO_JPEG_QUALITY, optimize=True, progressive=True)
+    os.replace(tmp_path, logo_path)
+
+    # A previous logo in the other format would otherwise linger
+    stale_path = os.path.join(LOGO_DIR, f"{user_id}.{'jpg' if has_alpha else 'png'}")
+    if os.path.exists(stale_path):
+        os.remove(stale_path)
+
+    logger.info(f"🖼️ Logo for user {user_id}: {image.size[0]}x{image.size[1]} {extension}, "
+                f"{os.path.getsize(logo_path)} bytes")
+    return logo_path
+
+@functools.lru_cache(maxsize=256)
+def _load_logo_reader(logo_path: str, mtime_ns: int, size: int) -> ImageReader:
+    reader = ImageReader(logo_path)
+    # drawImage digests the pixels (and alpha mask) on every render; decode them once here
+    reader.getRGBData()
+    if reader._dataA:
+        reader._dataA.getRGBData()
+    return reader
+
+class LogoImage(Image):
+    """Platypus Image that draws a preloaded ImageReader instead of reopening the file"""
+
+    def __init__(self, reader: ImageReader, width=None, height=None):
+        self._img = reader
+        super().__init__(reader.fp, width=width, height=height)
+
+def get_logo_image(logo_path: Optional[str], width, height) -> Optional[Image]:
+    """Flowable for a stored logo, or None if there is none or it can't be read"""
+    if not logo_path:
+        return None
+    try:
+        stat = os.stat(logo_path)
+        reader = _load_logo_reader(logo_path, stat.st_mtime_ns, stat.st_size)
+        return LogoImage(reader, width=width, height=height)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Could not load logo: {e}")
+        return None
+
+async def logo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/logo - show the current logo (if any) and ask for a new image"""
+    context.user_data['awaiting_logo'] = True
+    user_info = await run_db(get_user, update.effective_user.id)
+    await send_logo(context.bot, update.effective_chat.id, user_info, caption="🏢 Your current logo")
+    await update.message.reply_text(
+        "🏢 *Company Logo*\n\n"
+        "Send your logo as a photo or image file. It will appear on your invoices, "
+        "quotes and appointment confirmations.",
+        parse_mode='Markdown'
+    )
+
+async def handle_logo_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Photo or image document sent after /logo"""
+    if not context.user_data.get('awaiting_logo'):
+        return
+
+    message = update.message
+    user_id = update.effective_user.id
+    upload = message.photo[-1] if message.photo else message.document
+    if upload.file_size and upload.file_size > LOGO_MAX_UPLOAD_BYTES:
+        await message.reply_text("❌ That image is too large. Please send one under 20 MB.")
+        return
+
+    os.makedirs(LOGO_DIR, exist_ok=True)
+    upload_path = os.path.join(LOGO_DIR, f"upload_{user_id}_{uuid.uuid4().hex}")
+    try:
+        telegram_file = await upload.get_file()
+        await telegram_file.download_to_drive(upload_path)
+        logo_path = await asyncio.to_thread(process_logo, upload_path, user_id)
+    except Exception as e:
+        logger.error(f"❌ Logo processing failed for user {user_id}: {e}")
+        await message.reply_text("❌ Couldn't read that image. Please send a PNG or JPEG logo.")
+        return
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+
+    await run_db(update_user_company_info, user_id, logo_path=logo_path)
+    context.user_data.pop('awaiting_logo', None)
+    await message.reply_text("✅ Logo saved! It will be used on your next documents.")
+
 print("✅ Part 5 updated with comprehensive appointment PDF and email functionality!")
 
 # PART 4: COMMAND HANDLERS (Updated with Scheduling)
@@ -3111,7 +4834,7 @@ async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check if user has existing clients
-    clients = get_user_clients(user_id)
+    clients = await run_db(get_user_clients, user_id)
     
     if not clients:
         # No clients, create one first
@@ -3170,7 +4893,7 @@ async def schedule_client_handler(update: Update, context: ContextTypes.DEFAULT_
             client_id = int(data.split("_")[2])
             
             # Get client details
-            client = get_client_by_id(client_id)
+            client = await run_db(get_client_by_id, client_id)
             if client:
                 # Store in context for booking flow
                 context.user_data['scheduling'] = {
@@ -3270,7 +4993,7 @@ async def handle_appointment_buttons(update: Update, context: ContextTypes.DEFAU
 
 async def start_appointment_booking(query, user_id):
     """Start the appointment booking flow"""
-    clients = get_user_clients(user_id)
+    clients = await run_db(get_user_clients, user_id)
     
     if not clients:
         await query.edit_message_text(
@@ -3323,7 +5046,7 @@ async def handle_booking_flow(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Get client info if available
         client_name = ""
         if client_id:
-            client = get_client_by_id(client_id)
+            client = await run_db(get_client_by_id, client_id)
             client_name = client[2] if client else "Client"
         
         # Store in context
@@ -3341,7 +5064,7 @@ async def handle_booking_flow(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif data.startswith("book_client_"):
         # Client selection
         client_id = int(data.split("_")[2])
-        client = get_client_by_id(client_id)
+        client = await run_db(get_client_by_id, client_id)
         
         if client:
             context.user_data['booking_client_id'] = client_id
@@ -3525,7 +5248,7 @@ async def handle_calendar_navigation(query, data: str, user_id: int):
 
 async def toggle_appointment_reminder(query, appointment_id: int):
     """Toggle reminders for an appointment"""
-    appointment = get_appointment(appointment_id)
+    appointment = await run_db(get_appointment, appointment_id)
     
     if not appointment:
         await query.answer("Appointment not found")
@@ -3535,12 +5258,7 @@ async def toggle_appointment_reminder(query, appointment_id: int):
     new_status = not appointment[9] if appointment[9] is not None else True
     
     # Update database
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE appointments SET reminder_sent = ? WHERE appointment_id = ?', 
-                  (1 if new_status else 0, appointment_id))
-    conn.commit()
-    conn.close()
+    await run_db(set_appointment_reminder_sent, appointment_id, new_status)
     
     if new_status:
         message = "✅ Reminders ENABLED for this appointment"
@@ -3553,14 +5271,14 @@ async def toggle_appointment_reminder(query, appointment_id: int):
 
 async def view_appointment_details(query, appointment_id: int):
     """View detailed information about an appointment"""
-    appointment = get_appointment(appointment_id)
+    appointment = await run_db(get_appointment, appointment_id)
     
     if not appointment:
         await query.answer("Appointment not found")
         return
     
     appt_time = parser.parse(appointment[5])
-    client_name = appointment[12] if len(appointment) > 12 else "Unknown"
+    client_name = appointment.client_name or "Unknown"
     title = appointment[3] or "No title"
     duration = appointment[6] or 60
     status = appointment[8] or 'scheduled'
@@ -3664,7 +5382,7 @@ async def appointments_command(update: Update, context: ContextTypes.DEFAULT_TYP
     today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     next_week = today + timedelta(days=7)
     
-    appointments = get_user_appointments(user_id, today, next_week)
+    appointments = await run_db(get_user_appointments, user_id, today, next_week)
     
     if not appointments:
         await update.message.reply_text(
@@ -3706,7 +5424,7 @@ async def appointments_command(update: Update, context: ContextTypes.DEFAULT_TYP
         
         for appt in appointments_by_date[date_str]:
             appt_time = parser.parse(appt[5])
-            client_name = appt[12] if len(appt) > 12 else "Unknown"
+            client_name = appt.client_name or "Unknown"
             title = appt[3] or "No title"
             
             message += f"• 🕒 {appt_time.strftime('%I:%M %p')} - {title} with {client_name}\n"
@@ -3761,7 +5479,7 @@ async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for appt in appointments:
         appt_time = parser.parse(appt[5])
         end_time = appt_time + timedelta(minutes=appt[6])
-        client_name = appt[12] if len(appt) > 12 else "Unknown"
+        client_name = appt.client_name or "Unknown"
         title = appt[3] or "Meeting"
         
         # Calculate time until appointment
@@ -3846,7 +5564,7 @@ async def week_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             for appt in day_appointments[:3]:  # Show max 3 per day
                 appt_time = parser.parse(appt[5])
-                client_name = appt[12] if len(appt) > 12 else "Unknown"
+                client_name = appt.client_name or "Unknown"
                 title = appt[3] or "Meeting"
                 
                 message += f"• 🕒 {appt_time.strftime('%I:%M %p')} - {title} with {client_name}\n"
@@ -3906,7 +5624,7 @@ async def show_calendar_view(update, context):
     
     # Get appointments for the week
     week_end = week_start + timedelta(days=6)
-    appointments = get_user_appointments(
+    appointments = await run_db(get_user_appointments,
         user_id, 
         datetime.combine(week_start, datetime.min.time()),
         datetime.combine(week_end, datetime.max.time())
@@ -3966,7 +5684,7 @@ async def show_calendar_view(update, context):
         message += f"**Appointments for {selected_date.strftime('%A, %b %d')}:**\n"
         for appt in appointments_by_date[selected_date_str]:
             appt_time = parser.parse(appt[5])
-            client_name = appt[12] if len(appt) > 12 else "Unknown"
+            client_name = appt.client_name or "Unknown"
             title = appt[3] or "Meeting"
             
             message += f"• 🕒 {appt_time.strftime('%I:%M %p')} - {title}\n"
@@ -4032,7 +5750,7 @@ async def reschedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Get upcoming appointments
     today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     next_month = today + timedelta(days=30)
-    appointments = get_user_appointments(user_id, today, next_month, 'scheduled')
+    appointments = await run_db(get_user_appointments, user_id, today, next_month, 'scheduled')
     
     if not appointments:
         await update.message.reply_text(
@@ -4053,7 +5771,7 @@ async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Get upcoming appointments
     today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     next_week = today + timedelta(days=7)
-    appointments = get_user_appointments(user_id, today, next_week, 'scheduled')
+    appointments = await run_db(get_user_appointments, user_id, today, next_week, 'scheduled')
     
     if not appointments:
         await update.message.reply_text(
@@ -4072,7 +5790,7 @@ async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for appt in appointments[:8]:  # Show first 8 appointments
         appt_id = appt[0]
         appt_time = parser.parse(appt[5])
-        client_name = appt[12] if len(appt) > 12 else "Unknown"
+        client_name = appt.client_name or "Unknown"
         title = appt[3] or "Meeting"
         
         # Check if reminder is already set
@@ -4121,7 +5839,7 @@ async def handle_reminder_callback(update: Update, context: ContextTypes.DEFAULT
     
     if data == "reminder_settings":
         # Get current settings and show them
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         default_times = settings.get('default_reminder_times', [24, 2])
         email_notifications = settings.get('email_notifications', True)
         sms_notifications = settings.get('sms_notifications', False)
@@ -4182,27 +5900,27 @@ async def handle_reminder_callback(update: Update, context: ContextTypes.DEFAULT
     
     elif data == "toggle_email_reminders":
         # Toggle email notifications
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['email_notifications'] = not settings.get('email_notifications', True)
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         await query.answer(f"Email reminders {'enabled' if settings['email_notifications'] else 'disabled'}")
         await handle_reminder_callback(update, context)
     
     elif data == "toggle_sms_reminders":
         # Toggle SMS notifications
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['sms_notifications'] = not settings.get('sms_notifications', False)
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         await query.answer(f"SMS reminders {'enabled' if settings['sms_notifications'] else 'disabled'}")
         await handle_reminder_callback(update, context)
     
     elif data == "toggle_call_reminders":
         # Toggle voice call reminders
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['voice_call_reminders'] = not settings.get('voice_call_reminders', False)
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         await query.answer(f"Voice call reminders {'enabled' if settings['voice_call_reminders'] else 'disabled'}")
         await handle_reminder_callback(update, context)
@@ -4255,9 +5973,9 @@ async def handle_reminder_times_input(update: Update, context: ContextTypes.DEFA
         times.sort(reverse=True)
         
         # Save to user settings
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['default_reminder_times'] = times
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         # Clear the flag
         del context.user_data['awaiting_reminder_times']
@@ -4279,7 +5997,7 @@ async def handle_reminder_times_input(update: Update, context: ContextTypes.DEFA
 
 def get_reminder_settings(user_id: int):
     """Get user's reminder settings from database"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -4307,7 +6025,7 @@ def get_reminder_settings(user_id: int):
 
 def save_reminder_settings(user_id: int, settings: dict):
     """Save user's reminder settings to database"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -4336,7 +6054,7 @@ async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Get upcoming appointments
     today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     next_week = today + timedelta(days=7)
-    appointments = get_user_appointments(user_id, today, next_week, 'scheduled')
+    appointments = await run_db(get_user_appointments, user_id, today, next_week, 'scheduled')
     
     if not appointments:
         await update.message.reply_text(
@@ -4355,7 +6073,7 @@ async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for appt in appointments[:8]:  # Show first 8 appointments
         appt_id = appt[0]
         appt_time = parser.parse(appt[5])
-        client_name = appt[12] if len(appt) > 12 else "Unknown"
+        client_name = appt.client_name or "Unknown"
         title = appt[3] or "Meeting"
         
         # Check if reminder is already set
@@ -4405,7 +6123,7 @@ async def handle_reminder_callback(update: Update, context: ContextTypes.DEFAULT
     
     if data == "reminder_settings":
         # Get current settings and show them
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         default_times = settings.get('default_reminder_times', [24, 2])
         email_notifications = settings.get('email_notifications', True)
         sms_notifications = settings.get('sms_notifications', False)
@@ -4466,27 +6184,27 @@ async def handle_reminder_callback(update: Update, context: ContextTypes.DEFAULT
     
     elif data == "toggle_email_reminders":
         # Toggle email notifications
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['email_notifications'] = not settings.get('email_notifications', True)
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         await query.answer(f"Email reminders {'enabled' if settings['email_notifications'] else 'disabled'}")
         await handle_reminder_callback(update, context)
     
     elif data == "toggle_sms_reminders":
         # Toggle SMS notifications
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['sms_notifications'] = not settings.get('sms_notifications', False)
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         await query.answer(f"SMS reminders {'enabled' if settings['sms_notifications'] else 'disabled'}")
         await handle_reminder_callback(update, context)
     
     elif data == "toggle_call_reminders":
         # Toggle voice call reminders
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['voice_call_reminders'] = not settings.get('voice_call_reminders', False)
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         await query.answer(f"Voice call reminders {'enabled' if settings['voice_call_reminders'] else 'disabled'}")
         await handle_reminder_callback(update, context)
@@ -4539,9 +6257,9 @@ async def handle_reminder_times_input(update: Update, context: ContextTypes.DEFA
         times.sort(reverse=True)
         
         # Save to user settings
-        settings = get_reminder_settings(user_id)
+        settings = await run_db(get_reminder_settings, user_id)
         settings['default_reminder_times'] = times
-        save_reminder_settings(user_id, settings)
+        await run_db(save_reminder_settings, user_id, settings)
         
         # Clear the flag
         del context.user_data['awaiting_reminder_times']
@@ -4564,7 +6282,7 @@ async def handle_reminder_times_input(update: Update, context: ContextTypes.DEFA
 # Helper functions for reminders
 def get_reminder_settings(user_id: int):
     """Get user's reminder settings from database"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -4592,7 +6310,7 @@ def get_reminder_settings(user_id: int):
 
 def save_reminder_settings(user_id: int, settings: dict):
     """Save user's reminder settings to database"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
@@ -4954,11 +6672,11 @@ async def show_appointment_confirmation(update, context):
     
     # Get client info
     client_id = appointment_data.get('client_id')
-    client = get_client_by_id(client_id) if client_id else None
+    client = await run_db(get_client_by_id, client_id) if client_id else None
     
     # Get appointment type info
     appt_type = appointment_data.get('type', 'meeting')
-    appt_types = get_appointment_types(user_id)
+    appt_types = await run_db(get_appointment_types, user_id)
     type_info = next((t for t in appt_types if t[2] == appt_type), None)
     
     # Build confirmation message
@@ -5039,15 +6757,15 @@ async def show_appointment_confirmation(update, context):
 async def quote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start creating a new quote"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     
     if not user:
-        create_user(user_id, update.effective_user.username, update.effective_user.first_name, update.effective_user.last_name)
-        user = get_user(user_id)
+        await run_db(create_user, user_id, update.effective_user.username, update.effective_user.first_name, update.effective_user.last_name)
+        user = await run_db(get_user, user_id)
         await update.message.reply_text("✅ Your account has been created! Enjoy your 14-day free trial.")
     
     # Check creation limit (quotes count towards the same limit as invoices)
-    can_create, message = check_invoice_limit(user_id)
+    can_create, message = await run_db(check_invoice_limit, user_id)
     if not can_create:
         await update.message.reply_text(message)
         return
@@ -5060,8 +6778,8 @@ async def quote_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Show remaining creations for free tier
     remaining_info = ""
-    if not is_premium_user(user_id):
-        remaining = get_remaining_invoices(user_id)
+    if not await run_db(is_premium_user, user_id):
+        remaining = await run_db(get_remaining_invoices, user_id)
         remaining_info = f"\n\n📊 You have {remaining} creations remaining this month."
     
     await update.message.reply_text(
@@ -5126,7 +6844,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         invoice_data['currency'] = currency
         
         # FIXED: Only ask about VAT for premium users
-        if is_premium_user(user_id):
+        if await run_db(is_premium_user, user_id):
             keyboard = [
                 [InlineKeyboardButton("✅ Include VAT", callback_data="vat_yes")],
                 [InlineKeyboardButton("❌ No VAT", callback_data="vat_no")]
@@ -5236,8 +6954,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     elif data == 'premium_back':
         # Go back to premium plans
-        current_tier = get_user_tier(user_id)
-        remaining_invoices = get_remaining_invoices(user_id)
+        current_tier, remaining_invoices = await asyncio.gather(
+            run_db(get_user_tier, user_id),
+            run_db(get_remaining_invoices, user_id)
+        )
         
         free_features = "\n".join([f"• {feature}" for feature in TIER_LIMITS['free']['features']])
         premium_features = "\n".join([f"• {feature}" for feature in TIER_LIMITS['premium']['features']])
@@ -5297,11 +7017,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     elif data.startswith('view_client_'):
         client_id = int(data.split('_')[2])
-        client = get_client_by_id(client_id)
+        client = await run_db(get_client_by_id, client_id)
         
         if client:
             # Get invoices for this client
-            client_invoices = get_user_invoices(user_id, client[2])
+            client_invoices = await run_db(get_user_invoices, user_id, client[2])
             
             client_info = f"""
 👤 **Client Details**
@@ -5342,7 +7062,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith('create_invoice_client_'):
         client_id = int(data.split('_')[3])
-        client = get_client_by_id(client_id)
+        client = await run_db(get_client_by_id, client_id)
         
         if client:
             # Start invoice creation with client pre-filled and skip to invoice date step
@@ -5362,7 +7082,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith('create_quote_client_'):
         client_id = int(data.split('_')[3])
-        client = get_client_by_id(client_id)
+        client = await run_db(get_client_by_id, client_id)
         
         if client:
             # Start quote creation with client pre-filled and skip to quote date step
@@ -5383,7 +7103,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith('schedule_client_'):
         client_id = int(data.split('_')[2])
-        client = get_client_by_id(client_id)
+        client = await run_db(get_client_by_id, client_id)
         
         if client:
             # Start scheduling for this client
@@ -5396,7 +7116,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
             
             # Show appointment types
-            appt_types = get_appointment_types(user_id)
+            appt_types = await run_db(get_appointment_types, user_id)
             
             if not appt_types:
                 await query.edit_message_text(
@@ -5438,7 +7158,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['editing_client'] = client_id
         context.user_data['client_edit_step'] = 'name'
         
-        client = get_client_by_id(client_id)
+        client = await run_db(get_client_by_id, client_id)
         if client:
             await query.edit_message_text(
                 f"✏️ **Editing Client: {client[2]}**\n\n"
@@ -5452,7 +7172,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     elif data == 'clients_back':
         # FIXED: Show clients list with safe edit
-        clients = get_user_clients(user_id)
+        clients = await run_db(get_user_clients, user_id)
         
         if not clients:
             keyboard = [
@@ -5576,7 +7296,7 @@ async def handle_appointment_buttons(query, context, data):
         appointment_data = scheduling_data.get('appointment_data', {})
         
         # Get type details
-        appt_types = get_appointment_types(user_id)
+        appt_types = await run_db(get_appointment_types, user_id)
         selected_type = next((t for t in appt_types if t[2] == appt_type), None)
         
         if selected_type:
@@ -5664,7 +7384,7 @@ async def handle_appointment_buttons(query, context, data):
         appointment_datetime = parser.parse(datetime_str)
         
         # Save to database
-        appointment_id = create_appointment(
+        appointment_id = await run_db(create_appointment,
             user_id=user_id,
             client_id=client_id,
             title=title,
@@ -5678,11 +7398,11 @@ async def handle_appointment_buttons(query, context, data):
         
         if appointment_id:
             # Get client info for confirmation
-            client = get_client_by_id(client_id)
+            client = await run_db(get_client_by_id, client_id)
             client_name = client[2] if client else "Unknown"
             
             # Generate appointment summary
-            summary = generate_appointment_summary(appointment_id)
+            summary = await run_db(generate_appointment_summary, appointment_id)
             
             # Create success message
             success_message = f"""
@@ -5718,7 +7438,7 @@ async def handle_appointment_buttons(query, context, data):
             )
             
             # Send email confirmation
-            send_appointment_confirmation(appointment_id)
+            await run_db(send_appointment_confirmation, appointment_id)
         else:
             await query.edit_message_text(
                 "❌ Failed to save appointment. Please try again."
@@ -5772,7 +7492,7 @@ async def handle_appointment_buttons(query, context, data):
         context.user_data['scheduling'] = scheduling_data
         
         # Show clients list
-        clients = get_user_clients(user_id)
+        clients = await run_db(get_user_clients, user_id)
         
         if not clients:
             await query.edit_message_text(
@@ -5807,7 +7527,7 @@ async def handle_appointment_buttons(query, context, data):
         
         if 'client_id' in appointment_data:
             # Get client email
-            client = get_client_by_id(appointment_data['client_id'])
+            client = await run_db(get_client_by_id, appointment_data['client_id'])
             if client and client[3]:  # Email field
                 await query.edit_message_text(
                     "📧 **Sending Confirmation Email...**\n\n"
@@ -5868,6 +7588,20 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"Text input from user {user_id}: {text}")
     
+    # Reply to "🔍 Search Invoices by Client"
+    if context.user_data.pop('awaiting_client_search', False):
+        documents = await run_db(search_documents, user_id, text)
+        if not documents:
+            await update.message.reply_text(f"No invoices or quotes found for: {text}")
+            return
+        
+        message = f"🔍 Results for {text}:\n\n"
+        for doc in documents:
+            icon = "📋" if doc.document_type == 'quote' else "📄"
+            message += f"{icon} {doc.invoice_number or 'No Number'} - {doc.client_name} - {doc.currency or ''}{doc.total_amount or 0:.2f}\n"
+        await update.message.reply_text(message)
+        return
+    
     # Basic response
     response = f"""
 📝 **Message Received**
@@ -5915,10 +7649,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name
     
     # Check/create user
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     if not user:
-        create_user(user_id, update.effective_user.username, 
-                   update.effective_user.first_name, update.effective_user.last_name)
+        await run_db(create_user, user_id, update.effective_user.username, 
+                     update.effective_user.first_name, update.effective_user.last_name)
         welcome_msg = f"🎉 Welcome to Minigma Business Suite, {username}!\n\n"
     else:
         welcome_msg = f"👋 Welcome back, {username}!\n\n"
@@ -5965,6 +7699,12 @@ async def handle_button_callback(update: Update, context: ContextTypes.DEFAULT_T
     
     if data == "help":
         await help_command(update, context)
+    elif data.startswith(f"{DOCUMENT_PAGE_CALLBACK}:"):
+        await handle_document_page_callback(update, context)
+    elif data.startswith(f"{DOCUMENT_PDF_CALLBACK}:"):
+        await handle_document_pdf_callback(update, context)
+    elif data == "export_calendar_pdf":
+        await export_calendar_pdf_callback(update, context)
     elif data == "settings":
         await query.edit_message_text("⚙️ Settings panel coming soon!")
     else:
@@ -6160,45 +7900,40 @@ def send_appointment_email_to_client(appointment_id, email_type="confirmation"):
             return False
         
         # Get user and client info
-        user_id = appointment[1]
-        client_id = appointment[2]
+        user_id = appointment.user_id
+        client_id = appointment.client_id
         
         user_info = get_user(user_id)
         client = get_client_by_id(client_id) if client_id else None
         
-        if not client or not client[3]:  # No email
+        if not client or not client.email:
             logger.warning(f"No email for client in appointment {appointment_id}")
             return False
         
-        client_email = client[3]
-        client_name = client[2]
+        client_email = client.email
+        client_name = client.client_name
         
         # Prepare appointment data
-        appt_date_str = appointment[5]
-        try:
-            appt_date = parser.parse(appt_date_str)
-        except:
-            appt_date = datetime.now()
-            
-        duration = appointment[6] if len(appointment) > 6 else 60
+        appt_date = appointment.starts_at or datetime.now()
+        duration = appointment.duration_minutes or 60
         end_time = appt_date + timedelta(minutes=duration)
         
         appointment_data = {
-            'appointment_id': appointment[0],
+            'appointment_id': appointment.appointment_id,
             'appointment_number': generate_appointment_number(user_id),
-            'title': appointment[3] or 'Appointment',
-            'description': appointment[4] or '',
-            'appointment_date': appointment[5],
+            'title': appointment.title or 'Appointment',
+            'description': appointment.description or '',
+            'appointment_date': appointment.appointment_time,
             'duration_minutes': duration,
-            'appointment_type': appointment[7] if len(appointment) > 7 else 'meeting',
-            'status': appointment[8] if len(appointment) > 8 else 'scheduled'
+            'appointment_type': appointment.appointment_type or 'meeting',
+            'status': appointment.status or 'scheduled'
         }
         
         # Get email template
         template = get_default_email_template(user_id)
         company_name = "Your Business"
-        if user_info and len(user_info) > 8 and user_info[8]:
-            company_name = user_info[8]
+        if user_info and user_info.company_name:
+            company_name = user_info.company_name
         
         # Prepare email content based on type
         if email_type == "confirmation":
@@ -6235,17 +7970,17 @@ def send_appointment_email_to_client(appointment_id, email_type="confirmation"):
             email_type
         )
         
-        # Create PDF attachment
-        pdf_path = None
+        # Create PDF attachment (in memory - nothing is written to appointments/)
+        pdf_data = None
         if email_type == "confirmation":
             try:
                 client_info_dict = {
                     'client_name': client_name, 
                     'email': client_email,
-                    'phone': client[4] if len(client) > 4 else '',
-                    'address': client[5] if len(client) > 5 else ''
+                    'phone': client.phone or '',
+                    'address': client.address or ''
                 }
-                pdf_path = create_appointment_confirmation_pdf(
+                pdf_data = render_appointment_confirmation_pdf(
                     appointment_data, 
                     user_info, 
                     client_info_dict
@@ -6259,14 +7994,15 @@ def send_appointment_email_to_client(appointment_id, email_type="confirmation"):
             subject=subject,
             html_body=html_body,
             text_body=text_body,
-            attachment_path=pdf_path
+            attachment_data=pdf_data,
+            attachment_name=f"{appointment_data.get('appointment_number', 'appointment')}.pdf"
         )
         
         if success:
             logger.info(f"Appointment {email_type} email sent for appointment {appointment_id}")
             
             # Update notification status in database
-            conn = sqlite3.connect('invoices.db')
+            conn = get_db_connection()
             cursor = conn.cursor()
             cursor.execute(
                 'UPDATE appointments SET notification_sent = 1 WHERE appointment_id = ?',
@@ -6319,7 +8055,7 @@ def create_appointment_email_html(appointment_data, client_name, company_name, e
     
     # Company logo
     logo_html = ""
-    if user_info and len(user_info) > 7 and user_info[7]:  # logo_path
+    if user_info and user_info.logo_path:
         try:
             logo_html = f'<img src="cid:company_logo" alt="{company_name}" style="max-width: 200px; height: auto; margin-bottom: 20px;">'
         except:
@@ -6329,10 +8065,8 @@ def create_appointment_email_html(appointment_data, client_name, company_name, e
     user_email = EMAIL_CONFIG['sender_email']
     user_phone = ""
     if user_info:
-        if len(user_info) > 13 and user_info[13]:  # email field
-            user_email = user_info[13]
-        if len(user_info) > 14 and user_info[14]:  # phone field
-            user_phone = user_info[14]
+        user_email = user_info.email or user_email
+        user_phone = user_info.phone or user_phone
     
     html = f"""
     <!DOCTYPE html>
@@ -6561,8 +8295,9 @@ This email was sent by Minigma Business Suite
     
     return text
 
-def send_email_with_attachment(to_email, subject, html_body, text_body, attachment_path=None):
-    """Send email with optional attachment"""
+def send_email_with_attachment(to_email, subject, html_body, text_body, attachment_path=None,
+                               attachment_data=None, attachment_name=None):
+    """Send email with an optional attachment, from a file or from in-memory bytes"""
     try:
         # Check if email is configured
         if not EMAIL_CONFIG.get('sender_email') or not EMAIL_CONFIG.get('sender_password'):
@@ -6580,11 +8315,15 @@ def send_email_with_attachment(to_email, subject, html_body, text_body, attachme
         msg.attach(MIMEText(html_body, 'html'))
         
         # Attach file if provided
-        if attachment_path and os.path.exists(attachment_path):
+        if attachment_data is None and attachment_path and os.path.exists(attachment_path):
             with open(attachment_path, 'rb') as file:
-                part = MIMEApplication(file.read(), Name=os.path.basename(attachment_path))
-                part['Content-Disposition'] = f'attachment; filename="{os.path.basename(attachment_path)}"'
-                msg.attach(part)
+                attachment_data = file.read()
+            attachment_name = attachment_name or os.path.basename(attachment_path)
+        if attachment_data is not None:
+            attachment_name = attachment_name or 'attachment.pdf'
+            part = MIMEApplication(attachment_data, Name=attachment_name)
+            part['Content-Disposition'] = f'attachment; filename="{attachment_name}"'
+            msg.attach(part)
         
         # Connect to SMTP server
         if EMAIL_CONFIG.get('use_ssl', False):
@@ -6759,7 +8498,7 @@ def send_weekly_schedule_emails():
     """Send weekly schedule emails to all users"""
     try:
         # Get all users
-        conn = sqlite3.connect('invoices.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT user_id, email FROM users WHERE email IS NOT NULL')
         users = cursor.fetchall()
@@ -6783,8 +8522,8 @@ def send_weekly_schedule_emails():
                 # Create weekly schedule email
                 user_info = get_user(user_id)
                 company_name = "Your Business"
-                if user_info and len(user_info) > 8 and user_info[8]:
-                    company_name = user_info[8]
+                if user_info and user_info.company_name:
+                    company_name = user_info.company_name
                 
                 # Group appointments by day
                 appointments_by_day = {}
@@ -6831,7 +8570,7 @@ def send_weekly_schedule_emails():
                         except:
                             time_str = "Time N/A"
                             
-                        client_name = appt[12] if len(appt) > 12 else "Unknown"
+                        client_name = appt.client_name or "Unknown"
                         title = appt[3] or "Meeting"
                         duration = appt[6] if len(appt) > 6 else 60
                         appt_type = appt[7] if len(appt) > 7 else "Meeting"
@@ -7153,34 +8892,6 @@ async def safe_edit_message(query, new_text, reply_markup=None, parse_mode=None)
         await query.answer()
         return False
 
-def is_premium_user(user_id):
-    """Check if user has active premium subscription"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT subscription_tier, trial_end_date FROM users WHERE user_id = ?
-    ''', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        return False
-    
-    subscription_tier, trial_end_date = result
-    
-    # Check if user is on premium tier
-    if subscription_tier == 'premium':
-        return True
-    
-    # Check if user is in trial period
-    if trial_end_date:
-        trial_end = parse_trial_end_date(trial_end_date)
-        if datetime.now() <= trial_end:
-            return True
-    
-    return False
-
 def get_user_tier(user_id):
     """Get user's current tier"""
     if is_premium_user(user_id):
@@ -7192,7 +8903,7 @@ def get_remaining_invoices(user_id):
     if is_premium_user(user_id):
         return float('inf')  # Unlimited for premium
     
-    monthly_count = get_user_invoice_count_this_month(user_id) + get_user_quote_count_this_month(user_id)
+    monthly_count = get_monthly_usage(user_id, 'invoice', 'quote')
     remaining = TIER_LIMITS['free']['monthly_invoices'] - monthly_count
     return max(0, remaining)
 
@@ -7201,20 +8912,7 @@ def get_remaining_appointments(user_id):
     if is_premium_user(user_id):
         return float('inf')  # Unlimited for premium
     
-    # Count appointments created this month
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
-    first_day_of_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    first_day_str = first_day_of_month.strftime('%Y-%m-%d %H:%M:%S')
-    
-    cursor.execute('''
-        SELECT COUNT(*) FROM appointments 
-        WHERE user_id = ? AND created_at >= ?
-    ''', (user_id, first_day_str))
-    
-    appointment_count = cursor.fetchone()[0]
-    conn.close()
+    appointment_count = get_monthly_usage(user_id, 'appointment')
     
     remaining = TIER_LIMITS['free']['max_appointments'] - appointment_count
     return max(0, remaining)
@@ -7224,7 +8922,7 @@ def check_invoice_limit(user_id):
     if is_premium_user(user_id):
         return True, ""
 
-    monthly_count = get_user_invoice_count_this_month(user_id) + get_user_quote_count_this_month(user_id)
+    monthly_count = get_monthly_usage(user_id, 'invoice', 'quote')
     remaining = TIER_LIMITS['free']['monthly_invoices'] - monthly_count
     
     if remaining <= 0:
@@ -7293,22 +8991,21 @@ def can_set_working_hours(user_id):
 # Quote-specific database functions
 def save_quote_draft(user_id, client_name, quote_date, currency, items, client_email=None, client_phone=None):
     """Save quote draft to database"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
-    items_json = json.dumps(items)  # Use json.dumps for proper serialization
-    
     # Calculate total
     total_amount = sum(item['quantity'] * item['amount'] for item in items)
     
     print(f"DEBUG: Saving quote draft - User: {user_id}, Client: {client_name}")
     
     cursor.execute('''
-        INSERT INTO invoices (user_id, client_name, invoice_date, currency, items, 
+        INSERT INTO invoices (user_id, client_name, invoice_date, currency, 
                             total_amount, status, client_email, client_phone, document_type)
-        VALUES (?, ?, ?, ?, ?, ?, 'draft', ?, ?, 'quote')
-    ''', (user_id, client_name, quote_date, currency, items_json, total_amount, client_email, client_phone))
+        VALUES (?, ?, ?, ?, ?, 'draft', ?, ?, 'quote')
+    ''', (user_id, client_name, quote_date, currency, total_amount, client_email, client_phone))
     
     quote_id = cursor.lastrowid
+    save_invoice_items(cursor, quote_id, items)
     conn.commit()
     conn.close()
     
@@ -7317,35 +9014,25 @@ def save_quote_draft(user_id, client_name, quote_date, currency, items, client_e
 
 def get_quote(quote_id):
     """Get quote by ID"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Invoice)
     cursor.execute('SELECT * FROM invoices WHERE invoice_id = ? AND document_type = "quote"', (quote_id,))
     quote = cursor.fetchone()
-    
-    # Parse items JSON back to Python object
-    if quote and len(quote) > 5 and quote[5]:
-        try:
-            # Create a mutable list version to modify items
-            quote_list = list(quote)
-            quote_list[5] = json.loads(quote[5]) if isinstance(quote[5], str) else quote[5]
-            quote = tuple(quote_list)
-        except json.JSONDecodeError:
-            logger.warning(f"Failed to parse items JSON for quote {quote_id}")
-    
+    if quote:
+        quote.items = load_invoice_items(conn.cursor(), quote_id)
     conn.close()
     return quote
 
 def generate_quote_number(user_id):
     """Generate unique quote number"""
-    counter = get_invoice_counter(user_id)
+    counter = next_invoice_counter(user_id)
     now = datetime.now()
-    quote_number = f"QUO-{now.year}-{now.month:02d}-{counter:04d}"
-    increment_invoice_counter(user_id)
-    return quote_number
+    return f"QUO-{now.year}-{now.month:02d}-{counter:04d}"
 
 def update_quote_status(quote_id, status, quote_number=None):
     """Update quote status"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     if quote_number:
         cursor.execute('''
@@ -7357,17 +9044,20 @@ def update_quote_status(quote_id, status, quote_number=None):
         ''', (status, quote_id))
     conn.commit()
     conn.close()
+    pdf_cache.invalidate_document(quote_id)
 
 def get_user_quotes(user_id, client_name=None):
     """Get user's quotes"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Invoice)
     if client_name:
-        cursor.execute('''
+        condition, params = invoice_client_condition(client_name, user_id)
+        cursor.execute(f'''
             SELECT * FROM invoices 
-            WHERE user_id = ? AND client_name LIKE ? AND status = 'approved' AND document_type = 'quote'
+            WHERE user_id = ? AND {condition} AND status = 'approved' AND document_type = 'quote'
             ORDER BY created_at DESC
-        ''', (user_id, f'%{client_name}%'))
+        ''', (user_id, *params))
     else:
         cursor.execute('''
             SELECT * FROM invoices 
@@ -7375,41 +9065,22 @@ def get_user_quotes(user_id, client_name=None):
             ORDER BY created_at DESC
         ''', (user_id,))
     quotes = cursor.fetchall()
-    
-    # Parse items JSON for each quote
-    parsed_quotes = []
-    for quote in quotes:
-        if len(quote) > 5 and quote[5]:
-            try:
-                quote_list = list(quote)
-                quote_list[5] = json.loads(quote[5]) if isinstance(quote[5], str) else quote[5]
-                parsed_quotes.append(tuple(quote_list))
-            except json.JSONDecodeError:
-                parsed_quotes.append(quote)
-        else:
-            parsed_quotes.append(quote)
-    
     conn.close()
-    return parsed_quotes
+    return quotes
 
 def get_user_quote_count_this_month(user_id):
     """Get number of quotes created this month"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    first_day_of_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    first_day_str = first_day_of_month.strftime('%Y-%m-%d %H:%M:%S')
-    
-    cursor.execute('''
-        SELECT COUNT(*) FROM invoices 
-        WHERE user_id = ? AND status = 'approved' AND created_at >= ? AND document_type = 'quote'
-    ''', (user_id, first_day_str))
-    
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    return get_monthly_usage(user_id, 'quote')
 
 def create_quote_pdf(quote_data, user_info):
-    """Create PDF for quote"""
+    """Create PDF for quote and save it under quotes/"""
+    pdf_data = render_quote_pdf(quote_data, user_info)
+    pdf_file = save_pdf(pdf_data, f"quotes/{quote_data.get('quote_number', 'N/A')}.pdf")
+    logger.info(f"Quote PDF generated successfully: {pdf_file}")
+    return pdf_file
+
+def render_quote_pdf(quote_data, user_info) -> bytes:
+    """Build the quote PDF in memory"""
     try:
         # Use the same PDF creation as invoice but with quote-specific text
         buffer = io.BytesIO()
@@ -7448,19 +9119,11 @@ def create_quote_pdf(quote_data, user_info):
         
         # Header section
         company_name = ""
-        has_logo = False
-        if user_info and len(user_info) > 8:
-            company_name = user_info[8] if user_info[8] else ''
+        if user_info:
+            company_name = user_info.company_name or ''
         
-        if user_info and len(user_info) > 7 and user_info[7]:  # logo_path
-            logo_path = user_info[7]
-            if os.path.exists(logo_path):
-                try:
-                    logo = Image(logo_path, width=2.5*inch, height=1.25*inch)
-                    has_logo = True
-                except Exception as e:
-                    logger.warning(f"Could not load logo: {e}")
-                    has_logo = False
+        logo = get_logo_image(user_info.logo_path if user_info else None, 2.5*inch, 1.25*inch)
+        has_logo = logo is not None
         
         header_data = []
         
@@ -7488,8 +9151,8 @@ def create_quote_pdf(quote_data, user_info):
         
         # Company registration numbers if available
         reg_data = []
-        if user_info and len(user_info) > 9 and user_info[9]:  # company_reg_number
-            reg_data.append(Paragraph(f"<b>Company Reg:</b> {user_info[9]}", normal_style))
+        if user_info and user_info.company_reg_number:
+            reg_data.append(Paragraph(f"<b>Company Reg:</b> {user_info.company_reg_number}", normal_style))
         
         if reg_data:
             for reg in reg_data:
@@ -7635,58 +9298,104 @@ def create_quote_pdf(quote_data, user_info):
         
         pdf_data = buffer.getvalue()
         buffer.close()
-        
-        os.makedirs('quotes', exist_ok=True)
-        pdf_file = f"quotes/{quote_number}.pdf"
-        with open(pdf_file, 'wb') as f:
-            f.write(pdf_data)
-        
-        logger.info(f"Quote PDF generated successfully: {pdf_file}")
-        return pdf_file
+        return pdf_data
         
     except Exception as e:
         logger.error(f"Quote PDF generation error: {e}")
         raise
 
-# My Quotes command
+# My Invoices / My Quotes commands
+DOCUMENT_PAGE_CALLBACK = 'docpage'  # callback_data: docpage:<document_type>:<cursor>
+DOCUMENT_PDF_CALLBACK = 'docpdf'  # callback_data: docpdf:<invoice_id>
+
+async def show_document_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             document_type: str, after: Optional[Tuple[str, int]] = None):
+    """Show one page of invoices or quotes with a Next button when there are more"""
+    user_id = update.effective_user.id
+    client_name = context.user_data.get('document_filters', {}).get(document_type)
+    documents, next_cursor = await run_db(get_document_page, user_id, document_type, client_name, after)
+    label = 'quotes' if document_type == 'quote' else 'invoices'
+    
+    if not documents:
+        if after:
+            message = f"No more {label}."
+        elif client_name:
+            message = f"No {label} found for client: {client_name}"
+        else:
+            message = f"You haven't created any approved {label} yet."
+    else:
+        if client_name:
+            message = f"📋 {label.capitalize()} for {client_name}:\n\n"
+        else:
+            message = f"📋 Your Recent {label.capitalize()}:\n\n"
+        for document in documents:
+            number = document.invoice_number or "No Number"
+            document_date = document.invoice_date or "No Date"
+            message += f"• {number} - {document_date} - {document.currency or ''}{document.total_amount or 0:.2f}\n"
+        
+        if not after and not client_name and await run_db(is_premium_user, user_id):
+            command = 'myquotes' if document_type == 'quote' else 'myinvoices'
+            message += f"\n💡 *Tip: Use* `/{command} ClientName` *to filter by client*"
+    
+    # One PDF button per listed document, then Next
+    keyboard = [[InlineKeyboardButton(
+        f"📄 {document.invoice_number or 'No Number'}",
+        callback_data=f"{DOCUMENT_PDF_CALLBACK}:{document.invoice_id}"
+    )] for document in documents]
+    if next_cursor:
+        keyboard.append([InlineKeyboardButton(
+            "Next ▶️", callback_data=f"{DOCUMENT_PAGE_CALLBACK}:{document_type}:{next_cursor}"
+        )])
+    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    
+    if update.callback_query:
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    else:
+        await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def show_documents_command(update: Update, context: ContextTypes.DEFAULT_TYPE, document_type: str):
+    """Start a paged listing; arguments filter by client name"""
+    filters_by_type = context.user_data.setdefault('document_filters', {})
+    filters_by_type[document_type] = ' '.join(context.args) if context.args else None
+    await show_document_page(update, context, document_type)
+
+async def my_invoices_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show user's invoices"""
+    await show_documents_command(update, context, 'invoice')
+
 async def my_quotes_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's quotes"""
+    await show_documents_command(update, context, 'quote')
+
+async def handle_document_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Next button on /myinvoices and /myquotes"""
+    _, document_type, token = update.callback_query.data.split(':', 2)
+    after = decode_page_cursor(token)
+    if document_type not in ('invoice', 'quote') or not after:
+        await update.callback_query.edit_message_text("❌ This list has expired. Please run the command again.")
+        return
+    await show_document_page(update, context, document_type, after)
+
+async def handle_document_pdf_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """📄 button on /myinvoices and /myquotes: send that document's PDF"""
+    query = update.callback_query
     user_id = update.effective_user.id
+    document_id = query.data.split(':', 1)[1]
     
-    # Check if user wants to search by client
-    if context.args:
-        client_name = ' '.join(context.args)
-        quotes = get_user_quotes(user_id, client_name)
-        if quotes:
-            message = f"📋 Quotes for {client_name}:\n\n"
-            for quote in quotes:
-                if len(quote) > 2:
-                    quote_num = quote[2] if quote[2] else "No Number"
-                    quote_date = quote[3] if len(quote) > 3 else "No Date"
-                    total = quote[7] if len(quote) > 7 else 0
-                    currency = quote[6] if len(quote) > 6 else ""
-                    message += f"• {quote_num} - {quote_date} - {currency}{total:.2f}\n"
-        else:
-            message = f"No quotes found for client: {client_name}"
-    else:
-        quotes = get_user_quotes(user_id)
-        if not quotes:
-            await update.message.reply_text("You haven't created any approved quotes yet.")
-            return
-        
-        message = "📋 Your Recent Quotes:\n\n"
-        for quote in quotes[:10]:  # Show last 10 quotes
-            if len(quote) > 2:
-                quote_num = quote[2] if quote[2] else "No Number"
-                quote_date = quote[3] if len(quote) > 3 else "No Date"
-                total = quote[7] if len(quote) > 7 else 0
-                currency = quote[6] if len(quote) > 6 else ""
-                message += f"• {quote_num} - {quote_date} - {currency}{total:.2f}\n"
-        
-        if is_premium_user(user_id):
-            message += "\n💡 *Tip: Use* `/myquotes ClientName` *to filter by client*"
+    document = await run_db(get_invoice, int(document_id)) if document_id.isdigit() else None
+    if not document or document.user_id != user_id or document.status != 'approved':
+        await query.message.reply_text("❌ That document is no longer available.")
+        return
     
-    await update.message.reply_text(message, parse_mode='Markdown')
+    document_type = document.document_type or 'invoice'
+    user_info = await run_db(get_user, user_id)
+    try:
+        await send_document_pdf(context.bot, query.message.chat_id, document_type, document.invoice_id,
+                                document_pdf_data(document), user_info)
+    except PdfRenderBusy:
+        await query.message.reply_text("⏳ Lots of PDFs are being generated right now. Please try again in a minute.")
+    except asyncio.TimeoutError:
+        await query.message.reply_text(f"❌ Generating the {document_type} PDF took too long. Please try again.")
 
 # ==================================================
 # ENHANCED PREMIUM COMMAND WITH SCHEDULING FEATURES
@@ -7695,9 +9404,11 @@ async def my_quotes_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show premium features and subscription options"""
     user_id = update.effective_user.id
-    current_tier = get_user_tier(user_id)
-    remaining_invoices = get_remaining_invoices(user_id)
-    remaining_appointments = get_remaining_appointments(user_id)
+    current_tier, remaining_invoices, remaining_appointments = await asyncio.gather(
+        run_db(get_user_tier, user_id),
+        run_db(get_remaining_invoices, user_id),
+        run_db(get_remaining_appointments, user_id)
+    )
     
     if current_tier == 'premium':
         await update.message.reply_text(
@@ -7771,17 +9482,17 @@ async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check appointment limit
-    can_schedule, message = check_appointment_limit(user_id)
+    can_schedule, message = await run_db(check_appointment_limit, user_id)
     if not can_schedule:
         await update.message.reply_text(message)
         return
     
     # Check if user has existing clients
-    clients = get_user_clients(user_id)
+    clients = await run_db(get_user_clients, user_id)
     
     if not clients:
         # Check client limit
-        can_add_client, client_message = check_client_limit(user_id)
+        can_add_client, client_message = await run_db(check_client_limit, user_id)
         if not can_add_client:
             await update.message.reply_text(client_message)
             return
@@ -7820,8 +9531,8 @@ async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ])
     
     remaining_info = ""
-    if not is_premium_user(user_id):
-        remaining_appts = get_remaining_appointments(user_id)
+    if not await run_db(is_premium_user, user_id):
+        remaining_appts = await run_db(get_remaining_appointments, user_id)
         remaining_info = f"\n\n📊 You have {remaining_appts} appointments remaining this month."
     
     await update.message.reply_text(
@@ -7836,7 +9547,7 @@ async def calendar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show interactive calendar view with premium features"""
     user_id = update.effective_user.id
     
-    if not is_premium_user(user_id):
+    if not await run_db(is_premium_user, user_id):
         # Free tier: Show basic calendar
         await show_basic_calendar(update, context)
     else:
@@ -7850,7 +9561,7 @@ async def show_basic_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Get appointments for next 7 days
     next_week = today + timedelta(days=7)
-    appointments = get_user_appointments(user_id, today, next_week)
+    appointments = await run_db(get_user_appointments, user_id, today, next_week)
     
     message = "🗓️ **Calendar View (Free Tier)**\n\n"
     message += f"📅 *{today.strftime('%B %d, %Y')} - {next_week.strftime('%B %d, %Y')}*\n\n"
@@ -7888,7 +9599,7 @@ async def show_basic_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE
                 except:
                     time_str = "Time N/A"
                     
-                client_name = appt[12] if len(appt) > 12 else "Unknown"
+                client_name = appt.client_name or "Unknown"
                 title = appt[3] or "Meeting"
                 
                 message += f"• {time_str} - {title[:20]} with {client_name[:15]}\n"
@@ -7937,7 +9648,7 @@ async def recurring_appointments_command(update: Update, context: ContextTypes.D
     """Create recurring appointments (Premium only)"""
     user_id = update.effective_user.id
     
-    if not can_create_recurring_appointments(user_id):
+    if not await run_db(can_create_recurring_appointments, user_id):
         await update.message.reply_text(
             "❌ **Premium Feature: Recurring Appointments**\n\n"
             "Create appointments that repeat daily, weekly, or monthly.\n\n"
@@ -7963,7 +9674,7 @@ async def export_calendar_command(update: Update, context: ContextTypes.DEFAULT_
     """Export calendar data (Premium only)"""
     user_id = update.effective_user.id
     
-    if not can_use_calendar_export(user_id):
+    if not await run_db(can_use_calendar_export, user_id):
         await update.message.reply_text(
             "❌ **Premium Feature: Calendar Export**\n\n"
             "Export your calendar to PDF or CSV format.\n\n"
@@ -7996,6 +9707,55 @@ async def export_calendar_command(update: Update, context: ContextTypes.DEFAULT_
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+async def export_calendar_pdf_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Render the next 30 days as a calendar PDF on the render pool and send it"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    if not await run_db(can_use_calendar_export, user_id):
+        await query.edit_message_text("❌ Calendar export is a Premium feature. Use /premium to upgrade!")
+        return
+    
+    start_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    end_date = start_date + timedelta(days=30)
+    appointments, user_info = await asyncio.gather(
+        run_db(get_user_appointments, user_id, start_date, end_date),
+        run_db(get_user, user_id)
+    )
+    if not appointments:
+        await query.edit_message_text("📭 No appointments in the next 30 days to export.")
+        return
+    
+    await query.edit_message_text("⏳ Generating your calendar PDF...")
+    
+    # Same appointments and branding as a previous export: resend its file_id
+    export_data = {
+        'user_id': user_id,
+        'start_date': start_date,
+        'end_date': end_date,
+        'appointments': [appointment.as_dict() for appointment in appointments]
+    }
+    
+    async def render():
+        pdf_data = await pdf_renderer.render(render_calendar_export_pdf, user_id, start_date, end_date)
+        if not pdf_data:
+            raise ValueError("calendar export rendered no PDF")
+        return pdf_data
+    
+    try:
+        content_hash = await asyncio.to_thread(pdf_cache.key, 'calendar', export_data, user_info)
+        await send_cached_file(
+            context.bot, query.message.chat_id, content_hash, 'calendar', render,
+            filename=calendar_export_filename(user_id, start_date, end_date),
+            caption="📅 Your calendar for the next 30 days"
+        )
+    except PdfRenderBusy:
+        await query.edit_message_text("⏳ Lots of PDFs are being generated right now. Please try again in a minute.")
+    except asyncio.TimeoutError:
+        await query.edit_message_text("❌ Generating the calendar PDF took too long. Please try again.")
+    except ValueError:
+        await query.edit_message_text("❌ Could not generate the calendar PDF. Please try again.")
+
 # ==================================================
 # PREMIUM DECORATORS FOR APPOINTMENT FEATURES
 # ==================================================
@@ -8071,66 +9831,175 @@ def create_stripe_checkout_session(user_id, price_id, success_url, cancel_url):
         logger.error(f"Stripe error: {e}")
         return None
 
+# Stripe webhooks are acknowledged as soon as they are verified and stored;
+# process_stripe_events applies them later on a JobQueue worker. The event ID
+# is the primary key, so Stripe's redeliveries of an event are ignored.
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+STRIPE_EVENT_POLL_SECONDS = int(os.getenv('STRIPE_EVENT_POLL_SECONDS', '10'))
+
+def record_stripe_event(event_id: str, event_type: str, payload: str) -> bool:
+    """Store a verified webhook event; False if this event ID was already received"""
+    with db_connection() as conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO stripe_events (event_id, event_type, payload)
+            VALUES (?, ?, ?)
+        ''', (event_id, event_type, payload))
+        return cursor.rowcount == 1
+
 def handle_stripe_webhook(payload, sig_header):
-    """Handle Stripe webhook for payment confirmation"""
+    """Verify a Stripe webhook delivery and queue it for processing
+
+    Returns True when the delivery should be acknowledged (new or duplicate).
+    """
     try:
         if not PAYMENT_CONFIG.get('enabled', False):
             return False
             
         import stripe
-        stripe.api_key = PAYMENT_CONFIG['stripe_secret_key']
         
         event = stripe.Webhook.construct_event(
             payload, sig_header, PAYMENT_CONFIG['webhook_secret']
         )
         
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            user_id = session['client_reference_id']
-            
-            # Determine subscription period
-            subscription_id = session.get('subscription')
-            if subscription_id:
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                interval = subscription['items']['data'][0]['plan']['interval']
-                months = 12 if interval == 'year' else 1
-            else:
-                months = 1
-            
-            # Activate premium for user
-            add_premium_subscription(user_id, 'paid', months)
-            
-            logger.info(f"Premium activated for user {user_id} ({months} month(s))")
-            
-            # Send confirmation message
-            try:
-                from telegram import Bot
-                bot = Bot(token=BOT_TOKEN)
-                bot.send_message(
-                    chat_id=user_id,
-                    text=f"🎉 **Premium Activated!**\n\n"
-                         f"Thank you for upgrading to Minigma Premium!\n\n"
-                         f"✨ **You now have access to:**\n"
-                         f"• Unlimited invoices & quotes\n"
-                         f"• Advanced appointment scheduling\n"
-                         f"• Client database\n"
-                         f"• Payment tracking\n"
-                         f"• Email/SMS delivery\n\n"
-                         f"Use /setup to configure company details\n"
-                         f"Use /schedule for advanced appointments\n"
-                         f"Use /clients to manage your database\n\n"
-                         f"Welcome to the Premium Suite!",
-                    parse_mode='Markdown'
-                )
-            except Exception as e:
-                logger.error(f"Failed to send premium confirmation: {e}")
-            
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        if record_stripe_event(event['id'], event['type'], payload):
+            logger.info(f"📥 Queued Stripe event {event['id']} ({event['type']})")
+        else:
+            logger.info(f"Duplicate Stripe event {event['id']} ignored")
         return True
         
+    except ImportError:
+        logger.error("Stripe not installed. Install with: pip install stripe")
+        return False
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return False
 
+def apply_stripe_event(event) -> Optional[Tuple[int, int]]:
+    """Grant premium for a completed checkout; returns (user_id, months) or None"""
+    if event['type'] != 'checkout.session.completed':
+        return None
+    
+    session = event['data']['object']
+    user_id = int(session['client_reference_id'])
+    
+    # Determine subscription period
+    months = (session.get('metadata') or {}).get('months')
+    if months:
+        months = int(months)
+    elif session.get('subscription'):
+        import stripe
+        stripe.api_key = PAYMENT_CONFIG['stripe_secret_key']
+        subscription = stripe.Subscription.retrieve(session['subscription'])
+        interval = subscription['items']['data'][0]['plan']['interval']
+        months = 12 if interval == 'year' else 1
+    else:
+        months = 1
+    
+    # Activate premium for user
+    add_premium_subscription(user_id, 'paid', months)
+    logger.info(f"Premium activated for user {user_id} ({months} month(s))")
+    return user_id, months
+
+def process_stripe_events(limit: int = 50) -> List[Tuple[int, int]]:
+    """Apply pending webhook events, oldest first; returns the premium activations
+
+    Delivery is at-least-once: an event is marked processed after its grant,
+    so a crash in between replays it (the grant is an idempotent upsert).
+    Failing events are retried up to STRIPE_EVENT_MAX_ATTEMPTS times.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT event_id, payload FROM stripe_events
+        WHERE status = 'pending'
+        ORDER BY received_at
+        LIMIT ?
+    ''', (limit,))
+    events = cursor.fetchall()
+    conn.close()
+    
+    activations = []
+    for event_id, payload in events:
+        try:
+            activation = apply_stripe_event(json.loads(payload))
+        except Exception as e:
+            logger.error(f"Stripe event {event_id} failed: {e}")
+            with db_connection() as conn:
+                conn.execute('''
+                    UPDATE stripe_events
+                    SET attempts = attempts + 1, last_error = ?,
+                        status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                    WHERE event_id = ?
+                ''', (str(e), STRIPE_EVENT_MAX_ATTEMPTS, event_id))
+            continue
+        
+        with db_connection() as conn:
+            conn.execute('''
+                UPDATE stripe_events
+                SET status = 'processed', attempts = attempts + 1, processed_at = CURRENT_TIMESTAMP
+                WHERE event_id = ?
+            ''', (event_id,))
+        if activation:
+            activations.append(activation)
+    
+    return activations
+
+async def process_stripe_events_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue worker: apply queued Stripe events and confirm activations"""
+    # Subscription.retrieve is a network call, so keep it off the DB executor
+    activations = await asyncio.to_thread(process_stripe_events)
+    
+    for user_id, months in activations:
+        # Send confirmation message
+        try:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"🎉 **Premium Activated!**\n\n"
+                     f"Thank you for upgrading to Minigma Premium!\n\n"
+                     f"✨ **You now have access to:**\n"
+                     f"• Unlimited invoices & quotes\n"
+                     f"• Advanced appointment scheduling\n"
+                     f"• Client database\n"
+                     f"• Payment tracking\n"
+                     f"• Email/SMS delivery\n\n"
+                     f"Use /setup to configure company details\n"
+                     f"Use /schedule for advanced appointments\n"
+                     f"Use /clients to manage your database\n\n"
+                     f"Welcome to the Premium Suite!",
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"Failed to send premium confirmation: {e}")
+
+def fake_stripe_event(user_id, months=1, event_type='checkout.session.completed', event_id=None) -> str:
+    """JSON body shaped like a Stripe webhook delivery, for exercising the pipeline locally"""
+    return json.dumps({
+        'id': event_id or f"evt_test_{uuid.uuid4().hex[:24]}",
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()),
+        'livemode': False,
+        'data': {
+            'object': {
+                'id': f"cs_test_{uuid.uuid4().hex[:24]}",
+                'object': 'checkout.session',
+                'client_reference_id': str(user_id),
+                'subscription': None,
+                'metadata': {'user_id': str(user_id), 'feature': 'premium_suite', 'months': str(months)}
+            }
+        }
+    })
+
+def sign_stripe_payload(payload: str, secret: Optional[str] = None, timestamp: Optional[int] = None) -> str:
+    """Stripe-Signature header for payload, computed the way Stripe signs deliveries"""
+    secret = secret or PAYMENT_CONFIG['webhook_secret']
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode('utf-8'), f"{timestamp}.{payload}".encode('utf-8'),
+                         hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
 # ==================================================
 # UPDATED BUTTON HANDLER FOR PREMIUM PAYMENTS
 # ==================================================
@@ -8139,7 +10008,10 @@ async def handle_premium_payment(query, user_id, plan_type):
     """Handle premium payment selection"""
     if plan_type == 'trial':
         # Activate free trial
-        add_premium_subscription(user_id, 'trial', 1)
+        success, message = await run_db(add_premium_subscription, user_id, 'trial', 1)
+        if not success:
+            await query.edit_message_text(message)
+            return
         
         await query.edit_message_text(
             "🎉 **Premium Trial Activated!**\n\n"
@@ -8272,20 +10144,10 @@ def premium_required(feature_name):
         return wrapper
     return decorator
 
-# Update database initialization to include document_type column
+# document_type is now added by schema migration 002; kept for existing callers
 def update_database_for_quotes():
-    """Add document_type column to invoices table for quote support"""
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("ALTER TABLE invoices ADD COLUMN document_type TEXT DEFAULT 'invoice'")
-        print("✅ Added document_type column to invoices table")
-    except sqlite3.OperationalError:
-        print("✅ document_type column already exists")
-    
-    conn.commit()
-    conn.close()
+    """Ensure the invoices table supports quotes (document_type column)"""
+    run_migrations()
 
 print("✅ Part 8 updated with comprehensive premium tier system and scheduling features!")
 # ==================================================
@@ -8296,180 +10158,190 @@ import datetime
 import json
 
 class PremiumManager:
-    def __init__(self, filename='premium_users.json'):
-        self.filename = filename
-        self.premium_users = {}  # user_id: {'type': 'trial/paid', 'expires': date, 'features': []}
-        self.load_premium_users()
-    
-    def load_premium_users(self):
-        """Load premium users from JSON file"""
-        try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    self.premium_users = json.load(f)
-                print(f"✅ Loaded {len(self.premium_users)} premium users from JSON file")
-            else:
-                self.save_premium_users()
-                print("✅ Created new premium users JSON file")
-        except Exception as e:
-            print(f"❌ Error loading premium users: {e}")
-            # Fallback to simple text file
-            self.load_premium_users_fallback()
+    """Premium subscriptions, stored in the premium_users table (migration 009)
+
+    Lookups are primary-key or expires_at range reads and never write;
+    expired rows stay until remove_premium_user() and simply stop counting
+    as active. Every change also updates users.subscription_tier in the same
+    transaction, and expire_lapsed_users() moves it back to 'free' once a
+    subscription has run out.
+    """
     
-    def load_premium_users_fallback(self):
-        """Fallback to simple text file if JSON fails"""
-        try:
-            txt_file = 'premium_users.txt'
-            if os.path.exists(txt_file):
-                with open(txt_file, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('#'):
-                            parts = line.split('|')
-                            if len(parts) > 0:
-                                user_id = parts[0].strip()
-                                if user_id.isdigit():
-                                    user_id = int(user_id)
-                                    self.premium_users[str(user_id)] = {
-                                        'type': 'paid',
-                                        'expires': None,
-                                        'activated': datetime.datetime.now().strftime("%Y-%m-%d"),
-                                        'features': ['all']
-                                    }
-                print(f"✅ Loaded {len(self.premium_users)} premium users from fallback file")
-        except Exception as e:
-            print(f"❌ Fallback load failed: {e}")
+    def _today(self):
+        return date.today().isoformat()
     
-    def save_premium_users(self):
-        """Save premium users to JSON file"""
-        try:
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(self.premium_users, f, indent=2, default=str)
-            return True
-        except Exception as e:
-            print(f"❌ Error saving premium users: {e}")
-            return False
+    def _row_to_data(self, row):
+        premium_type, username, activated, expires_at, features, months = row
+        return {
+            'type': premium_type,
+            'expires': expires_at,
+            'activated': activated,
+            'username': username or '',
+            'features': json.loads(features) if features else [],
+            'months': months
+        }
     
     def is_premium(self, user_id):
         """Check if user has active premium access"""
         try:
-            user_id = str(user_id)
-            
-            if user_id not in self.premium_users:
-                return False
-            
-            user_data = self.premium_users[user_id]
-            
-            # Check if subscription has expired
-            if user_data.get('expires'):
-                expires_date = datetime.datetime.strptime(user_data['expires'], "%Y-%m-%d").date()
-                if datetime.datetime.now().date() > expires_date:
-                    # Subscription expired, remove from premium
-                    del self.premium_users[user_id]
-                    self.save_premium_users()
-                    return False
-            
-            return True
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT 1 FROM premium_users
+                WHERE user_id = ? AND (expires_at IS NULL OR expires_at >= ?)
+            ''', (int(user_id), self._today()))
+            active = cursor.fetchone() is not None
+            conn.close()
+            return active
         except Exception as e:
             print(f"Error in is_premium for user {user_id}: {e}")
             return False
     
     def get_user_data(self, user_id):
         """Get premium user data"""
-        user_id = str(user_id)
-        return self.premium_users.get(user_id, {})
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT premium_type, username, activated, expires_at, features, months
+            FROM premium_users WHERE user_id = ?
+        ''', (int(user_id),))
+        row = cursor.fetchone()
+        conn.close()
+        return self._row_to_data(row) if row else {}
     
     def add_premium_user(self, user_id, username="", premium_type='trial', months=1, features=None):
-        """Add a new premium user"""
-        user_id = str(user_id)
+        """Add a new premium user (or renew an existing one)"""
+        user_id = int(user_id)
         
         if features is None:
             features = ['invoices', 'quotes', 'appointments', 'clients', 'payments', 'emails', 'sms']
         
         # Calculate expiration date
-        today = datetime.datetime.now().date()
-        if premium_type == 'trial':
-            expires_date = today + datetime.timedelta(days=30*months)  # Trial months
-        else:
-            expires_date = today + datetime.timedelta(days=30*months)  # Paid months
-        
-        user_data = {
-            'type': premium_type,
-            'expires': expires_date.strftime("%Y-%m-%d"),
-            'activated': today.strftime("%Y-%m-%d"),
-            'username': username,
-            'features': features,
-            'months': months
-        }
+        today = date.today()
+        expires_date = today + timedelta(days=30*months)
         
-        self.premium_users[user_id] = user_data
-        self.save_premium_users()
-        
-        # Also update database
         try:
-            conn = sqlite3.connect('invoices.db')
-            cursor = conn.cursor()
-            cursor.execute('UPDATE users SET subscription_tier = ? WHERE user_id = ?', ('premium', user_id))
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            print(f"Note: Could not update database for user {user_id}: {e}")
+            with db_connection() as conn:
+                conn.execute('''
+                    INSERT INTO premium_users
+                    (user_id, premium_type, username, activated, expires_at, features, months)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        premium_type = excluded.premium_type,
+                        username = excluded.username,
+                        activated = excluded.activated,
+                        expires_at = excluded.expires_at,
+                        features = excluded.features,
+                        months = excluded.months
+                ''', (user_id, premium_type, username, today.strftime("%Y-%m-%d"),
+                      expires_date.strftime("%Y-%m-%d"), json.dumps(features), months))
+                conn.execute('UPDATE users SET subscription_tier = ? WHERE user_id = ?', ('premium', user_id))
+        except sqlite3.Error as e:
+            print(f"❌ Error saving premium user {user_id}: {e}")
+            return False, f"❌ Could not add premium user {user_id}"
+        entitlements.invalidate(user_id)
         
         return True, f"✅ User {user_id} added as {premium_type} premium user (expires: {expires_date.strftime('%Y-%m-%d')})"
     
     def remove_premium_user(self, user_id):
         """Remove a user from premium access"""
-        user_id = str(user_id)
-        
-        if user_id not in self.premium_users:
-            return False, "User not in premium list"
-        
-        del self.premium_users[user_id]
-        self.save_premium_users()
+        user_id = int(user_id)
         
-        # Update database
         try:
-            conn = sqlite3.connect('invoices.db')
-            cursor = conn.cursor()
-            cursor.execute('UPDATE users SET subscription_tier = ? WHERE user_id = ?', ('free', user_id))
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            print(f"Note: Could not update database for user {user_id}: {e}")
+            with db_connection() as conn:
+                cursor = conn.execute('DELETE FROM premium_users WHERE user_id = ?', (user_id,))
+                if cursor.rowcount == 0:
+                    return False, "User not in premium list"
+                conn.execute('UPDATE users SET subscription_tier = ? WHERE user_id = ?', ('free', user_id))
+        except sqlite3.Error as e:
+            print(f"❌ Error removing premium user {user_id}: {e}")
+            return False, f"❌ Could not remove premium user {user_id}"
+        entitlements.invalidate(user_id)
         
         return True, f"❌ User {user_id} removed from premium users"
     
+    def count_users(self):
+        """Count of stored premium users, active or expired"""
+        conn = get_db_connection()
+        count = conn.execute('SELECT COUNT(*) FROM premium_users').fetchone()[0]
+        conn.close()
+        return count
+    
+    def list_users(self, limit=20):
+        """Premium users as (user_id, data, is_active), latest expiry first"""
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, premium_type, username, activated, expires_at, features, months
+            FROM premium_users
+            ORDER BY expires_at IS NULL DESC, expires_at DESC
+            LIMIT ?
+        ''', (limit,))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        today = self._today()
+        users = []
+        for row in rows:
+            data = self._row_to_data(row[1:])
+            users.append((row[0], data, data['expires'] is None or data['expires'] >= today))
+        return users
+    
     def get_active_count(self):
         """Get count of active premium users"""
-        count = 0
-        for user_id, data in self.premium_users.items():
-            if self.is_premium(user_id):
-                count += 1
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT (SELECT COUNT(*) FROM premium_users WHERE expires_at IS NULL)
+                 + (SELECT COUNT(*) FROM premium_users WHERE expires_at >= ?)
+        ''', (self._today(),))
+        count = cursor.fetchone()[0]
+        conn.close()
         return count
     
     def get_expiring_soon(self, days=7):
         """Get users whose premium expires soon"""
-        expiring = []
-        today = datetime.datetime.now().date()
+        today = date.today()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, username, expires_at, premium_type FROM premium_users
+            WHERE expires_at BETWEEN ? AND ?
+            ORDER BY expires_at
+        ''', (today.strftime("%Y-%m-%d"), (today + timedelta(days=days)).strftime("%Y-%m-%d")))
+        rows = cursor.fetchall()
+        conn.close()
         
-        for user_id, data in self.premium_users.items():
-            if data.get('expires'):
-                try:
-                    expires_date = datetime.datetime.strptime(data['expires'], "%Y-%m-%d").date()
-                    days_until = (expires_date - today).days
-                    if 0 <= days_until <= days:
-                        expiring.append({
-                            'user_id': user_id,
-                            'username': data.get('username', ''),
-                            'expires': data['expires'],
-                            'days_until': days_until,
-                            'type': data.get('type', 'unknown')
-                        })
-                except Exception as e:
-                    print(f"Error parsing date for user {user_id}: {e}")
-                    continue
+        expiring = []
+        for user_id, username, expires_at, premium_type in rows:
+            expires_date = date.fromisoformat(expires_at)
+            expiring.append({
+                'user_id': str(user_id),
+                'username': username or '',
+                'expires': expires_at,
+                'days_until': (expires_date - today).days,
+                'type': premium_type or 'unknown'
+            })
         
         return expiring
+    
+    def expire_lapsed_users(self):
+        """Downgrade users whose premium has expired; returns their user IDs"""
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT p.user_id FROM premium_users p
+                JOIN users u ON u.user_id = p.user_id
+                WHERE p.expires_at < ? AND u.subscription_tier = 'premium'
+            ''', (self._today(),))
+            user_ids = [row[0] for row in cursor.fetchall()]
+            cursor.executemany(
+                "UPDATE users SET subscription_tier = 'free' WHERE user_id = ?",
+                [(user_id,) for user_id in user_ids]
+            )
+        for user_id in user_ids:
+            entitlements.invalidate(user_id)
+        return user_ids
 
 # Create global instance
 premium_manager = PremiumManager()
@@ -8480,92 +10352,11 @@ premium_manager = PremiumManager()
 
 def is_premium_user_enhanced(user_id):
     """Enhanced premium check - integrates with database trial system"""
-    # First check premium manager
-    try:
-        if premium_manager.is_premium(int(user_id)):
-            return True
-    except Exception as e:
-        print(f"Error checking premium manager for user {user_id}: {e}")
-    
-    # Check database trial system
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT subscription_tier, trial_end_date, trial_used FROM users WHERE user_id = ?
-    ''', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        return False
-    
-    subscription_tier, trial_end_date, trial_used = result
-    
-    # Check if user is on premium tier in database
-    if subscription_tier == 'premium':
-        return True
-    
-    # Check if user is in trial period
-    if trial_end_date and trial_used:
-        trial_end = parse_trial_end_date(trial_end_date)
-        if datetime.datetime.now() <= trial_end:
-            return True
-    
-    return False
+    return entitlements.is_premium(user_id)
 
 def get_user_tier_enhanced(user_id):
     """Get user's current tier with detailed info"""
-    user_id = int(user_id)
-    
-    # Get premium manager data
-    premium_data = premium_manager.get_user_data(user_id)
-    if premium_data and premium_manager.is_premium(user_id):
-        tier_type = premium_data.get('type', 'premium')
-        expires = premium_data.get('expires', 'Never')
-        return {
-            'name': 'premium',
-            'type': tier_type,
-            'expires': expires,
-            'features': premium_data.get('features', []),
-            'unlimited': True
-        }
-    
-    # Check database for trial
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT trial_end_date, trial_used FROM users WHERE user_id = ?
-    ''', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        trial_end_date, trial_used = result
-        if trial_end_date and trial_used:
-            trial_end = parse_trial_end_date(trial_end_date)
-            if datetime.datetime.now() <= trial_end:
-                days_left = (trial_end - datetime.datetime.now()).days
-                return {
-                    'name': 'trial',
-                    'expires': trial_end.strftime("%Y-%m-%d"),
-                    'days_left': days_left,
-                    'features': TIER_LIMITS['free']['features'] + ['trial_features'],
-                    'unlimited': True  # Trial users get unlimited access
-                }
-    
-    # Free tier user
-    return {
-        'name': 'free',
-        'limits': {
-            'invoices': TIER_LIMITS['free']['monthly_invoices'],
-            'appointments': TIER_LIMITS['free']['max_appointments'],
-            'clients': TIER_LIMITS['free']['max_clients']
-        },
-        'features': TIER_LIMITS['free']['features'],
-        'unlimited': False
-    }
+    return entitlements.get(user_id)
 
 def get_remaining_invoices_enhanced(user_id):
     """Get remaining invoices for current user tier"""
@@ -8574,7 +10365,7 @@ def get_remaining_invoices_enhanced(user_id):
     if tier['name'] in ['premium', 'trial'] or tier.get('unlimited', False):
         return float('inf')  # Unlimited for premium/trial
     
-    monthly_count = get_user_invoice_count_this_month(user_id) + get_user_quote_count_this_month(user_id)
+    monthly_count = get_monthly_usage(user_id, 'invoice', 'quote')
     remaining = TIER_LIMITS['free']['monthly_invoices'] - monthly_count
     return max(0, remaining)
 
@@ -8585,20 +10376,7 @@ def get_remaining_appointments_enhanced(user_id):
     if tier['name'] in ['premium', 'trial'] or tier.get('unlimited', False):
         return float('inf')  # Unlimited for premium/trial
     
-    # Count appointments created this month
-    conn = sqlite3.connect('invoices.db')
-    cursor = conn.cursor()
-    
-    first_day_of_month = datetime.datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    first_day_str = first_day_of_month.strftime('%Y-%m-%d %H:%M:%S')
-    
-    cursor.execute('''
-        SELECT COUNT(*) FROM appointments 
-        WHERE user_id = ? AND created_at >= ?
-    ''', (user_id, first_day_str))
-    
-    appointment_count = cursor.fetchone()[0]
-    conn.close()
+    appointment_count = get_monthly_usage(user_id, 'appointment')
     
     remaining = TIER_LIMITS['free']['max_appointments'] - appointment_count
     return max(0, remaining)
@@ -8622,7 +10400,7 @@ def check_invoice_limit_enhanced(user_id):
     if tier['name'] in ['premium', 'trial'] or tier.get('unlimited', False):
         return True, ""  # Premium/trial users have no limits
 
-    monthly_count = get_user_invoice_count_this_month(user_id) + get_user_quote_count_this_month(user_id)
+    monthly_count = get_monthly_usage(user_id, 'invoice', 'quote')
     remaining = TIER_LIMITS['free']['monthly_invoices'] - monthly_count
     
     if remaining <= 0:
@@ -8751,6 +10529,8 @@ def add_premium_subscription_enhanced(user_id, subscription_type, months=1):
     
     # Add to premium manager
     if subscription_type == 'trial':
+        if premium_manager.get_user_data(user_id).get('type') == 'trial':
+            return False, "❌ You have already used your premium trial"
         success, message = premium_manager.add_premium_user(
             user_id, username, 'trial', months,
             features=['invoices', 'quotes', 'appointments', 'clients', 'payments']
@@ -8763,12 +10543,12 @@ def add_premium_subscription_enhanced(user_id, subscription_type, months=1):
     
     if success:
         # Update database
-        conn = sqlite3.connect('invoices.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # If trial, set trial dates
         if subscription_type == 'trial':
-            trial_end_date = datetime.datetime.now() + datetime.timedelta(days=30*months)
+            trial_end_date = datetime.now() + timedelta(days=30*months)
             trial_end_str = trial_end_date.strftime('%Y-%m-%d %H:%M:%S')
             
             cursor.execute('''
@@ -8783,9 +10563,13 @@ def add_premium_subscription_enhanced(user_id, subscription_type, months=1):
         
         conn.commit()
         conn.close()
+        entitlements.invalidate(user_id)
     
     return success, message
 
+# Stripe webhook and /premium trial button
+add_premium_subscription = add_premium_subscription_enhanced
+
 def remove_premium_subscription_enhanced(user_id):
     """Remove premium subscription from user"""
     user_id = int(user_id)
@@ -8795,11 +10579,12 @@ def remove_premium_subscription_enhanced(user_id):
     
     if success:
         # Update database
-        conn = sqlite3.connect('invoices.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET subscription_tier = ? WHERE user_id = ?', ('free', user_id))
         conn.commit()
         conn.close()
+        entitlements.invalidate(user_id)
     
     return success, message
 
@@ -8821,15 +10606,15 @@ def get_subscription_expiry(user_id):
 async def create_invoice_with_tier_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Create invoice with tier checks - renamed to avoid conflict"""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await run_db(get_user, user_id)
     
     if not user:
-        create_user(user_id, update.effective_user.username, update.effective_user.first_name, update.effective_user.last_name)
-        user = get_user(user_id)
+        await run_db(create_user, user_id, update.effective_user.username, update.effective_user.first_name, update.effective_user.last_name)
+        user = await run_db(get_user, user_id)
         await update.message.reply_text("✅ Your account has been created! Starting invoice creation...")
     
     # Check invoice limit for free users
-    can_create, message = check_invoice_limit_enhanced(user_id)
+    can_create, message = await run_db(check_invoice_limit_enhanced, user_id)
     if not can_create:
         await update.message.reply_text(message)
         return
@@ -8840,13 +10625,15 @@ async def create_invoice_with_tier_check(update: Update, context: ContextTypes.D
     }
     
     # Show remaining info based on tier
-    tier = get_user_tier_enhanced(user_id)
+    tier = await run_db(get_user_tier_enhanced, user_id)
     remaining_info = ""
     
     if tier['name'] == 'free':
-        remaining_invoices = get_remaining_invoices_enhanced(user_id)
-        remaining_appointments = get_remaining_appointments_enhanced(user_id)
-        remaining_clients = get_remaining_clients_enhanced(user_id)
+        remaining_invoices, remaining_appointments, remaining_clients = await asyncio.gather(
+            run_db(get_remaining_invoices_enhanced, user_id),
+            run_db(get_remaining_appointments_enhanced, user_id),
+            run_db(get_remaining_clients_enhanced, user_id)
+        )
         
         remaining_info = (
             f"\n\n📊 **Your Free Tier Limits:**\n"
@@ -8880,27 +10667,28 @@ async def list_premium_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Admin only command")
         return
     
-    active_count = premium_manager.get_active_count()
-    expiring_soon = premium_manager.get_expiring_soon(days=7)
+    active_count, expiring_soon, total_users, premium_users = await asyncio.gather(
+        run_db(premium_manager.get_active_count),
+        run_db(premium_manager.get_expiring_soon, days=7),
+        run_db(premium_manager.count_users),
+        run_db(premium_manager.list_users, limit=20)  # Show first 20
+    )
     
     message = f"📊 **Premium User Management**\n\n"
     message += f"**Active Premium Users:** {active_count}\n\n"
     
-    if premium_manager.premium_users:
+    if total_users:
         message += "**All Premium Users:**\n"
-        for uid, data in list(premium_manager.premium_users.items())[:20]:  # Show first 20
+        for uid, data, is_active in premium_users:
             user_type = data.get('type', 'unknown')
-            expires = data.get('expires', 'Never')
-            username = data.get('username', 'No username')
-            
-            # Check if active
-            is_active = premium_manager.is_premium(uid)
+            expires = data.get('expires') or 'Never'
+            username = data.get('username') or 'No username'
             status = "✅ Active" if is_active else "❌ Expired"
             
             message += f"• `{uid}` - {username} - {user_type} - {expires} - {status}\n"
         
-        if len(premium_manager.premium_users) > 20:
-            message += f"\n... and {len(premium_manager.premium_users) - 20} more users\n"
+        if total_users > 20:
+            message += f"\n... and {total_users - 20} more users\n"
     else:
         message += "No premium users found.\n"
     
@@ -8920,7 +10708,7 @@ async def check_expiring_command(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ Admin only command")
         return
     
-    expiring_users = premium_manager.get_expiring_soon(days=3)
+    expiring_users = await run_db(premium_manager.get_expiring_soon, days=3)
     
     if not expiring_users:
         await update.message.reply_text("✅ No subscriptions expiring in the next 3 days.")
@@ -8940,58 +10728,87 @@ async def check_expiring_command(update: Update, context: ContextTypes.DEFAULT_T
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
-def send_renewal_reminders():
-    """Send renewal reminders to users with expiring subscriptions"""
+# Renewal reminders go out through the running Application's bot in batches
+# of at most RENEWAL_REMINDERS_PER_SECOND, under Telegram's ~30 messages/second
+# broadcast limit. The expiring set is one range read on
+# premium_users.expires_at, so dates are never re-parsed per user.
+RENEWAL_REMINDER_DAYS = 3
+RENEWAL_REMINDERS_PER_SECOND = int(os.getenv('RENEWAL_REMINDERS_PER_SECOND', '25'))
+
+def renewal_reminder_message(days_until):
+    """Reminder text for a subscription expiring in days_until days"""
+    if days_until == 0:
+        return (
+            f"⚠️ **Your Premium Subscription Expires Today!**\n\n"
+            f"Your Minigma Premium access will expire today.\n\n"
+            f"To continue enjoying unlimited features:\n"
+            f"1. Use /premium to renew your subscription\n"
+            f"2. Choose your preferred plan\n"
+            f"3. Complete the payment\n\n"
+            f"Renew now to avoid losing access to premium features!"
+        )
+    return (
+        f"⏰ **Premium Subscription Reminder**\n\n"
+        f"Your Minigma Premium access will expire in {days_until} days.\n\n"
+        f"To avoid interruption in service:\n"
+        f"1. Use /premium to renew early\n"
+        f"2. Choose your preferred plan\n"
+        f"3. Complete the payment\n\n"
+        f"Renew now to continue enjoying unlimited features!"
+    )
+
+async def send_renewal_reminder(bot, user) -> bool:
+    """Send one renewal reminder, waiting out a single flood-control RetryAfter"""
+    user_id = int(user['user_id'])
+    message = renewal_reminder_message(user['days_until'])
+    for attempt in range(2):
+        try:
+            await bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown')
+            return True
+        except RetryAfter as e:
+            if attempt:
+                break
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Failed to send reminder to user {user_id}: {e}")
+            return False
+    logger.error(f"Failed to send reminder to user {user_id}: rate limited")
+    return False
+
+async def send_renewal_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Daily job: remind users whose premium expires within RENEWAL_REMINDER_DAYS"""
     try:
-        expiring_users = premium_manager.get_expiring_soon(days=3)
-        
-        for user in expiring_users:
-            try:
-                user_id = int(user['user_id'])
-                days_until = user['days_until']
-                
-                # Send reminder message
-                from telegram import Bot
-                bot = Bot(token=BOT_TOKEN)
-                
-                if days_until == 0:
-                    message = (
-                        f"⚠️ **Your Premium Subscription Expires Today!**\n\n"
-                        f"Your Minigma Premium access will expire today.\n\n"
-                        f"To continue enjoying unlimited features:\n"
-                        f"1. Use /premium to renew your subscription\n"
-                        f"2. Choose your preferred plan\n"
-                        f"3. Complete the payment\n\n"
-                        f"Renew now to avoid losing access to premium features!"
-                    )
-                else:
-                    message = (
-                        f"⏰ **Premium Subscription Reminder**\n\n"
-                        f"Your Minigma Premium access will expire in {days_until} days.\n\n"
-                        f"To avoid interruption in service:\n"
-                        f"1. Use /premium to renew early\n"
-                        f"2. Choose your preferred plan\n"
-                        f"3. Complete the payment\n\n"
-                        f"Renew now to continue enjoying unlimited features!"
-                    )
-                
-                bot.send_message(
-                    chat_id=user_id,
-                    text=message,
-                    parse_mode='Markdown'
-                )
-                
-                logger.info(f"Sent renewal reminder to user {user_id}")
-                
-            except Exception as e:
-                logger.error(f"Failed to send reminder to user {user['user_id']}: {e}")
-                continue
-        
-        return len(expiring_users)
-        
+        expiring_users = await run_db(premium_manager.get_expiring_soon, RENEWAL_REMINDER_DAYS)
     except Exception as e:
         logger.error(f"Error sending renewal reminders: {e}")
         return 0
+    
+    sent = 0
+    batch_size = max(1, RENEWAL_REMINDERS_PER_SECOND)
+    for start in range(0, len(expiring_users), batch_size):
+        started = time.monotonic()
+        batch = expiring_users[start:start + batch_size]
+        results = await asyncio.gather(*(send_renewal_reminder(context.bot, user) for user in batch))
+        sent += sum(results)
+        
+        elapsed = time.monotonic() - started
+        if start + batch_size < len(expiring_users) and elapsed < 1:
+            await asyncio.sleep(1 - elapsed)
+    
+    logger.info(f"⏰ Sent {sent}/{len(expiring_users)} renewal reminders")
+    return sent
+
+async def expire_premium_users(context: ContextTypes.DEFAULT_TYPE):
+    """Daily job: move lapsed premium subscriptions back to the free tier"""
+    try:
+        expired = await run_db(premium_manager.expire_lapsed_users)
+    except Exception as e:
+        logger.error(f"Error expiring premium users: {e}")
+        return 0
+    
+    if expired:
+        logger.info(f"⏰ Premium expired for {len(expired)} users")
+    return len(expired)
 
 # ==================================================
 # INITIALIZATION FUNCTION
@@ -9002,9 +10819,6 @@ def initialize_premium_system():
     print("\n🔧 Initializing Premium Management System...")
     print("-" * 50)
     
-    # Load premium manager
-    premium_manager.load_premium_users()
-    
     active_count = premium_manager.get_active_count()
     expiring_soon = premium_manager.get_expiring_soon(days=7)
     
@@ -9018,23 +10832,8 @@ def initialize_premium_system():
     
     print("-" * 50)
     
-    # Schedule renewal reminder job
-    try:
-        # Import here to avoid circular imports
-        import sys
-        if 'application' in sys.modules:
-            from main import application
-            if application.job_queue:
-                # Send renewal reminders daily at 10 AM
-                application.job_queue.run_daily(
-                    send_renewal_reminders,
-                    time=datetime.time(hour=10, minute=0, second=0)
-                )
-                print("✅ Renewal reminder job scheduled (10 AM daily)")
-        else:
-            print("⚠️  Application not available, skipping job scheduling")
-    except Exception as e:
-        print(f"⚠️  Could not schedule renewal reminder job: {e}")
+    # The renewal reminder and expiry jobs (send_renewal_reminders,
+    # expire_premium_users) are scheduled in main()
     
     return True
 
@@ -9049,7 +10848,6 @@ import calendar as pycalendar
 import sqlite3  # Added missing import
 from datetime import datetime, timedelta, date
 from typing import Dict, List, Optional, Tuple
-import re
 
 # Note: You'll need these imports for the Telegram bot functionality
 # from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -9057,10 +10855,11 @@ import re
 
 # ===== DATABASE FUNCTIONS FOR SCHEDULING =====
 
-def get_appointment(appointment_id: int) -> Optional[tuple]:
+def get_appointment(appointment_id: int) -> Optional[Appointment]:
     """Get appointment by ID"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     cursor.execute('''
         SELECT a.*, c.client_name, c.email, c.phone 
         FROM appointments a 
@@ -9071,10 +10870,11 @@ def get_appointment(appointment_id: int) -> Optional[tuple]:
     conn.close()
     return appointment
 
-def get_appointments_needing_reminder(hours_ahead: int = 24) -> List[tuple]:
+def get_appointments_needing_reminder(hours_ahead: int = 24) -> List[Appointment]:
     """Get appointments needing reminders (upcoming in X hours)"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     
     now = datetime.now()
     reminder_time = now + timedelta(hours=hours_ahead)
@@ -9096,7 +10896,7 @@ def get_appointments_needing_reminder(hours_ahead: int = 24) -> List[tuple]:
 
 def get_user_calendar_settings(user_id: int) -> Dict:
     """Get user's calendar settings"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT calendar_settings FROM users WHERE user_id = ?', (user_id,))
     result = cursor.fetchone()
@@ -9119,28 +10919,24 @@ def get_user_calendar_settings(user_id: int) -> Dict:
 def check_appointment_conflict(user_id: int, start_time: datetime, 
                               duration: int, exclude_id: Optional[int] = None) -> bool:
     """Check if appointment time conflicts with existing appointments"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     end_time = start_time + timedelta(minutes=duration)
     
-    query = '''
+    query = f'''
         SELECT appointment_id FROM appointments 
         WHERE user_id = ? 
-        AND status = 'scheduled'
-        AND (
-            (appointment_time <= ? AND datetime(appointment_time, '+' || duration_minutes || ' minutes') >= ?)
-            OR (appointment_time <= ? AND datetime(appointment_time, '+' || duration_minutes || ' minutes') >= ?)
-            OR (appointment_time >= ? AND datetime(appointment_time, '+' || duration_minutes || ' minutes') <= ?)
-        )
+        AND {APPOINTMENT_OVERLAP_SQL.format(a='', start='?', end='?')}
     '''
     
-    params = [user_id, start_time, start_time, end_time, end_time, start_time, end_time]
+    params = [user_id, start_time.strftime('%Y-%m-%d %H:%M:%S'), end_time.strftime('%Y-%m-%d %H:%M:%S')]
     
     if exclude_id:
         query += ' AND appointment_id != ?'
         params.append(exclude_id)
     
+    query += ' LIMIT 1'
     cursor.execute(query, params)
     conflict = cursor.fetchone() is not None
     conn.close()
@@ -9155,16 +10951,16 @@ def get_user_availability(user_id: int, target_date: date, duration: int = 60) -
     work_end = datetime.combine(target_date, datetime.strptime(settings['working_hours']['end'], '%H:%M').time())
     
     # Get existing appointments
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT appointment_time, duration_minutes 
         FROM appointments 
         WHERE user_id = ? 
-        AND DATE(appointment_time) = ?
+        AND appointment_time >= ? AND appointment_time < ?
         AND status = 'scheduled'
         ORDER BY appointment_time
-    ''', (user_id, target_date.strftime('%Y-%m-%d')))
+    ''', (user_id, *day_range(target_date)))
     
     appointments = cursor.fetchall()
     conn.close()
@@ -9218,13 +11014,17 @@ async def schedule_command(update, context):  # Changed from formal typing for n
     """Enhanced scheduling command hub"""
     user_id = update.effective_user.id
     
-    # Get appointment statistics - need to implement these helper functions
-    today_count = len(get_today_appointments(user_id)) if 'get_today_appointments' in globals() else 0
-    tomorrow_count = len(get_tomorrow_appointments(user_id))
-    clients = get_user_clients(user_id) if 'get_user_clients' in globals() else []
-    
-    # Check for conflicts/urgent items
-    conflicts = check_upcoming_conflicts(user_id)
+    # Get appointment statistics - queries run concurrently on the DB executor
+    today_appts, tomorrow_appts, clients, conflicts, next_appt, week_stats = await asyncio.gather(
+        run_db(get_today_appointments, user_id),
+        run_db(get_tomorrow_appointments, user_id),
+        run_db(get_user_clients, user_id),
+        run_db(check_upcoming_conflicts, user_id),
+        run_db(get_next_appointment, user_id),
+        run_db(get_appointment_stats, user_id, 'week')
+    )
+    today_count = len(today_appts)
+    tomorrow_count = len(tomorrow_appts)
     
     message = f"📅 **Appointment Scheduling Center**\n\n"
     
@@ -9236,10 +11036,8 @@ async def schedule_command(update, context):  # Changed from formal typing for n
     message += f"👥 **Active Clients:** {len(clients)}\n\n"
     
     # Next appointment
-    next_appt = get_next_appointment(user_id)
     if next_appt:
-        # Assuming index 5 is appointment_time
-        appt_time = next_appt[5] if isinstance(next_appt[5], datetime) else datetime.strptime(next_appt[5], '%Y-%m-%d %H:%M:%S')
+        appt_time = next_appt.starts_at
         time_left = appt_time - datetime.now()
         hours_left = time_left.total_seconds() / 3600
         
@@ -9256,7 +11054,6 @@ async def schedule_command(update, context):  # Changed from formal typing for n
         message += f"   📝 {appt_title[:30]}{'...' if len(appt_title) > 30 else ''}\n\n"
     
     # Quick stats
-    week_stats = get_appointment_stats(user_id, 'week')
     message += f"📈 **This Week:** {week_stats['total']} appts ({week_stats['completed']}✅ {week_stats['cancelled']}❌)\n\n"
     
     # Keyboard with advanced options - need InlineKeyboardButton import
@@ -9325,11 +11122,11 @@ async def show_week_view(update, user_id: int, week_date: datetime):
     """Enhanced week view with availability indicators"""
     week_start = week_date - timedelta(days=week_date.weekday())
     
-    # Get appointments for the week - need to implement this function
-    appointments = get_week_appointments(user_id, week_start) if 'get_week_appointments' in globals() else []
-    
-    # Get calendar settings
-    settings = get_user_calendar_settings(user_id)
+    # Get appointments for the week and the availability heatmap off the event loop
+    appointments, heatmap = await asyncio.gather(
+        run_db(get_week_appointments, user_id, week_start),
+        run_db(generate_availability_heatmap, user_id)
+    )
     
     message = f"📅 **Weekly Calendar**\n"
     message += f"**Week of {week_start.strftime('%d %b %Y')}**\n\n"
@@ -9338,7 +11135,7 @@ async def show_week_view(update, user_id: int, week_date: datetime):
     for day_offset in range(7):
         current_day = week_start + timedelta(days=day_offset)
         day_appointments = [a for a in appointments 
-                          if isinstance(a[5], datetime) and a[5].date() == current_day.date()]
+                          if a.starts_at and a.starts_at.date() == current_day.date()]
         
         # Day header
         day_str = current_day.strftime('%a %d')
@@ -9353,7 +11150,7 @@ async def show_week_view(update, user_id: int, week_date: datetime):
             # Group by hour
             hourly_appointments = {}
             for appt in day_appointments:
-                hour = appt[5].hour
+                hour = appt.starts_at.hour
                 if hour not in hourly_appointments:
                     hourly_appointments[hour] = []
                 hourly_appointments[hour].append(appt)
@@ -9364,8 +11161,8 @@ async def show_week_view(update, user_id: int, week_date: datetime):
                 message += f"  {hour:02d}:00 "
                 
                 for appt in hour_appts:
-                    duration = appt[6] // 30 if len(appt) > 6 else 1  # Show in 30-min blocks
-                    status = appt[8] if len(appt) > 8 else 'scheduled'
+                    duration = (appt.duration_minutes or 30) // 30  # Show in 30-min blocks
+                    status = appt.status or 'scheduled'
                     emoji = get_appointment_emoji(status)
                     
                     if duration == 1:
@@ -9383,7 +11180,7 @@ async def show_week_view(update, user_id: int, week_date: datetime):
     
     # Add availability heatmap
     message += f"**Availability Heatmap** (Next 7 days)\n"
-    message += generate_availability_heatmap(user_id)
+    message += heatmap
     
     # Navigation keyboard - need InlineKeyboardButton import
     try:
@@ -9465,8 +11262,11 @@ async def show_month_view(update, user_id: int, month_date: datetime):
     else:
         last_day = date(year + 1, 1, 1) - timedelta(days=1)
     
-    # Get appointments for the month - need to implement this function
-    appointments = get_appointments_between(user_id, first_day, last_day) if 'get_appointments_between' in globals() else []
+    # Get appointments and stats for the month
+    appointments, month_stats = await asyncio.gather(
+        run_db(get_appointments_between, user_id, first_day, last_day),
+        run_db(get_appointment_stats, user_id, 'month', month_date)
+    )
     
     # Create calendar header
     calendar_header = pycalendar.month_name[month] + " " + str(year)
@@ -9478,15 +11278,10 @@ async def show_month_view(update, user_id: int, month_date: datetime):
     # Map appointments to days
     appointment_counts = {}
     for appt in appointments:
-        if isinstance(appt[5], datetime):
-            day = appt[5].day
-        else:
-            # Try to parse string date
-            try:
-                day = datetime.strptime(str(appt[5]), '%Y-%m-%d %H:%M:%S').day
-            except:
-                continue
-        appointment_counts[day] = appointment_counts.get(day, 0) + 1
+        starts_at = appt.starts_at
+        if not starts_at:
+            continue
+        appointment_counts[starts_at.day] = appointment_counts.get(starts_at.day, 0) + 1
     
     # Generate calendar
     days_of_week = ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]
@@ -9513,7 +11308,6 @@ async def show_month_view(update, user_id: int, month_date: datetime):
     message += "\n**Key:** • = appointments, 🟢 = today\n"
     
     # Quick stats
-    month_stats = get_appointment_stats(user_id, 'month', month_date)
     message += f"\n📊 **Month Stats:** {month_stats['total']} appointments\n"
     message += f"✅ {month_stats['completed']} • ⏰ {month_stats['scheduled']} • ❌ {month_stats['cancelled']}\n"
     
@@ -9579,7 +11373,7 @@ async def appointment_list_command(update, context):
                     pass
     
     # Get filtered appointments
-    appointments = get_filtered_appointments(user_id, filters)
+    appointments = await run_db(get_filtered_appointments, user_id, filters)
     
     if not appointments:
         await update.message.reply_text(
@@ -9594,15 +11388,11 @@ async def appointment_list_command(update, context):
     # Group by date
     appointments_by_date = {}
     for appt in appointments:
-        # Assuming index 5 is appointment_time
-        if isinstance(appt[5], datetime):
-            date_key = appt[5].strftime('%Y-%m-%d')
-        else:
-            try:
-                date_key = datetime.strptime(str(appt[5]), '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d')
-            except:
-                continue
-                
+        starts_at = appt.starts_at
+        if not starts_at:
+            continue
+        date_key = starts_at.strftime('%Y-%m-%d')
+        
         if date_key not in appointments_by_date:
             appointments_by_date[date_key] = []
         appointments_by_date[date_key].append(appt)
@@ -9613,29 +11403,18 @@ async def appointment_list_command(update, context):
         message += f"**{date_obj.strftime('%A, %d %B')}**\n"
         
         for appt in appointments_by_date[date_key]:
-            if isinstance(appt[5], datetime):
-                time_str = appt[5].strftime('%H:%M')
-            else:
-                try:
-                    time_str = datetime.strptime(str(appt[5]), '%Y-%m-%d %H:%M:%S').strftime('%H:%M')
-                except:
-                    time_str = "Unknown"
-                    
-            status = appt[8] if len(appt) > 8 else 'scheduled'
-            status_emoji = get_appointment_emoji(status)
-            duration = f"{appt[6]}min" if len(appt) > 6 else "N/A"
+            time_str = appt.starts_at.strftime('%H:%M')
+            status_emoji = get_appointment_emoji(appt.status or 'scheduled')
+            duration = f"{appt.duration_minutes}min" if appt.duration_minutes else "N/A"
             
-            title = appt[3] if len(appt) > 3 else "Untitled"
+            title = appt.title or "Untitled"
             message += f"{status_emoji} **{time_str}** ({duration}) - {title[:40]}"
             
-            if appt[2] and len(appt) > 2:  # Client info
-                # Need to implement get_client_by_id
-                client = get_client_by_id(appt[2]) if 'get_client_by_id' in globals() else None
-                if client:
-                    message += f"\n   👤 {client[2] if len(client) > 2 else 'Unknown'}"
+            if appt.client_id:  # Client name comes from the JOIN
+                message += f"\n   👤 {appt.client_name or 'Unknown'}"
             
-            message += f"\n   📝 ID: {appt[0]} | "
-            reminder_status = 'ON' if (len(appt) > 9 and appt[9]) else 'OFF'
+            message += f"\n   📝 ID: {appt.appointment_id} | "
+            reminder_status = 'ON' if appt.reminder_enabled else 'OFF'
             message += f"🔔: {reminder_status}\n\n"
     
     if len(appointments_by_date) > 10:
@@ -9760,8 +11539,8 @@ async def handle_booking_type(query, appointment_type: str):
     if appointment_type in defaults:
         context.user_data['booking'].update(defaults[appointment_type])
     
-    # Get clients for selection - need to implement this function
-    clients = get_user_clients(user_id) if 'get_user_clients' in globals() else []
+    # Get clients for selection
+    clients = await run_db(get_user_clients, user_id)
     
     if not clients:
         await query.edit_message_text(
@@ -9811,7 +11590,7 @@ async def handle_booking_type(query, appointment_type: str):
 
 def check_upcoming_conflicts(user_id: int) -> List[Dict]:
     """Check for scheduling conflicts in upcoming appointments"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     # Get appointments with potential conflicts (within 15 minutes of each other)
@@ -9820,12 +11599,13 @@ def check_upcoming_conflicts(user_id: int) -> List[Dict]:
             SELECT 
                 appointment_id,
                 appointment_time,
-                datetime(appointment_time, '+' || duration_minutes || ' minutes') as end_time,
+                end_time,
                 title,
                 client_id
             FROM appointments 
             WHERE user_id = ? 
             AND status = 'scheduled'
+            AND end_time > datetime('now')  -- implied by the next line; lets the index seek
             AND appointment_time > datetime('now')
         )
         SELECT 
@@ -9860,7 +11640,7 @@ def check_upcoming_conflicts(user_id: int) -> List[Dict]:
 
 async def show_conflicts(update, context, user_id: int):
     """Show detected conflicts to user"""
-    conflicts = check_upcoming_conflicts(user_id)
+    conflicts = await run_db(check_upcoming_conflicts, user_id)
     
     if not conflicts:
         await update.message.reply_text(
@@ -9923,26 +11703,28 @@ def get_appointment_emoji(status: str) -> str:
     }
     return emoji_map.get(status, '📅')
 
-def get_tomorrow_appointments(user_id: int) -> List[tuple]:
+def get_tomorrow_appointments(user_id: int) -> List[Appointment]:
     """Get appointments for tomorrow"""
     tomorrow = datetime.now() + timedelta(days=1)
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     cursor.execute('''
         SELECT * FROM appointments 
         WHERE user_id = ? 
-        AND DATE(appointment_time) = DATE(?)
+        AND appointment_time >= ? AND appointment_time < ?
         AND status = 'scheduled'
         ORDER BY appointment_time
-    ''', (user_id, tomorrow))
+    ''', (user_id, *day_range(tomorrow)))
     appointments = cursor.fetchall()
     conn.close()
     return appointments
 
-def get_next_appointment(user_id: int) -> Optional[tuple]:
+def get_next_appointment(user_id: int) -> Optional[Appointment]:
     """Get the next upcoming appointment"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     cursor.execute('''
         SELECT * FROM appointments 
         WHERE user_id = ? 
@@ -9960,7 +11742,7 @@ def get_appointment_stats(user_id: int, period: str = 'week', reference_date: Op
     if not reference_date:
         reference_date = datetime.now()
     
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
     
     if period == 'week':
@@ -9999,10 +11781,11 @@ def get_appointment_stats(user_id: int, period: str = 'week', reference_date: Op
         'cancelled': result[3] or 0
     }
 
-def get_filtered_appointments(user_id: int, filters: Dict) -> List[tuple]:
+def get_filtered_appointments(user_id: int, filters: Dict) -> List[Appointment]:
     """Get appointments with filters"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     
     query = '''
         SELECT a.*, c.client_name 
@@ -10017,8 +11800,9 @@ def get_filtered_appointments(user_id: int, filters: Dict) -> List[tuple]:
         params.append(filters['status'])
     
     if 'client' in filters:
-        query += ' AND c.client_name LIKE ?'
-        params.append(f'%{filters["client"]}%')
+        condition, client_params = client_name_condition(filters['client'], user_id)
+        query += f' AND {condition}'
+        params.extend(client_params)
     
     # Add date filters if present
     if 'from_date' in filters:
@@ -10041,26 +11825,28 @@ def get_filtered_appointments(user_id: int, filters: Dict) -> List[tuple]:
 # These functions are referenced but not defined in your code.
 # You'll need to implement them:
 
-def get_today_appointments(user_id: int) -> List[tuple]:
+def get_today_appointments(user_id: int) -> List[Appointment]:
     """Get appointments for today"""
     today = datetime.now().date()
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     cursor.execute('''
         SELECT * FROM appointments 
         WHERE user_id = ? 
-        AND DATE(appointment_time) = DATE(?)
+        AND appointment_time >= ? AND appointment_time < ?
         AND status = 'scheduled'
         ORDER BY appointment_time
-    ''', (user_id, today))
+    ''', (user_id, *day_range(today)))
     appointments = cursor.fetchall()
     conn.close()
     return appointments
 
-def get_user_clients(user_id: int) -> List[tuple]:
+def get_user_clients(user_id: int) -> List[Client]:
     """Get clients for a user"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Client)
     cursor.execute('''
         SELECT * FROM clients 
         WHERE user_id = ? 
@@ -10070,41 +11856,43 @@ def get_user_clients(user_id: int) -> List[tuple]:
     conn.close()
     return clients
 
-def get_week_appointments(user_id: int, week_start: datetime) -> List[tuple]:
+def get_week_appointments(user_id: int, week_start: datetime) -> List[Appointment]:
     """Get appointments for a week"""
-    week_end = week_start + timedelta(days=7)
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     cursor.execute('''
         SELECT * FROM appointments 
         WHERE user_id = ? 
-        AND appointment_time BETWEEN ? AND ?
+        AND appointment_time >= ? AND appointment_time < ?
         AND status = 'scheduled'
         ORDER BY appointment_time
-    ''', (user_id, week_start, week_end))
+    ''', (user_id, *day_range(week_start, days=7)))
     appointments = cursor.fetchall()
     conn.close()
     return appointments
 
-def get_appointments_between(user_id: int, start_date: date, end_date: date) -> List[tuple]:
+def get_appointments_between(user_id: int, start_date: date, end_date: date) -> List[Appointment]:
     """Get appointments between two dates"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Appointment)
     cursor.execute('''
         SELECT * FROM appointments 
         WHERE user_id = ? 
-        AND DATE(appointment_time) BETWEEN ? AND ?
+        AND appointment_time >= ? AND appointment_time < ?
         AND status = 'scheduled'
         ORDER BY appointment_time
-    ''', (user_id, start_date, end_date))
+    ''', (user_id, *day_range(start_date, end_date)))
     appointments = cursor.fetchall()
     conn.close()
     return appointments
 
-def get_client_by_id(client_id: int) -> Optional[tuple]:
+def get_client_by_id(client_id: int) -> Optional[Client]:
     """Get client by ID"""
-    conn = sqlite3.connect('invoices.db')
+    conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.row_factory = record_factory(Client)
     cursor.execute('SELECT * FROM clients WHERE client_id = ?', (client_id,))
     client = cursor.fetchone()
     conn.close()
@@ -10165,6 +11953,9 @@ def main():
     print(f"✅ Token loaded: {BOT_TOKEN[:15]}...")
     
     try:
+        # Fork the PDF workers before the bot starts its threads (no-op if already started)
+        pdf_renderer.start()
+        
         # Create the Application
         application = Application.builder().token(BOT_TOKEN).build()
         
@@ -10173,6 +11964,9 @@ def main():
         # Basic commands
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("help", help_command))
+        application.add_handler(CommandHandler("myinvoices", my_invoices_command))
+        application.add_handler(CommandHandler("myquotes", my_quotes_command))
+        application.add_handler(CommandHandler("logo", logo_command))
         
         # Appointment commands (add these if you have them defined)
         # application.add_handler(CommandHandler("schedule", schedule_command))
@@ -10182,6 +11976,9 @@ def main():
         # Text handler - IMPORTANT for all text inputs
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
         
+        # Logo uploads after /logo
+        application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_logo_upload))
+        
         # Callback query handler for inline buttons
         application.add_handler(CallbackQueryHandler(handle_button_callback))
         
@@ -10200,11 +11997,24 @@ def main():
         try:
             import datetime as dt
             job_queue.run_daily(send_daily_schedule, time=dt.time(hour=8, minute=0))
+            # Premium renewal reminders at 10 AM
+            job_queue.run_daily(send_renewal_reminders, time=dt.time(hour=10, minute=0))
+            # Downgrade lapsed premium subscriptions at startup and just after midnight
+            job_queue.run_once(expire_premium_users, when=30)
+            job_queue.run_daily(expire_premium_users, time=dt.time(hour=0, minute=5))
+            # Forget old Telegram file_ids at 3 AM
+            job_queue.run_daily(prune_telegram_files_job, time=dt.time(hour=3, minute=0))
         except ImportError:
             print("⚠️  Could not schedule daily tasks - datetime module issue")
         
+        # Apply queued Stripe webhook events
+        if PAYMENT_CONFIG.get('enabled', False):
+            job_queue.run_repeating(process_stripe_events_job, interval=STRIPE_EVENT_POLL_SECONDS, first=15)
+        
         # Start the bot
         application.run_polling(drop_pending_updates=True)
+        shutdown_db_executor()
+        pdf_renderer.shutdown()
         
     except Exception as e:
         print(f"❌ Error starting bot: {e}")
@@ -10222,6 +12032,18 @@ class HealthHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b'Telegram Bot is running!')
     
+    def do_POST(self):
+        """Stripe webhook intake: verify, store and acknowledge"""
+        if self.path != '/stripe/webhook':
+            self.send_response(404)
+            self.end_headers()
+            return
+        
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        accepted = handle_stripe_webhook(payload, self.headers.get('Stripe-Signature'))
+        self.send_response(200 if accepted else 400)
+        self.end_headers()
+    
     def log_message(self, format, *args):
         # Disable HTTP logging noise
         pass
@@ -10245,6 +12067,9 @@ if __name__ == "__main__":
         print("HTTP server on port 8000 for health checks")
         print("=" * 50)
         
+        # Fork the PDF workers while this is still the only thread
+        pdf_renderer.start()
+        
         # Start HTTP server in background thread
         http_thread = threading.Thread(target=run_http_server, daemon=True)
         http_thread.start()
@@ -1,75 +1,139 @@
 # premium_manager.py
 import datetime
+import os
+
+HEADER = "# Premium Users List\n# Format: TelegramUserID | Username (optional) | ActivatedDate\n"
 
 class PremiumManager:
-    def __init__(self, filename='premium_users.txt'):
+    """Premium users in premium_users.txt plus an append-only change journal
+
+    add/remove only append a line to <filename>.journal ("+id | username | date"
+    or "-id"), so each is O(1) however many users there are. The journal is
+    replayed on load and folded back into the main file by compact(), which
+    runs at startup and whenever the journal grows past compact_after entries.
+    """
+
+    def __init__(self, filename='premium_users.txt', compact_after=1000):
         self.filename = filename
-        self.premium_users = set()
+        self.journal_filename = filename + '.journal'
+        self.compact_after = compact_after
+        self.premium_users = {}  # user_id: (username, activated date)
+        self.journal_entries = 0
         self.load_premium_users()
-    
+
+    def _parse_entry(self, line):
+        """'id | username | date' -> (user_id, username, date), or None"""
+        parts = [part.strip() for part in line.split('|')]
+        if not parts[0].isdigit():
+            return None
+        username = parts[1] if len(parts) > 1 else ""
+        activated = parts[2] if len(parts) > 2 else ""
+        return int(parts[0]), username, activated
+
     def load_premium_users(self):
-        """Load premium users from file"""
+        """Load premium users from file, replay the journal and compact it"""
         try:
             with open(self.filename, 'r', encoding='utf-8') as f:
                 for line in f:
                     line = line.strip()
                     if line and not line.startswith('#'):  # Skip comments and empty lines
-                        parts = line.split('|')
-                        if parts:  # First part is user ID
-                            user_id = parts[0].strip()
-                            if user_id.isdigit():
-                                self.premium_users.add(int(user_id))
-            print(f"Loaded {len(self.premium_users)} premium users")
+                        entry = self._parse_entry(line)
+                        if entry:
+                            self.premium_users[entry[0]] = entry[1:]
         except FileNotFoundError:
             # Create file if it doesn't exist
             with open(self.filename, 'w', encoding='utf-8') as f:
-                f.write("# Premium Users List\n# Format: TelegramUserID | Username (optional) | ActivatedDate\n")
+                f.write(HEADER)
             print("Created new premium users file")
-    
+
+        torn = self._replay_journal()
+        # A torn tail must go too, or the next append would be glued onto it
+        if self.journal_entries or torn:
+            self.compact()
+        print(f"Loaded {len(self.premium_users)} premium users")
+
+    def _replay_journal(self):
+        """Apply journal lines in order; a torn last line from a crash is ignored
+
+        Returns True if the journal ended in such a torn line.
+        """
+        try:
+            with open(self.journal_filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        return True
+                    line = line.strip()
+                    if line[:1] == '-' and line[1:].isdigit():
+                        self.premium_users.pop(int(line[1:]), None)
+                    elif line[:1] == '+':
+                        entry = self._parse_entry(line[1:])
+                        if entry:
+                            self.premium_users[entry[0]] = entry[1:]
+                    self.journal_entries += 1
+        except FileNotFoundError:
+            pass
+        return False
+
+    def _append_journal(self, lines):
+        with open(self.journal_filename, 'a', encoding='utf-8') as f:
+            f.writelines(line + "\n" for line in lines)
+        self.journal_entries += len(lines)
+        if self.journal_entries >= self.compact_after:
+            self.compact()
+
+    def compact(self):
+        """Rewrite premium_users.txt from memory and empty the journal"""
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            f.write(HEADER)
+            for user_id, (username, activated) in self.premium_users.items():
+                f.write(f"{user_id} | {username} | {activated}\n")
+        os.replace(tmp_filename, self.filename)
+        # Only drop the journal once the new main file is in place
+        open(self.journal_filename, 'w', encoding='utf-8').close()
+        self.journal_entries = 0
+
     def is_premium(self, user_id):
         """Check if user has premium access"""
         return user_id in self.premium_users
-    
+
     def add_premium_user(self, user_id, username=""):
         """Add a new premium user to the file"""
         if user_id in self.premium_users:
             return False, "User already has premium access"
-        
-        # Add to memory
-        self.premium_users.add(user_id)
-        
-        # Add to file
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        with open(self.filename, 'a', encoding='utf-8') as f:
-            if username:
-                f.write(f"\n{user_id} | {username} | {today}")
-            else:
-                f.write(f"\n{user_id} | | {today}")
-        
+
+        self.add_premium_users([(user_id, username)])
         return True, f"✅ User {user_id} added to premium users"
-    
+
     def remove_premium_user(self, user_id):
         """Remove a user from premium access"""
         if user_id not in self.premium_users:
             return False, "User not in premium list"
-        
-        # Remove from memory
-        self.premium_users.remove(user_id)
-        
-        # Rewrite file without the user
-        with open(self.filename, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            for line in lines:
-                if line.strip() and not line.strip().startswith('#'):
-                    parts = line.split('|')
-                    if parts and parts[0].strip() != str(user_id):
-                        f.write(line)
-                else:
-                    f.write(line)
-        
+
+        self.remove_premium_users([user_id])
         return True, f"❌ User {user_id} removed from premium users"
 
+    def add_premium_users(self, users):
+        """Grant premium to many (user_id, username) pairs with one journal append"""
+        today = datetime.datetime.now().strftime("%Y-%m-%d")
+        lines = []
+        for user_id, username in users:
+            if user_id not in self.premium_users:
+                self.premium_users[user_id] = (username, today)
+                lines.append(f"+{user_id} | {username} | {today}")
+        if lines:
+            self._append_journal(lines)
+        return len(lines)
+
+    def remove_premium_users(self, user_ids):
+        """Revoke premium for many users with one journal append"""
+        lines = []
+        for user_id in user_ids:
+            if self.premium_users.pop(user_id, None) is not None:
+                lines.append(f"-{user_id}")
+        if lines:
+            self._append_journal(lines)
+        return len(lines)
+
 # Create global instance
-premium_manager = PremiumManager()
\ No newline at end of file
+premium_manager = PremiumManager()
@@ -0,0 +1,157 @@
+"""Benchmark the approved-document list queries under candidate invoices indexes
+
+Builds a synthetic invoices table (the migration 001/002 columns) in a
+temporary SQLite file, then times the statements get_user_invoices,
+get_user_quotes and get_document_page issue for one heavy account under each
+index set, printing the query plans and the best-of-N wall time.
+tests/test_query_plans.py pins the real functions to the chosen index.
+
+    python scripts/bench_invoice_indexes.py --rows 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+HEAVY_USER = 1
+
+INVOICES_TABLE = '''
+    CREATE TABLE invoices (
+        invoice_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        invoice_number TEXT UNIQUE,
+        client_name TEXT,
+        invoice_date TEXT,
+        currency TEXT,
+        items TEXT,
+        total_amount REAL,
+        vat_enabled BOOLEAN DEFAULT FALSE,
+        vat_amount REAL DEFAULT 0,
+        status TEXT DEFAULT 'draft',
+        paid_status BOOLEAN DEFAULT FALSE,
+        client_email TEXT,
+        client_phone TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        document_type TEXT DEFAULT 'invoice'
+    )
+'''
+
+INDEX_SETS = {
+    # idx_invoices_user_date and idx_invoices_status from migration 001
+    'baseline': ['invoices(user_id, created_at)', 'invoices(status)'],
+    'type_first': ['invoices(user_id, status, document_type, created_at)'],
+    'status_date': ['invoices(user_id, status, created_at)'],
+    'date_first': ['invoices(user_id, status, created_at, document_type)'],
+}
+
+LIST = "SELECT * FROM invoices WHERE user_id = ? AND status = 'approved'"
+QUERIES = [
+    ('get_user_invoices', f'{LIST} ORDER BY created_at DESC', ()),
+    ('get_user_quotes', f"{LIST} AND document_type = 'quote' ORDER BY created_at DESC", ()),
+    ('invoice page', f'{LIST} AND document_type = ? ORDER BY created_at DESC, invoice_id DESC LIMIT 11',
+     ('invoice',)),
+    ('invoice keyset page', f'{LIST} AND document_type = ? AND (created_at, invoice_id) < (?, ?) '
+     'ORDER BY created_at DESC, invoice_id DESC LIMIT 11', ('invoice', '2025-06-01 00:00:00', 1 << 62)),
+    ('untyped page', f'{LIST} ORDER BY created_at DESC, invoice_id DESC LIMIT 11', ()),
+]
+
+
+def build_database(conn, rows, users, heavy_share):
+    """Insert rows invoices, heavy_share of them owned by HEAVY_USER"""
+    rng = random.Random(0)
+    start = datetime(2024, 1, 1)
+    statuses = ['approved'] * 8 + ['draft', 'pending']
+
+    def invoices():
+        for number in range(1, rows + 1):
+            user_id = HEAVY_USER if rng.random() < heavy_share else rng.randint(2, users)
+            created_at = start + timedelta(seconds=rng.randint(0, 3 * 365 * 86400))
+            yield (
+                user_id, f'INV-{number:07d}', f'Client {rng.randint(1, 500)}',
+                rng.choice(statuses), rng.choice(['invoice', 'invoice', 'quote']),
+                created_at.strftime('%Y-%m-%d %H:%M:%S'), round(rng.uniform(10, 5000), 2),
+            )
+
+    conn.execute(INVOICES_TABLE)
+    conn.executemany('''
+        INSERT INTO invoices (user_id, invoice_number, client_name, status, document_type,
+                              created_at, total_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', invoices())
+    conn.commit()
+
+
+def use_indexes(conn, name):
+    """Drop the previous candidate's indexes and create this one's"""
+    for (index_name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'bench_%'").fetchall():
+        conn.execute(f'DROP INDEX {index_name}')
+    began = time.perf_counter()
+    for number, definition in enumerate(INDEX_SETS[name]):
+        conn.execute(f'CREATE INDEX bench_{number} ON {definition}')
+    conn.execute('ANALYZE')
+    conn.commit()
+    size = conn.execute(
+        "SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name LIKE 'bench_%'"
+    ).fetchone()[0] if has_dbstat(conn) else None
+    return time.perf_counter() - began, size
+
+
+def has_dbstat(conn):
+    try:
+        conn.execute('SELECT 1 FROM dbstat LIMIT 1')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def run_queries(conn, repeat):
+    """Return {label: (best seconds, plan)} for each benchmarked statement"""
+    results = {}
+    for label, sql, extra in QUERIES:
+        params = (HEAVY_USER, *extra)
+        plan = '; '.join(row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params))
+        timings = []
+        for _ in range(repeat):
+            began = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            timings.append(time.perf_counter() - began)
+        results[label] = (min(timings), plan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--heavy-share', type=float, default=0.1,
+                        help='fraction of rows owned by the benchmarked account')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench_invoices_') as workdir:
+        conn = sqlite3.connect(os.path.join(workdir, 'invoices.db'))
+        began = time.perf_counter()
+        build_database(conn, args.rows, args.users, args.heavy_share)
+        print(f'Built {args.rows:,} invoices in {time.perf_counter() - began:.1f}s')
+
+        results = {}
+        for name in INDEX_SETS:
+            build_seconds, size = use_indexes(conn, name)
+            results[name] = run_queries(conn, args.repeat)
+            size_note = f', {size / 1e6:.1f} MB' if size is not None else ''
+            print(f'\n{name}: {" + ".join(INDEX_SETS[name])} (built in {build_seconds:.1f}s{size_note})')
+            for label, (_, plan) in results[name].items():
+                print(f'  {label:20} {plan}')
+        conn.close()
+
+    print(f'\n{"query":20}' + ''.join(f'{name:>14}' for name in INDEX_SETS))
+    for label, _, _ in QUERIES:
+        print(f'{label:20}' + ''.join(f'{results[name][label][0] * 1000:12.2f}ms' for name in INDEX_SETS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Fixtures for the database-layer tests
+
+invoice_bot2.py is a single module whose top-level imports need the whole
+deployment stack (python-telegram-bot, ReportLab, Pillow). The database layer
+only needs the standard library, so tests exec just the sections they
+exercise, sliced out of the source by their "# ===== ... =====" banners.
+"""
+import ast
+import logging
+from pathlib import Path
+
+import pytest
+
+SOURCE = Path(__file__).resolve().parent.parent / 'invoice_bot2.py'
+
+CORE_IMPORTS = ('# ===== CORE IMPORTS =====', '# ===== THIRD-PARTY IMPORTS =====')
+DB_LAYER = ('# ===== DATABASE CONNECTION MANAGER =====', '# ===== INITIALIZE DATABASE =====')
+USER_DEFAULTS = ('# ===== DEFAULT SETTINGS HELPER FUNCTIONS =====', '# ===== BOT COMMANDS SETUP =====')
+
+
+def load_sections(*banners):
+    """Exec the core imports and each (start, end) banner range into one namespace"""
+    source = SOURCE.read_text(encoding='utf-8')
+    namespace = {'__name__': 'invoice_bot2', 'logger': logging.getLogger('invoice_bot2')}
+    for start, end in (CORE_IMPORTS,) + banners:
+        begin = source.index(start)
+        code = source[begin:source.index(end, begin)]
+        # Pad with newlines so tracebacks point at the real line numbers
+        padded = '\n' * source.count('\n', 0, begin) + code
+        exec(compile(padded, str(SOURCE), 'exec'), namespace)
+    return namespace
+
+
+def load_functions(namespace, *names):
+    """Exec the top-level definitions of the given functions into namespace
+
+    Classes and module-level constants can be named too. The module
+    redefines some helpers in later parts; like the running bot, the last
+    definition wins.
+    """
+    source = SOURCE.read_text(encoding='utf-8')
+    definitions = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            definitions[node.name] = node
+        elif isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            definitions[node.targets[0].id] = node
+    for name in names:
+        node = definitions[name]
+        module = ast.Module(body=[node], type_ignores=[])
+        exec(compile(module, str(SOURCE), 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture
+def load_bot(tmp_path, monkeypatch):
+    """Load the database layer plus the given sections against a fresh, migrated database"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'invoices.db'))
+    loaded = []
+
+    def load(*banners):
+        bot = load_sections(DB_LAYER, *banners)
+        bot['init_db']()
+        loaded.append(bot)
+        return bot
+
+    yield load
+    for bot in loaded:
+        bot['close_db_connection']()
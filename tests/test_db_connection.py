@@ -0,0 +1,100 @@
+"""Nested lease semantics of the shared per-thread connection"""
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def bot(load_bot, tmp_path):
+    bot = load_bot()
+    with bot['db_connection']() as conn:
+        conn.execute('CREATE TABLE notes (body TEXT)')
+    return bot
+
+
+def committed_notes(tmp_path):
+    """Rows visible to another connection, i.e. actually committed"""
+    other = sqlite3.connect(tmp_path / 'invoices.db')
+    try:
+        return sorted(row[0] for row in other.execute('SELECT body FROM notes'))
+    finally:
+        other.close()
+
+
+def insert_and_commit(bot, body):
+    """A helper that takes its own lease and commits, like most of invoice_bot2"""
+    conn = bot['get_db_connection']()
+    conn.execute('INSERT INTO notes VALUES (?)', (body,))
+    conn.commit()
+    conn.close()
+
+
+def test_nested_commit_does_not_commit_callers_partial_work(bot, tmp_path):
+    outer = bot['get_db_connection']()
+    outer.execute("INSERT INTO notes VALUES ('outer')")
+    insert_and_commit(bot, 'inner')
+
+    assert committed_notes(tmp_path) == []
+
+    outer.commit()
+    outer.close()
+    assert committed_notes(tmp_path) == ['inner', 'outer']
+
+
+def test_outer_rollback_discards_nested_work(bot, tmp_path):
+    outer = bot['get_db_connection']()
+    outer.execute("INSERT INTO notes VALUES ('outer')")
+    insert_and_commit(bot, 'inner')
+    outer.rollback()
+    outer.close()
+
+    assert committed_notes(tmp_path) == []
+
+
+def test_nested_rollback_only_undoes_its_own_changes(bot, tmp_path):
+    with bot['db_connection']() as outer:
+        outer.execute("INSERT INTO notes VALUES ('outer')")
+        inner = bot['get_db_connection']()
+        inner.execute("INSERT INTO notes VALUES ('inner')")
+        inner.rollback()
+        inner.close()
+
+    assert committed_notes(tmp_path) == ['outer']
+
+
+def test_nested_close_without_commit_rolls_back_its_changes(bot, tmp_path):
+    with bot['db_connection']() as outer:
+        outer.execute("INSERT INTO notes VALUES ('outer')")
+        inner = bot['get_db_connection']()
+        inner.execute("INSERT INTO notes VALUES ('inner')")
+        inner.close()
+
+    assert committed_notes(tmp_path) == ['outer']
+
+
+def test_nested_commit_is_final_when_caller_has_no_transaction(bot, tmp_path):
+    outer = bot['get_db_connection']()
+    outer.execute('SELECT COUNT(*) FROM notes').fetchone()
+    insert_and_commit(bot, 'inner')
+
+    assert committed_notes(tmp_path) == ['inner']
+    outer.close()
+    assert committed_notes(tmp_path) == ['inner']
+
+
+def test_outermost_close_keeps_work_a_nested_lease_committed(bot, tmp_path):
+    # The helper's commit() used to commit the whole transaction on the spot
+    outer = bot['get_db_connection']()
+    outer.execute("INSERT INTO notes VALUES ('outer')")
+    insert_and_commit(bot, 'inner')
+    outer.close()
+
+    assert committed_notes(tmp_path) == ['inner', 'outer']
+
+
+def test_outermost_close_rolls_back_uncommitted_work(bot, tmp_path):
+    conn = bot['get_db_connection']()
+    conn.execute("INSERT INTO notes VALUES ('lost')")
+    conn.close()
+
+    assert committed_notes(tmp_path) == []
@@ -0,0 +1,69 @@
+"""Tier resolution in EntitlementService"""
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import load_functions
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    return load_functions(
+        bot, 'TIER_LIMITS', 'ENTITLEMENT_CACHE_TTL', 'parse_trial_end_date', 'EntitlementService',
+    )
+
+
+def add_user(bot, user_id, tier='free', expires_at=None, premium_row=False):
+    with bot['db_connection']() as conn:
+        conn.execute(
+            'INSERT INTO users (user_id, subscription_tier) VALUES (?, ?)', (user_id, tier)
+        )
+        if premium_row:
+            conn.execute(
+                'INSERT INTO premium_users (user_id, premium_type, expires_at) VALUES (?, ?, ?)',
+                (user_id, 'paid', expires_at)
+            )
+        conn.commit()
+
+
+def test_expired_subscription_is_free_despite_stale_tier_column(bot):
+    add_user(bot, 1, 'premium', (date.today() - timedelta(days=1)).isoformat(), premium_row=True)
+
+    tier = bot['EntitlementService']().get(1)
+
+    assert tier['name'] == 'free'
+
+
+def test_active_subscription_reports_its_expiry(bot):
+    expires = (date.today() + timedelta(days=10)).isoformat()
+    add_user(bot, 1, 'premium', expires, premium_row=True)
+
+    tier = bot['EntitlementService']().get(1)
+
+    assert (tier['name'], tier['type'], tier['expires']) == ('premium', 'paid', expires)
+
+
+def test_tier_column_counts_when_there_is_no_subscription_row(bot):
+    add_user(bot, 1, 'premium')
+    add_user(bot, 2)
+
+    tiers = bot['EntitlementService']().get_many([1, 2])
+
+    assert (tiers[1]['name'], tiers[1]['expires']) == ('premium', 'Never')
+    assert tiers[2]['name'] == 'free'
+
+
+def test_get_many_reads_subscriptions_in_one_query(bot):
+    for user_id in range(1, 21):
+        add_user(bot, user_id, 'premium', '2099-01-01', premium_row=True)
+    conn = bot['_get_thread_connection']()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        tiers = bot['EntitlementService']().get_many(range(1, 21))
+    finally:
+        conn.set_trace_callback(None)
+
+    assert {tier['name'] for tier in tiers.values()} == {'premium'}
+    assert sum('FROM premium_users' in sql for sql in statements) == 1
@@ -0,0 +1,58 @@
+"""Moving invoices.items blobs into invoice_items"""
+import json
+
+from conftest import DB_LAYER, load_sections
+
+GOOD_ITEMS = json.dumps([{'description': 'Consulting', 'quantity': 2, 'amount': 50.0}])
+
+
+def insert_invoice(cursor, invoice_id, items):
+    cursor.execute(
+        'INSERT INTO invoices (invoice_id, user_id, invoice_number, items) VALUES (?, 1, ?, ?)',
+        (invoice_id, f'INV-{invoice_id}', items)
+    )
+
+
+def test_migration_004_quarantines_unreadable_blobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('DB_PATH', str(tmp_path / 'invoices.db'))
+    bot = load_sections(DB_LAYER)
+
+    # A database from before line items had their own table (schema version 3)
+    with bot['db_connection']() as conn:
+        cursor = conn.cursor()
+        cursor.execute('CREATE TABLE schema_version (version INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+        for version, name, migrate in bot['SCHEMA_MIGRATIONS'][:3]:
+            migrate(cursor)
+            cursor.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+        insert_invoice(cursor, 1, GOOD_ITEMS)
+        insert_invoice(cursor, 2, '[{"description": "Broken"')
+        insert_invoice(cursor, 3, '{"not": "a list"}')
+
+    bot['init_db']()
+
+    with bot['db_connection']() as conn:
+        items = conn.execute('SELECT invoice_id, description FROM invoice_items').fetchall()
+        quarantined = conn.execute(
+            'SELECT invoice_id, items FROM invoice_items_quarantine ORDER BY invoice_id'
+        ).fetchall()
+        blobs = conn.execute('SELECT COUNT(*) FROM invoices WHERE items IS NOT NULL').fetchone()[0]
+    bot['close_db_connection']()
+
+    assert items == [(1, 'Consulting')]
+    assert quarantined == [(2, '[{"description": "Broken"'), (3, '{"not": "a list"}')]
+    assert blobs == 0
+
+
+def test_migration_012_quarantines_blobs_left_behind_by_004(load_bot):
+    bot = load_bot()
+    with bot['db_connection']() as conn:
+        insert_invoice(conn.cursor(), 7, 'not json')
+        conn.execute('DELETE FROM schema_version WHERE version >= 12')
+
+    bot['init_db']()
+
+    with bot['db_connection']() as conn:
+        quarantined = conn.execute('SELECT invoice_id, items, error FROM invoice_items_quarantine').fetchall()
+    assert [row[:2] for row in quarantined] == [(7, 'not json')]
+    assert quarantined[0][2]
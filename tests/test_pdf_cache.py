@@ -0,0 +1,65 @@
+"""PdfCache: byte-bounded LRU of rendered PDFs"""
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import load_functions, load_sections
+
+
+@pytest.fixture
+def bot():
+    return load_functions(load_sections(), 'PDF_CACHE_MAX_BYTES', 'PDF_BRANDING_FIELDS', 'PdfCache')
+
+
+def test_least_recently_used_entries_are_evicted_by_size(bot):
+    cache = bot['PdfCache'](max_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'  # b is now the least recently used
+
+    cache.put('c', b'cccc')
+
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (b'aaaa', None, b'cccc')
+    assert cache.total_bytes == 8
+
+
+def test_entry_larger_than_the_cache_is_not_stored(bot):
+    cache = bot['PdfCache'](max_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('big', b'x' * 11)
+
+    assert (cache.get('a'), cache.get('big')) == (b'aaaa', None)
+
+
+def test_invalidate_user_drops_only_that_users_documents(bot):
+    cache = bot['PdfCache']()
+    cache.put('a', b'a', user_id=1, document_id=10)
+    cache.put('b', b'b', user_id=1, document_id=11)
+    cache.put('c', b'c', user_id=2, document_id=12)
+
+    cache.invalidate_user(1)
+
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (None, None, b'c')
+    assert cache.total_bytes == 1
+
+
+def test_invalidate_document_drops_every_rendition_of_it(bot):
+    cache = bot['PdfCache']()
+    cache.put('quote-v1', b'v1', user_id=1, document_id=10)
+    cache.put('quote-v2', b'v2', user_id=1, document_id=10)
+    cache.put('other', b'o', user_id=1, document_id=11)
+
+    cache.invalidate_document(10)
+
+    assert (cache.get('quote-v1'), cache.get('quote-v2'), cache.get('other')) == (None, None, b'o')
+
+
+def test_key_changes_with_branding(bot):
+    data = {'invoice_number': 'INV-1', 'items': [{'description': 'Work', 'amount': 5}]}
+    plain = SimpleNamespace(logo_path=None, company_name='Acme', company_reg_number=None, vat_reg_number=None)
+    renamed = SimpleNamespace(**{**vars(plain), 'company_name': 'Acme Ltd'})
+    key = bot['PdfCache'].key
+
+    assert key('invoice', data, plain) == key('invoice', dict(data), plain)
+    assert key('invoice', data, plain) != key('invoice', data, renamed)
+    assert key('invoice', data, plain) != key('quote', data, plain)
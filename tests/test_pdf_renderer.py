@@ -0,0 +1,70 @@
+"""PdfRenderService: queue bound, timeouts and a worker crash"""
+import asyncio
+import os
+import threading
+
+import pytest
+
+from conftest import DB_LAYER, load_functions, load_sections
+
+
+@pytest.fixture
+def bot():
+    bot = load_sections(DB_LAYER)
+    load_functions(
+        bot, 'PDF_RENDER_WORKERS', 'PDF_RENDER_QUEUE_SIZE', 'PDF_RENDER_QUEUE_WAIT', 'PDF_RENDER_TIMEOUT',
+        'PdfRenderBusy', '_inherited_conns', '_pdf_worker_init', 'PdfRenderService',
+    )
+    bot['PDF_RENDER_QUEUE_WAIT'] = 0.05
+    return bot
+
+
+def test_full_queue_raises_busy_and_slots_free_up(bot):
+    renderer = bot['PdfRenderService'](workers=0, queue_size=1)
+    release = threading.Event()
+
+    async def scenario():
+        blocked = asyncio.ensure_future(renderer.render(release.wait))
+        await asyncio.sleep(0.01)
+        with pytest.raises(bot['PdfRenderBusy']):
+            await renderer.render(int)
+        release.set()
+        await blocked
+        return await renderer.render(int, '7')
+
+    assert asyncio.run(scenario()) == 7
+
+
+def test_timed_out_render_holds_its_slot_until_it_finishes(bot):
+    renderer = bot['PdfRenderService'](workers=0, queue_size=1)
+    release = threading.Event()
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await renderer.render(release.wait, timeout=0.05)
+        # The abandoned render still runs, so the queue is still full
+        with pytest.raises(bot['PdfRenderBusy']):
+            await renderer.render(int)
+        release.set()
+        await asyncio.sleep(0.05)
+        return await renderer.render(int, '3')
+
+    assert asyncio.run(scenario()) == 3
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs the fork start method')
+def test_broken_pool_is_not_reforked(bot):
+    renderer = bot['PdfRenderService'](workers=1)
+    renderer.start()
+
+    async def scenario():
+        with pytest.raises(bot['BrokenProcessPool']):
+            await renderer.render(os._exit, 1)
+        return await renderer.render(os.getpid)
+
+    try:
+        assert asyncio.run(scenario()) == os.getpid()
+        renderer.start()
+        assert renderer._executor is None
+    finally:
+        renderer.shutdown()
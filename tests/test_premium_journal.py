@@ -0,0 +1,56 @@
+"""premium_manager.py's text file plus append-only journal"""
+import importlib.util
+
+import pytest
+
+from conftest import SOURCE
+
+MODULE = SOURCE.parent / 'premium_manager.py'
+
+
+@pytest.fixture
+def premium_manager(tmp_path, monkeypatch):
+    """The module, imported in tmp_path so its global instance's files land there"""
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location('premium_manager', MODULE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_journal_is_replayed_on_load(premium_manager):
+    manager = premium_manager.PremiumManager()
+    manager.add_premium_users([(12, 'alice'), (34, 'bob')])
+    manager.remove_premium_user(12)
+
+    reloaded = premium_manager.PremiumManager()
+
+    assert list(reloaded.premium_users) == [34]
+    assert reloaded.premium_users[34][0] == 'bob'
+
+
+def test_load_and_threshold_compact_the_journal(premium_manager, tmp_path):
+    manager = premium_manager.PremiumManager(compact_after=3)
+    manager.add_premium_user(1, 'a')
+    manager.add_premium_user(2, 'b')
+    journal = tmp_path / 'premium_users.txt.journal'
+    assert len(journal.read_text().splitlines()) == 2
+
+    manager.add_premium_user(3, 'c')
+
+    assert journal.read_text() == ''
+    assert '3 | c |' in (tmp_path / 'premium_users.txt').read_text()
+    assert set(premium_manager.PremiumManager().premium_users) == {1, 2, 3}
+
+
+def test_torn_tail_is_dropped_before_the_next_append(premium_manager, tmp_path):
+    premium_manager.PremiumManager()
+    (tmp_path / 'premium_users.txt.journal').write_text('+12 | torn')
+
+    manager = premium_manager.PremiumManager()
+    manager.add_premium_user(34, 'bob')
+
+    assert manager.premium_users.keys() == {34}
+    reloaded = premium_manager.PremiumManager()
+    assert reloaded.premium_users.keys() == {34}
+    assert reloaded.premium_users[34][0] == 'bob'
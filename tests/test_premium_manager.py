@@ -0,0 +1,64 @@
+"""PremiumManager subscriptions in the premium_users table"""
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import load_functions
+
+YESTERDAY = (date.today() - timedelta(days=1)).isoformat()
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    load_functions(
+        bot, 'TIER_LIMITS', 'ENTITLEMENT_CACHE_TTL', 'parse_trial_end_date', 'EntitlementService',
+        'entitlements', 'PremiumManager', 'get_user', 'add_premium_subscription_enhanced',
+    )
+    bot['premium_manager'] = bot['PremiumManager']()
+    return bot
+
+
+def subscription_tier(bot, user_id):
+    with bot['db_connection']() as conn:
+        return conn.execute(
+            'SELECT subscription_tier FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone()[0]
+
+
+def test_expire_lapsed_users_downgrades_and_invalidates(bot):
+    with bot['db_connection']() as conn:
+        conn.execute('INSERT INTO users (user_id) VALUES (1), (2)')
+        conn.commit()
+    manager = bot['premium_manager']
+    manager.add_premium_user(1, 'lapsed', 'paid')
+    manager.add_premium_user(2, 'current', 'paid')
+    assert bot['entitlements'].get(1)['name'] == 'premium'  # now cached
+    with bot['db_connection']() as conn:
+        conn.execute('UPDATE premium_users SET expires_at = ? WHERE user_id = 1', (YESTERDAY,))
+        conn.commit()
+
+    assert manager.expire_lapsed_users() == [1]
+
+    assert (subscription_tier(bot, 1), subscription_tier(bot, 2)) == ('free', 'premium')
+    assert bot['entitlements'].get(1)['name'] == 'free'
+    assert manager.expire_lapsed_users() == []
+
+
+def test_trial_grant_records_the_trial_and_is_not_repeatable(bot):
+    with bot['db_connection']() as conn:
+        conn.execute("INSERT INTO users (user_id, username) VALUES (1, 'alice')")
+        conn.commit()
+    grant = bot['add_premium_subscription_enhanced']
+
+    assert grant(1, 'trial', 1)[0] is True
+    with bot['db_connection']() as conn:
+        trial_end, trial_used = conn.execute(
+            'SELECT trial_end_date, trial_used FROM users WHERE user_id = 1'
+        ).fetchone()
+        expires = conn.execute('SELECT expires_at FROM premium_users WHERE user_id = 1').fetchone()[0]
+    assert trial_end and trial_used
+
+    assert grant(1, 'trial', 1)[0] is False
+    with bot['db_connection']() as conn:
+        assert conn.execute('SELECT expires_at FROM premium_users WHERE user_id = 1').fetchone()[0] == expires
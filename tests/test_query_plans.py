@@ -0,0 +1,79 @@
+"""EXPLAIN QUERY PLAN regression checks for the indexed list queries"""
+from datetime import date, datetime
+
+import pytest
+
+from conftest import load_functions
+
+APPOINTMENT_QUERIES = (
+    'get_today_appointments', 'get_tomorrow_appointments',
+    'get_week_appointments', 'get_appointments_between',
+    'get_user_availability', 'get_user_calendar_settings',
+)
+INVOICE_QUERIES = (
+    'DOCUMENT_PAGE_SIZE', 'encode_page_cursor',
+    'get_user_invoices', 'get_user_quotes', 'get_document_page',
+)
+PAGE_CURSOR = ('2026-03-02 10:00:00', 500)
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    return load_functions(bot, *APPOINTMENT_QUERIES, *INVOICE_QUERIES)
+
+
+def query_plans(bot, call, table):
+    """Run call() and return (sql, plan details) for each SELECT on table it executed"""
+    conn = bot['_get_thread_connection']()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    plans = []
+    for sql in statements:
+        if sql.lstrip().upper().startswith('SELECT') and f'FROM {table}' in sql:
+            details = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+            plans.append((sql, details))
+    assert plans, 'no SELECT was executed'
+    return plans
+
+
+def assert_uses_index(plans, index_name):
+    for sql, details in plans:
+        plan = '\n'.join(details)
+        assert f'INDEX {index_name}' in plan, f'{index_name} not used:\n{plan}\n{sql}'
+        assert 'SCAN' not in plan, f'table scan:\n{plan}\n{sql}'
+        assert 'USE TEMP B-TREE' not in plan, f'sort step:\n{plan}\n{sql}'
+
+
+@pytest.mark.parametrize('name, args', [
+    ('get_today_appointments', (1,)),
+    ('get_tomorrow_appointments', (1,)),
+    ('get_week_appointments', (1, datetime(2026, 3, 2, 15, 30))),
+    ('get_appointments_between', (1, date(2026, 3, 1), date(2026, 3, 31))),
+    ('get_user_availability', (1, date(2026, 3, 2))),
+])
+def test_appointment_day_filters_seek_the_time_index(bot, name, args):
+    plans = query_plans(bot, lambda: bot[name](*args), 'appointments')
+
+    assert_uses_index(plans, 'idx_appointments_user_date')
+    for sql, details in plans:
+        assert 'DATE(' not in sql.upper()
+        assert any('appointment_time>' in detail for detail in details), details
+
+
+@pytest.mark.parametrize('name, args, kwargs', [
+    ('get_user_invoices', (1,), {}),
+    ('get_user_quotes', (1,), {}),
+    ('get_document_page', (1,), {}),
+    ('get_document_page', (1,), {'after': PAGE_CURSOR}),
+    ('get_document_page', (1, 'invoice'), {}),
+    ('get_document_page', (1, 'quote'), {'after': PAGE_CURSOR}),
+])
+def test_document_lists_read_in_index_order(bot, name, args, kwargs):
+    plans = query_plans(bot, lambda: bot[name](*args, **kwargs), 'invoices')
+
+    assert_uses_index(plans, 'idx_invoices_user_status_created')
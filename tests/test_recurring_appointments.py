@@ -0,0 +1,76 @@
+"""Recurring appointment series and conflict detection"""
+from datetime import datetime
+
+import pytest
+
+from conftest import load_functions
+
+START = datetime(2026, 3, 2, 10, 0)
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    return load_functions(
+        bot, 'MAX_RECURRING_OCCURRENCES', 'APPOINTMENT_OVERLAP_SQL', 'SeriesConflictError',
+        'get_recurrence_dates', 'find_series_conflicts', 'create_recurring_appointments',
+        'create_appointment', 'check_appointment_conflict', 'get_appointment_conflicts',
+    )
+
+
+def appointment_count(bot):
+    with bot['db_connection']() as conn:
+        return conn.execute('SELECT COUNT(*) FROM appointments').fetchone()[0]
+
+
+def test_conflicting_series_is_refused_by_default(bot):
+    bot['create_appointment'](1, 1, 'Existing', datetime(2026, 3, 9, 10, 30), duration_minutes=30)
+
+    with pytest.raises(bot['SeriesConflictError']) as raised:
+        bot['create_recurring_appointments'](1, 1, 'Weekly', '', START, 60, 'meeting', 'weekly', count=3)
+
+    assert list(raised.value.conflicts) == ['2026-03-09 10:00:00']
+    assert appointment_count(bot) == 1
+
+
+def test_skip_conflicts_creates_only_free_occurrences(bot):
+    bot['create_appointment'](1, 1, 'Existing', datetime(2026, 3, 9, 10, 30), duration_minutes=30)
+
+    created = bot['create_recurring_appointments'](
+        1, 1, 'Weekly', '', START, 60, 'meeting', 'weekly', count=3, skip_conflicts=True
+    )
+
+    assert len(created) == 2
+    assert appointment_count(bot) == 3
+
+
+def test_series_and_single_checks_agree_on_back_to_back_slots(bot):
+    # Existing 11:00-12:00 appointment; the new 10:00-11:00 slot ends as it starts
+    bot['create_appointment'](1, 1, 'Existing', datetime(2026, 3, 2, 11, 0), duration_minutes=60)
+
+    single = bot['check_appointment_conflict'](1, START, 60)
+    listed = bot['get_appointment_conflicts'](1, START, 60)
+    with bot['db_connection']() as conn:
+        series = bot['find_series_conflicts'](conn.cursor(), 1, [START], 60)
+
+    assert single is True
+    assert [appointment.title for appointment in listed] == ['Existing']
+    assert list(series) == ['2026-03-02 10:00:00']
+
+
+def test_count_above_the_cap_is_rejected(bot):
+    with pytest.raises(ValueError):
+        bot['get_recurrence_dates'](START, 'daily', count=bot['MAX_RECURRING_OCCURRENCES'] + 1)
+
+
+def test_end_date_past_the_cap_is_rejected_rather_than_truncated(bot):
+    with pytest.raises(ValueError):
+        bot['create_recurring_appointments'](
+            1, 1, 'Daily', '', START, 30, 'meeting', 'daily', end_date=datetime(2028, 1, 1)
+        )
+    assert appointment_count(bot) == 0
+
+
+def test_series_at_the_cap_is_created(bot):
+    dates = bot['get_recurrence_dates'](START, 'daily', count=bot['MAX_RECURRING_OCCURRENCES'])
+    assert len(dates) == bot['MAX_RECURRING_OCCURRENCES']
@@ -0,0 +1,48 @@
+"""Full-text search and client-name filters stay within one tenant"""
+import pytest
+
+from conftest import load_functions
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    if not bot['search_index_available']():
+        pytest.skip('SQLite built without FTS5')
+    load_functions(bot, 'invoice_client_condition', 'client_name_condition')
+    with bot['db_connection']() as conn:
+        for user_id in (1, 2):
+            conn.execute('INSERT INTO clients (user_id, client_name) VALUES (?, ?)', (user_id, 'Acme Ltd'))
+            invoice_id = conn.execute('''
+                INSERT INTO invoices (user_id, invoice_number, client_name, status)
+                VALUES (?, ?, 'Acme Ltd', 'approved')
+            ''', (user_id, f'INV-{user_id}')).lastrowid
+            conn.execute('INSERT INTO invoice_items (invoice_id, description) VALUES (?, ?)',
+                         (invoice_id, 'Boiler service'))
+    return bot
+
+
+def matching_ids(bot, table, column, condition):
+    sql, params = condition
+    with bot['db_connection']() as conn:
+        return [row[0] for row in conn.execute(f'SELECT {column} FROM {table} c WHERE {sql}', params)]
+
+
+def test_invoice_client_condition_only_matches_the_users_rows(bot):
+    condition = bot['invoice_client_condition']('acme', 1)
+
+    assert 'invoices_fts' in condition[0]
+    assert matching_ids(bot, 'invoices', 'user_id', condition) == [1]
+
+
+def test_client_name_condition_only_matches_the_users_rows(bot):
+    condition = bot['client_name_condition']('acme', 2)
+
+    assert 'clients_fts' in condition[0]
+    assert matching_ids(bot, 'clients', 'user_id', condition) == [2]
+
+
+def test_item_search_returns_only_the_users_documents(bot):
+    found = bot['search_documents'](2, 'boiler')
+
+    assert [document.invoice_number for document in found] == ['INV-2']
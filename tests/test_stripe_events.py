@@ -0,0 +1,72 @@
+"""Queued Stripe webhook events, driven by the local fake payload generator"""
+import json
+
+import pytest
+
+from conftest import load_functions
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    load_functions(
+        bot, 'TIER_LIMITS', 'ENTITLEMENT_CACHE_TTL', 'parse_trial_end_date', 'EntitlementService',
+        'entitlements', 'PremiumManager', 'get_user', 'add_premium_subscription_enhanced',
+        'STRIPE_EVENT_MAX_ATTEMPTS', 'record_stripe_event', 'apply_stripe_event',
+        'process_stripe_events', 'fake_stripe_event',
+    )
+    bot['premium_manager'] = bot['PremiumManager']()
+    bot['add_premium_subscription'] = bot['add_premium_subscription_enhanced']
+    with bot['db_connection']() as conn:
+        conn.execute('INSERT INTO users (user_id) VALUES (42)')
+        conn.commit()
+    return bot
+
+
+def queue(bot, payload):
+    event = json.loads(payload)
+    return bot['record_stripe_event'](event['id'], event['type'], payload)
+
+
+def event_state(bot, event_id):
+    with bot['db_connection']() as conn:
+        return conn.execute(
+            'SELECT status, attempts FROM stripe_events WHERE event_id = ?', (event_id,)
+        ).fetchone()
+
+
+def test_duplicate_event_id_is_ignored(bot):
+    payload = bot['fake_stripe_event'](42, event_id='evt_dup')
+
+    assert queue(bot, payload) is True
+    assert queue(bot, bot['fake_stripe_event'](42, months=12, event_id='evt_dup')) is False
+
+    with bot['db_connection']() as conn:
+        stored = conn.execute('SELECT payload FROM stripe_events').fetchall()
+    assert stored == [(payload,)]
+
+
+def test_pending_event_is_applied_once_and_marked_processed(bot):
+    queue(bot, bot['fake_stripe_event'](42, months=3, event_id='evt_paid'))
+
+    assert bot['process_stripe_events']() == [(42, 3)]
+    assert bot['process_stripe_events']() == []
+
+    assert event_state(bot, 'evt_paid') == ('processed', 1)
+    data = bot['premium_manager'].get_user_data(42)
+    assert (data['type'], data['months']) == ('paid', 3)
+
+
+def test_failing_event_is_retried_then_marked_failed(bot):
+    event = json.loads(bot['fake_stripe_event'](42, event_id='evt_bad'))
+    event['data']['object']['client_reference_id'] = 'not-a-user'
+    queue(bot, json.dumps(event))
+
+    for attempt in range(1, bot['STRIPE_EVENT_MAX_ATTEMPTS']):
+        assert bot['process_stripe_events']() == []
+        assert event_state(bot, 'evt_bad') == ('pending', attempt)
+
+    bot['process_stripe_events']()
+    assert event_state(bot, 'evt_bad') == ('failed', bot['STRIPE_EVENT_MAX_ATTEMPTS'])
+    bot['process_stripe_events']()
+    assert event_state(bot, 'evt_bad') == ('failed', bot['STRIPE_EVENT_MAX_ATTEMPTS'])
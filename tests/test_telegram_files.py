@@ -0,0 +1,86 @@
+"""Re-sending uploads by their stored Telegram file_id"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import load_functions
+
+
+class BadRequest(Exception):
+    """Stands in for telegram.error.BadRequest"""
+
+
+class FakeBot:
+    """Records send_document calls; file_ids listed in rejected raise BadRequest"""
+
+    def __init__(self, rejected=()):
+        self.rejected = set(rejected)
+        self.sent = []
+
+    async def send_document(self, chat_id, document, caption=None, filename=None):
+        self.sent.append(document)
+        if document in self.rejected:
+            raise BadRequest('wrong file identifier')
+        file_id = f'file-{len(self.sent)}' if isinstance(document, bytes) else document
+        return SimpleNamespace(document=SimpleNamespace(file_id=file_id))
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    bot['BadRequest'] = BadRequest
+    load_functions(
+        bot, 'TELEGRAM_FILE_MAX_AGE_DAYS', 'get_telegram_file_id', 'save_telegram_file_id',
+        'forget_telegram_file_id', 'prune_telegram_file_ids', 'send_cached_file',
+    )
+    yield bot
+    bot['shutdown_db_executor']()
+
+
+def send(bot, telegram, loads):
+    async def load():
+        loads.append(1)
+        return b'%PDF-1.4'
+
+    return asyncio.run(bot['send_cached_file'](telegram, 1, 'hash-1', 'invoice', load, filename='INV-1.pdf'))
+
+
+def test_miss_uploads_and_stores_the_file_id(bot):
+    telegram, loads = FakeBot(), []
+
+    send(bot, telegram, loads)
+
+    assert telegram.sent == [b'%PDF-1.4'] and loads == [1]
+    assert bot['get_telegram_file_id']('hash-1') == 'file-1'
+
+
+def test_hit_resends_the_file_id_without_loading(bot):
+    bot['save_telegram_file_id']('hash-1', 'file-9', 'invoice')
+    telegram, loads = FakeBot(), []
+
+    send(bot, telegram, loads)
+
+    assert telegram.sent == ['file-9'] and loads == []
+
+
+def test_rejected_file_id_is_forgotten_and_reuploaded(bot):
+    bot['save_telegram_file_id']('hash-1', 'file-9', 'invoice')
+    telegram, loads = FakeBot(rejected={'file-9'}), []
+
+    send(bot, telegram, loads)
+
+    assert telegram.sent == ['file-9', b'%PDF-1.4'] and loads == [1]
+    assert bot['get_telegram_file_id']('hash-1') == 'file-2'
+
+
+def test_prune_drops_only_old_file_ids(bot):
+    bot['save_telegram_file_id']('new', 'file-new', 'invoice')
+    bot['save_telegram_file_id']('old', 'file-old', 'invoice')
+    with bot['db_connection']() as conn:
+        conn.execute("UPDATE telegram_files SET created_at = datetime('now', '-100 days') WHERE content_hash = 'old'")
+
+    assert bot['prune_telegram_file_ids'](90) == 1
+
+    assert bot['get_telegram_file_id']('old') is None
+    assert bot['get_telegram_file_id']('new') == 'file-new'
@@ -0,0 +1,88 @@
+"""Trigger-maintained monthly usage counters"""
+from datetime import datetime
+
+import pytest
+
+from conftest import load_functions
+
+SLOT = datetime(2026, 3, 2, 10, 0)
+
+
+@pytest.fixture
+def bot(load_bot):
+    bot = load_bot()
+    return load_functions(bot, 'get_monthly_usage', 'create_appointment', 'cancel_appointment')
+
+
+def execute(bot, sql, params=()):
+    with bot['db_connection']() as conn:
+        return conn.execute(sql, params).lastrowid
+
+
+def add_invoice(bot, status='draft', user_id=1):
+    return execute(bot, "INSERT INTO invoices (user_id, status, document_type) VALUES (?, ?, 'invoice')",
+                   (user_id, status))
+
+
+def set_status(bot, invoice_id, status):
+    execute(bot, 'UPDATE invoices SET status = ? WHERE invoice_id = ?', (status, invoice_id))
+
+
+def test_reapproval_counts_the_document_once(bot):
+    invoice_id = add_invoice(bot)
+    set_status(bot, invoice_id, 'approved')
+    set_status(bot, invoice_id, 'approved')
+    set_status(bot, invoice_id, 'draft')
+    set_status(bot, invoice_id, 'approved')
+
+    assert bot['get_monthly_usage'](1, 'invoice') == 1
+
+
+def test_deleting_an_approved_document_releases_it(bot):
+    invoice_id = add_invoice(bot, 'approved')
+    draft_id = add_invoice(bot)
+
+    execute(bot, 'DELETE FROM invoices WHERE invoice_id = ?', (draft_id,))
+    assert bot['get_monthly_usage'](1, 'invoice') == 1
+    execute(bot, 'DELETE FROM invoices WHERE invoice_id = ?', (invoice_id,))
+    assert bot['get_monthly_usage'](1, 'invoice') == 0
+
+
+def test_cancelling_or_deleting_an_appointment_frees_quota(bot):
+    cancelled = bot['create_appointment'](1, 1, 'Cancelled', SLOT)
+    deleted = bot['create_appointment'](1, 1, 'Deleted', SLOT.replace(hour=14))
+    assert bot['get_monthly_usage'](1, 'appointment') == 2
+
+    bot['cancel_appointment'](cancelled)
+    bot['cancel_appointment'](cancelled)
+    execute(bot, 'DELETE FROM appointments WHERE appointment_id = ?', (deleted,))
+
+    assert bot['get_monthly_usage'](1, 'appointment') == 0
+
+
+def test_released_usage_is_taken_from_the_period_it_was_counted_in(bot):
+    invoice_id = add_invoice(bot, 'approved')
+    execute(bot, "UPDATE usage_counters SET period = '2020-01'")
+    execute(bot, "UPDATE invoices SET usage_period = '2020-01'")
+
+    set_status(bot, invoice_id, 'draft')
+
+    with bot['db_connection']() as conn:
+        assert conn.execute("SELECT count FROM usage_counters WHERE period = '2020-01'").fetchone() == (0,)
+    assert bot['get_monthly_usage'](1, 'invoice') == 0
+
+
+def test_migration_rebuilds_counters_from_current_rows(bot):
+    add_invoice(bot, 'approved')
+    add_invoice(bot, 'draft')
+    bot['create_appointment'](1, 1, 'Cancelled', SLOT)
+    with bot['db_connection']() as conn:
+        # The old triggers left stale counts behind
+        conn.execute("UPDATE appointments SET status = 'cancelled', usage_period = NULL")
+        conn.execute('UPDATE usage_counters SET count = 5')
+        conn.execute('DELETE FROM schema_version WHERE version >= 13')
+
+    bot['init_db']()
+
+    assert bot['get_monthly_usage'](1, 'invoice') == 1
+    assert bot['get_monthly_usage'](1, 'appointment') == 0
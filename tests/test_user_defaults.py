@@ -0,0 +1,40 @@
+"""New-user scheduling defaults"""
+import pytest
+
+from conftest import USER_DEFAULTS
+
+WORKING_HOURS = ('# ===== WORKING HOURS FUNCTIONS =====', '# ===== QUOTE FUNCTIONS =====')
+
+
+@pytest.fixture
+def bot(load_bot):
+    return load_bot(USER_DEFAULTS, WORKING_HOURS)
+
+
+def test_get_working_hours_creates_defaults_for_user_without_any(bot):
+    hours = bot['get_working_hours'](5)
+
+    # (id, user_id, day_of_week, is_working_day, start_time, end_time, ...)
+    assert [row[2] for row in hours] == list(range(7))
+    assert [bool(row[3]) for row in hours] == [True] * 5 + [False] * 2
+    assert hours[0][4:6] == ('09:00', '17:00')
+    assert len(bot['get_working_hours'](5)) == 7
+
+
+def test_get_calendar_settings_creates_defaults_for_user_without_any(bot):
+    settings = bot['get_calendar_settings'](5)
+
+    # (user_id, default_view, first_day_of_week, slot_duration, ...)
+    assert settings[:4] == (5, 'week', 1, 30)
+
+
+def test_initialize_user_defaults_is_idempotent(bot):
+    bot['initialize_user_defaults'](5)
+    bot['initialize_user_defaults'](5)
+
+    with bot['db_connection']() as conn:
+        counts = {
+            table: conn.execute(f'SELECT COUNT(*) FROM {table} WHERE user_id = 5').fetchone()[0]
+            for table in ('working_hours', 'calendar_settings', 'email_templates', 'buffer_times')
+        }
+    assert counts == {'working_hours': 7, 'calendar_settings': 1, 'email_templates': 3, 'buffer_times': 1}